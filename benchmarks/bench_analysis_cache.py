@@ -0,0 +1,66 @@
+import os
+import sys
+import time
+import random
+import asyncio
+import logging
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "functions"))
+
+import cache
+import clients
+import pipeline
+from fakes import FakeAsyncDocumentAnalysisClient, load_analyze_result
+
+# Time spent analysing a stream of uploads where some files are re-uploads or function retries,
+# with and without the content addressed analysis cache. A second pass with an empty in-memory
+# LRU shows hits served from the durable backend after a host restart.
+
+
+def uploads(count, duplicate_rate, seed):
+    rng = random.Random(seed)
+    seen = []
+    for i in range(count):
+        if seen and rng.random() < duplicate_rate:
+            yield rng.choice(seen)
+        else:
+            data = ("invoice %d " % i).encode() + os.urandom(64 * 1024)
+            seen.append(data)
+            yield data
+
+
+async def _analyze_all(documents, analysis_cache, fake):
+    for data in documents:
+        if analysis_cache is None:
+            poller = await fake.begin_analyze_document_from_url("prebuilt-invoice", "https://bench/invoice/1-invoice.pdf")
+            await poller.result()
+        else:
+            await pipeline.analyze("prebuilt-invoice", "https://bench/invoice/1-invoice.pdf", data)
+
+
+def run(documents, analysis_cache, latency):
+    fake = FakeAsyncDocumentAnalysisClient({"prebuilt-invoice": load_analyze_result("sampleinvoice1")}, analysis_latency=latency)
+    clients.register_factory("docintell_async", lambda endpoint, key: fake)
+    cache.set_analysis_cache(analysis_cache)
+    start = time.perf_counter()
+    asyncio.run(_analyze_all(documents, analysis_cache, fake))
+    return time.perf_counter() - start, fake.analyses
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--documents", type=int, default=200)
+    parser.add_argument("--duplicate-rate", type=float, default=0.3, help="fraction of uploads that repeat an earlier file")
+    parser.add_argument("--latency", type=float, default=0.02, help="seconds per analysis")
+    args = parser.parse_args()
+    logging.disable(logging.INFO)
+
+    documents = list(uploads(args.documents, args.duplicate_rate, seed=1))
+    with tempfile.TemporaryDirectory() as directory:
+        backend = cache.DirectoryCacheBackend(directory)
+        for label, analysis_cache in [("no cache", None), ("cache", cache.AnalysisCache(backend)), ("after restart", cache.AnalysisCache(backend))]:
+            elapsed, analyses = run(documents, analysis_cache, args.latency)
+            stats = analysis_cache.stats() if analysis_cache else {}
+            print(f"{label:14} {elapsed:6.2f}s  analyses={analyses:4}  {stats}")
@@ -0,0 +1,160 @@
+import os
+import sys
+import time
+import random
+import asyncio
+import logging
+import argparse
+import azure.functions as func
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "functions"))
+
+import cache
+import clients
+import extraction
+import idempotency
+import telemetry
+from fakes import FakeAsyncCosmosClient, FakeAsyncOpenAI, FakeContext, load_analyze_result, user_function
+
+# Azure Open AI comparisons made by the fraud function for a change feed with the deliveries it gets
+# in production: every application is seen when it is created, after the first extraction and after
+# the second, --redelivered of the batches are delivered again (the invocation failed or the host
+# stopped before the lease was checkpointed), --overlap of them are processed by two hosts at the
+# same time (leases moving between hosts) and the comparisons the function writes come back to it.
+# Versions are written to the Cosmos DB stand-in as the batches are delivered, so a delivery sees the
+# etags of its batch and the function's etag conditional writes behave as they do in production.
+# Run with the idempotency records and with a store that never finds one, which compares whenever
+# an application is delivered without a comparison, like the function did before the records.
+# Also reports the time fraud() takes to drop a batch of changes that need no comparison.
+
+INVOICES = ["sampleinvoice1", "sampleinvoice2"]
+RECEIPTS = ["samplereciept1", "samplereciept2"]
+MAX_RETRY_COUNT = 5
+
+
+class NoRecordStore(idempotency.RunStore):
+    async def claim(self, application, fingerprint):
+        return idempotency.NEW, None
+
+    async def complete(self, application, fingerprint, result):
+        pass
+
+    async def release(self, application, fingerprint):
+        pass
+
+
+def changes(applications, ambiguous_rate, rng):
+    # The versions of every application in the order they are written
+    extracted = {name: extraction.extract(model_id, load_analyze_result(name))
+                 for model_id, names in (("prebuilt-invoice", INVOICES), ("prebuilt-receipt", RECEIPTS)) for name in names}
+    timeline = []
+    for number in range(applications):
+        invoice, receipt = dict(extracted[rng.choice(INVOICES)]), dict(extracted[rng.choice(RECEIPTS)])
+        if rng.random() < ambiguous_rate:
+            # Low total confidence sends the application to Azure Open AI
+            receipt["total_confidence"] = 0.5
+        first, second = rng.sample([("invoice", invoice), ("receipt", receipt)], 2)
+        written = rng.uniform(0, applications)
+        for version in [{"id": str(number)}, {"id": str(number), first[0]: first[1]}, {"id": str(number), first[0]: first[1], second[0]: second[1]}]:
+            timeline.append((written, version))
+            written += rng.uniform(0.5, 5)
+    timeline.sort(key=lambda change: change[0])
+    return [version for _, version in timeline]
+
+
+def _batch(versions, items):
+    # The change feed delivers the latest version of each item in a batch, as it was when read
+    latest = {}
+    for version in versions:
+        latest[version["id"]] = items[version["id"]]
+    return [func.Document.from_dict(dict(item)) for item in latest.values()]
+
+
+async def deliver(fraud, documents, stats):
+    # One delivery of a batch, retried with the retry policy of the fraud function
+    for attempt in range(MAX_RETRY_COUNT + 1):
+        stats["invocations"] += 1
+        try:
+            await fraud(func.DocumentList([func.Document.from_dict(dict(doc)) for doc in documents]), FakeContext(attempt, MAX_RETRY_COUNT))
+            return
+        except Exception:
+            stats["retries"] += 1
+            await asyncio.sleep(0.01)
+
+
+async def feed(fraud, timeline, items, args, rng):
+    stats = {"changes": 0, "invocations": 0, "retries": 0}
+    batches = [timeline[i:i + args.batch] for i in range(0, len(timeline), args.batch)]
+    for versions in batches:
+        # The intake app and the invoice and receipt functions write these versions
+        for version in versions:
+            previous = items.get(version["id"], {})
+            items[version["id"]] = dict(previous, **version, _etag=os.urandom(8).hex())
+        documents = _batch(versions, items)
+        hosts = 2 if rng.random() < args.overlap else 1
+        deliveries = hosts + (rng.random() < args.redelivered)
+        stats["changes"] += len(documents) * deliveries
+        await asyncio.gather(*(deliver(fraud, documents, stats) for _ in range(hosts)))
+        if deliveries > hosts:
+            await deliver(fraud, documents, stats)
+    # The function's own writes come back through the change feed
+    written = [dict(item) for item in items.values() if item.get("comparison")]
+    for i in range(0, len(written), args.batch):
+        stats["changes"] += len(written[i:i + args.batch])
+        await deliver(fraud, written[i:i + args.batch], stats)
+    stats["applications compared"] = len(written)
+    return stats
+
+
+def run(timeline, store, args):
+    openai = FakeAsyncOpenAI(request_latency=args.openai_latency, seed=args.seed)
+    clients.register_factory("openai_async", lambda api_key, endpoint: openai)
+    items = {}
+    cosmos = FakeAsyncCosmosClient(items)
+    clients.register_factory("cosmos_async", lambda connection_string: cosmos)
+    cache.set_comparison_cache(cache.ComparisonCache(maxsize=0))
+    idempotency.set_run_store(store)
+    exporter = telemetry.LocalExporter()
+    telemetry.add_exporter(exporter)
+    try:
+        stats = asyncio.run(feed(user_function("fraud"), timeline, items, args, random.Random(args.seed)))
+    finally:
+        telemetry.remove_exporter(exporter)
+    stats["skipped changes"] = exporter.total("changefeed_skipped")
+    stats["comparisons reused"] = exporter.total("comparisons_reused")
+    stats["stale writes skipped"] = exporter.total("etag_conflicts")
+    stats["Open AI requests"] = openai.requests
+    return stats
+
+
+def skip_time(timeline, repeat):
+    # Microseconds per change of a batch of applications waiting for their second document
+    fraud = user_function("fraud")
+    waiting = {version["id"]: version for version in timeline if not ("invoice" in version and "receipt" in version)}
+    batch = func.DocumentList([func.Document.from_dict(dict(version)) for version in waiting.values()])
+    start = time.perf_counter()
+    for _ in range(repeat):
+        asyncio.run(fraud(batch, FakeContext()))
+    return (time.perf_counter() - start) * 1e6 / (repeat * len(batch))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--applications", type=int, default=300)
+    parser.add_argument("--batch", type=int, default=25, help="changes per change feed batch")
+    parser.add_argument("--ambiguous-rate", type=float, default=0.3, help="share of applications the pre-match cannot settle")
+    parser.add_argument("--redelivered", type=float, default=0.2, help="share of batches delivered again")
+    parser.add_argument("--overlap", type=float, default=0.1, help="share of batches processed by two hosts at once")
+    parser.add_argument("--openai-latency", type=float, default=0.05)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    logging.disable(logging.ERROR)
+
+    timeline = changes(args.applications, args.ambiguous_rate, random.Random(args.seed))
+    ambiguous = sum(1 for version in timeline if version.get("receipt", {}).get("total_confidence") == 0.5 and "invoice" in version)
+    print("%d applications, %d of them ambiguous, %d changes written" % (args.applications, ambiguous, len(timeline)))
+    results = {"idempotency records": run(timeline, idempotency.RunStore(), args), "no records": run(timeline, NoRecordStore(), args)}
+    print("%-24s %s" % ("", " ".join("%20s" % name for name in results)))
+    for key in results["no records"]:
+        print("%-24s %s" % (key, " ".join("%20d" % stats[key] for stats in results.values())))
+    print("dropping a change that needs no comparison: %.1f us" % skip_time(timeline, 20))
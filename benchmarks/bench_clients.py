@@ -0,0 +1,61 @@
+import os
+import sys
+import time
+import asyncio
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "functions"))
+
+import clients
+from fakes import FakeAsyncDocumentAnalysisClient, FakeAsyncCosmosClient, FakeAsyncBlobServiceClient, FakeAsyncOpenAI, load_analyze_result
+
+# Invocations/sec of a simulated invoice -> fraud invocation on the async clients the functions use,
+# with cold clients (closed and rebuilt for every invocation, as function_app.py used to do) versus
+# warm clients from the shared registry.
+
+
+def install_fakes(connect_latency, request_latency):
+    os.environ.setdefault("mfdocintell_STORAGE", "DefaultEndpointsProtocol=https;AccountName=bench;AccountKey=a2V5;EndpointSuffix=core.windows.net")
+    results = {"prebuilt-invoice": load_analyze_result("sampleinvoice1")}
+    clients.register_factory("docintell_async", lambda endpoint, key: FakeAsyncDocumentAnalysisClient(results, connect_latency=connect_latency, request_latency=request_latency))
+    items = {"1": {"id": "1", "invoice": [], "receipt": [], "_etag": "0"}}
+    clients.register_factory("cosmos_async", lambda connection_string: FakeAsyncCosmosClient(items, connect_latency=connect_latency, request_latency=request_latency))
+    blobs = {}
+    clients.register_factory("blob_async", lambda connection_string: FakeAsyncBlobServiceClient(blobs, connect_latency=connect_latency, request_latency=request_latency))
+    clients.register_factory("openai_async", lambda api_key, endpoint: FakeAsyncOpenAI(connect_latency=connect_latency, request_latency=request_latency))
+    return blobs
+
+
+async def invocation(blobs):
+    blobs[("invoice", "1-invoice.pdf")] = b"%PDF"
+    poller = await clients.get_async_document_analysis_client().begin_analyze_document_from_url("prebuilt-invoice", "https://bench/invoice/1-invoice.pdf")
+    await poller.result()
+    clients.processed_blob_uri("1-invoice.pdf")
+    container = clients.get_async_docs_container()
+    doc = await container.read_item(item="1", partition_key="1")
+    await container.replace_item(doc, doc, if_match=doc["_etag"])
+    await clients.get_async_blob_client("invoice", "1-invoice.pdf").delete_blob()
+    await clients.get_async_openai_client().chat.completions.create(model="gpt-4", messages=[])
+
+
+async def run(iterations, cold, blobs):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        if cold:
+            await clients.close_async_clients()
+        await invocation(blobs)
+    return iterations / (time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--iterations", type=int, default=50)
+    parser.add_argument("--connect-latency", type=float, default=0.050, help="seconds per new connection")
+    parser.add_argument("--request-latency", type=float, default=0.002, help="seconds per request")
+    args = parser.parse_args()
+
+    blobs = install_fakes(args.connect_latency, args.request_latency)
+    cold = asyncio.run(run(args.iterations, True, blobs))
+    warm = asyncio.run(run(args.iterations, False, blobs))
+    print(f"cold clients: {cold:8.1f} invocations/sec")
+    print(f"warm clients: {warm:8.1f} invocations/sec ({warm / cold:.1f}x)")
@@ -0,0 +1,48 @@
+import os
+import sys
+import time
+import asyncio
+import logging
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "functions"))
+
+import cache
+import comparison
+from fakes import FakeAsyncOpenAI
+
+# Wall clock time to compare one change feed batch against a fake Azure Open AI endpoint with
+# injected latency and throttling, serially (concurrency 1) and with bounded parallelism, then the
+# same batch again once the comparison cache has seen it.
+
+
+def run(batch_size, concurrency, latency, throttle_rate, comparison_cache=None):
+    client = FakeAsyncOpenAI(request_latency=latency, throttle_rate=throttle_rate, retry_after=latency)
+    pairs = [({"content": "Invoice " + str(i)}, {"content": "Receipt " + str(i)}) for i in range(batch_size)]
+    start = time.perf_counter()
+    results = asyncio.run(comparison.compare_all(client, pairs, concurrency=concurrency, comparison_cache=comparison_cache))
+    elapsed = time.perf_counter() - start
+    failed = sum(isinstance(result, Exception) for result in results)
+    return elapsed, client.requests, client.throttled, failed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch-size", type=int, default=40)
+    parser.add_argument("--latency", type=float, default=0.25, help="seconds per chat completion")
+    parser.add_argument("--throttle-rate", type=float, default=0.1, help="fraction of requests answered with a 429")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 8, 16])
+    args = parser.parse_args()
+
+    # Throttling is expected here, keep the retry warnings out of the report
+    logging.disable(logging.WARNING)
+
+    print(f"batch of {args.batch_size} documents, {args.latency * 1000:.0f}ms per request, {args.throttle_rate:.0%} throttled")
+    for concurrency in args.concurrency:
+        elapsed, requests, throttled, failed = run(args.batch_size, concurrency, args.latency, args.throttle_rate)
+        print(f"concurrency {concurrency:3}: {elapsed:6.2f}s  {args.batch_size / elapsed:6.1f} docs/sec  requests={requests} throttled={throttled} failed={failed}")
+
+    comparison_cache = cache.ComparisonCache()
+    run(args.batch_size, max(args.concurrency), args.latency, args.throttle_rate, comparison_cache)
+    elapsed, requests, throttled, failed = run(args.batch_size, max(args.concurrency), args.latency, args.throttle_rate, comparison_cache)
+    print(f"cached batch   : {elapsed:6.2f}s  {args.batch_size / elapsed:6.1f} docs/sec  requests={requests} {comparison_cache.stats()}")
@@ -0,0 +1,69 @@
+import os
+import sys
+import time
+import asyncio
+import logging
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "functions"))
+
+import clients
+import pipeline
+from fakes import FakeAsyncCosmosClient
+
+# Contention on one application document: N writers per application id each save their own field
+# at the same time, against a Cosmos stand-in with etag semantics and request latency.
+#   read-replace - the previous read_item / replace_item(if_match) with one blind retry
+#   patch        - pipeline.save_to_application(), a patch of the writer's own path with bounded retries
+
+
+async def read_replace(container, application_number, field, data):
+    doc = await container.read_item(item=application_number, partition_key=application_number)
+    item_etag = doc["_etag"]
+    doc[field] = data
+    try:
+        await container.replace_item(doc, doc, if_match=item_etag)
+    except:
+        doc = await container.read_item(item=application_number, partition_key=application_number)
+        item_etag = doc["_etag"]
+        doc[field] = data
+        await container.replace_item(doc, doc, if_match=item_etag)
+
+
+async def run(mode, applications, writers, latency, content_size):
+    items = {str(a): {"id": str(a), "_etag": "0", "content": "x" * content_size} for a in range(applications)}
+    cosmos = FakeAsyncCosmosClient(items, request_latency=latency)
+    clients.register_factory("cosmos_async", lambda conn: cosmos)
+    container = clients.get_async_docs_container()
+
+    async def write(application_number, field):
+        data = {"status": "processed", "value": field}
+        if mode == "patch":
+            await pipeline.save_to_application(application_number, field, data)
+        else:
+            await read_replace(container, application_number, field, data)
+
+    start = time.perf_counter()
+    results = await asyncio.gather(*(write(str(a), "field_" + str(w)) for a in range(applications) for w in range(writers)), return_exceptions=True)
+    elapsed = time.perf_counter() - start
+
+    failed = sum(isinstance(result, Exception) for result in results)
+    saved = sum(1 for a in range(applications) for w in range(writers) if "field_" + str(w) in items[str(a)])
+    lost = applications * writers - failed - saved
+    return elapsed, failed, lost, container._items.transferred
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--applications", type=int, default=50)
+    parser.add_argument("--writers", type=int, nargs="+", default=[2, 4, 8])
+    parser.add_argument("--latency", type=float, default=0.01, help="seconds per Cosmos request")
+    parser.add_argument("--content-size", type=int, default=20000, help="bytes of OCR content already in each document")
+    args = parser.parse_args()
+    logging.disable(logging.WARNING)
+
+    for writers in args.writers:
+        for mode in ("read-replace", "patch"):
+            elapsed, failed, lost, transferred = asyncio.run(run(mode, args.applications, writers, args.latency, args.content_size))
+            total = args.applications * writers
+            print(f"{writers} writers/app  {mode:12}  {elapsed:5.2f}s  failed={failed:4}/{total}  lost updates={lost:4}  transferred={transferred / 1024 / 1024:7.2f} MB")
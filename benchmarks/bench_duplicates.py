@@ -0,0 +1,182 @@
+import os
+import sys
+import time
+import random
+import asyncio
+import argparse
+import statistics
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "functions"))
+
+import clients
+import duplicates
+import extraction
+from fakes import FakeAsyncCosmosClient, load_analyze_result, fixture_names
+
+# Cross application duplicate detection:
+#   lookup    - time to check a new receipt against an in-memory index of --documents receipts,
+#               against scanning every stored signature, which is what finding a reused receipt
+#               costs without an index
+#   cosmos    - the same check against the Cosmos DB backend on the in-process stand-in, with
+#               --cosmos-latency per request: latency and requests per check
+#   stall     - the longest the event loop is held up while a --words word document is checked, the
+#               signature is computed on a worker thread
+#   detection - the fixtures flagged as duplicates of each other, and the share of noisy copies of
+#               each fixture (words dropped or misread, like a rescan or another photo) found from
+#               their OCR text alone, without the extracted fields. Run on the Cosmos DB backend, so
+#               the signatures go through the JSON numbers Cosmos DB stores.
+# The indexed receipts are random signatures, they stand in for distinct documents because random
+# signatures do not share LSH bands. The receipts looked up are made of random words of a fixture.
+
+NOISE_LEVELS = [0.0, 0.02, 0.05, 0.1, 0.2]
+
+
+def _noisy(content, rate, rng):
+    words = content.split()
+    noisy = []
+    for word in words:
+        roll = rng.random()
+        if roll < rate / 2:
+            continue
+        noisy.append(word[::-1] if roll < rate else word)
+    return " ".join(noisy)
+
+
+def _random_signature(rng):
+    return [rng.getrandbits(32) for _ in range(duplicates.NUM_PERM)]
+
+
+def build_index(documents, rng):
+    backend = duplicates.MemoryIndexBackend()
+    for idx in range(documents):
+        application = "bg%d" % idx
+        for band, value in enumerate(duplicates.bands(_random_signature(rng))):
+            backend.items["receipt-b%d-%s" % (band, value)] = {"applications": [application]}
+    return duplicates.DuplicateIndex(backend)
+
+
+def new_receipts(data, count, rng):
+    words = data["content"].split()
+    return [dict(data, content=" ".join(rng.choice(words) for _ in words), total=round(rng.uniform(1, 1000), 2)) for _ in range(count)]
+
+
+async def lookups(index, receipts):
+    timings = []
+    for idx, data in enumerate(receipts):
+        start = time.perf_counter()
+        await index.check("receipt", "prebuilt-receipt", "new%d" % idx, data)
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+
+def cosmos_index(items=None, latency=0.0):
+    # Index on the Cosmos DB backend of a fresh in-process stand-in
+    cosmos = FakeAsyncCosmosClient(items, request_latency=latency)
+    clients.register_factory("cosmos_async", lambda connection_string: cosmos)
+    os.environ.setdefault("cosmosdb_config", "AccountEndpoint=https://bench.documents.azure.com:443/;AccountKey=a2V5;")
+    return duplicates.DuplicateIndex(duplicates.CosmosIndexBackend("fingerprints")), cosmos
+
+
+async def cosmos_lookups(documents, receipts, latency, rng):
+    items = {}
+    for idx in range(documents):
+        for band, value in enumerate(duplicates.bands(_random_signature(rng))):
+            items["receipt-b%d-%s" % (band, value)] = {"id": "receipt-b%d-%s" % (band, value), "applications": ["bg%d" % idx]}
+    index, cosmos = cosmos_index(items, latency)
+    requests = cosmos.requests
+    timings = await lookups(index, receipts)
+    return timings, (cosmos.requests - requests) / len(receipts)
+
+
+async def stall(data, words, rng):
+    # Longest gap between the ticks of a 1 ms timer while a long document is checked
+    vocabulary = data["content"].split()
+    document = dict(data, content=" ".join(rng.choice(vocabulary) + str(rng.randrange(1000)) for _ in range(words)))
+    gaps, running = [], True
+
+    async def ticker():
+        last = time.perf_counter()
+        while running:
+            await asyncio.sleep(0.001)
+            now = time.perf_counter()
+            gaps.append(now - last)
+            last = now
+
+    task = asyncio.create_task(ticker())
+    start = time.perf_counter()
+    await duplicates.DuplicateIndex().check("receipt", "prebuilt-receipt", "long", document)
+    elapsed = time.perf_counter() - start
+    running = False
+    await task
+    return elapsed, max(gaps)
+
+
+def scan(signatures, values):
+    return [other for other in signatures if duplicates.similarity(values, other) >= duplicates.SIMILARITY_THRESHOLD]
+
+
+async def detection(variants, seed):
+    rng = random.Random(seed)
+    fixtures = {name: (model_id, extraction.extract(model_id, load_analyze_result(name))) for model_id in extraction.SCHEMAS for name in fixture_names(model_id)}
+    index, _ = cosmos_index()
+    for name, (model_id, data) in fixtures.items():
+        for match in await index.check(model_id, model_id, name, data):
+            print("%s is a duplicate of %s: similarity %.2f, same extracted fields %s" % (name, match["application"], match["similarity"], match["exact"]))
+
+    print()
+    print("%-16s %s" % ("fixture", " ".join("%9s" % ("%d%% noise" % (rate * 100)) for rate in NOISE_LEVELS)))
+    for name, (model_id, data) in fixtures.items():
+        found = []
+        for rate in NOISE_LEVELS:
+            index, _ = cosmos_index()
+            await index.check(model_id, model_id, "original", data)
+            hits = 0
+            for idx in range(variants):
+                copy = {"content": _noisy(data["content"], rate, rng)}
+                matches = await index.check(model_id, model_id, "copy%d" % idx, copy)
+                hits += any(match["application"] == "original" for match in matches)
+            found.append(hits / variants)
+        print("%-16s %s" % (name, " ".join("%8.0f%%" % (100 * share) for share in found)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--documents", type=int, default=50000, help="receipts in the index")
+    parser.add_argument("--lookups", type=int, default=200)
+    parser.add_argument("--variants", type=int, default=50, help="noisy copies of each fixture per noise level")
+    parser.add_argument("--cosmos-latency", type=float, default=0.005, help="seconds per Cosmos DB request")
+    parser.add_argument("--words", type=int, default=20000, help="words of the long document for the stall measurement")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    data = extraction.extract("prebuilt-receipt", load_analyze_result(fixture_names("prebuilt-receipt")[0]))
+
+    start = time.perf_counter()
+    for _ in range(args.lookups):
+        values = duplicates.signature(data["content"])
+    print("signature of a %d character receipt: %.3f ms" % (len(data["content"]), (time.perf_counter() - start) * 1000 / args.lookups))
+
+    start = time.perf_counter()
+    index = build_index(args.documents, rng)
+    print("indexed %d receipts in %.1fs" % (args.documents, time.perf_counter() - start))
+    timings = asyncio.run(lookups(index, new_receipts(data, args.lookups, rng)))
+    timings.sort()
+    print("index lookup: p50 %.3f ms  p99 %.3f ms (signature included)" % (statistics.median(timings), timings[int(len(timings) * 0.99) - 1]))
+
+    signatures = [_random_signature(rng) for _ in range(min(args.documents, 10000))]
+    start = time.perf_counter()
+    scan(signatures, values)
+    elapsed = (time.perf_counter() - start) * 1000 * args.documents / len(signatures)
+    print("full scan of %d signatures: %.1f ms" % (args.documents, elapsed))
+
+    timings, requests = asyncio.run(cosmos_lookups(min(args.documents, 5000), new_receipts(data, min(args.lookups, 50), rng), args.cosmos_latency, rng))
+    timings.sort()
+    print("Cosmos DB backend at %.0f ms per request: p50 %.1f ms  p99 %.1f ms, %.0f requests per check" % (
+        args.cosmos_latency * 1000, statistics.median(timings), timings[int(len(timings) * 0.99) - 1], requests))
+
+    elapsed, gap = asyncio.run(stall(data, args.words, rng))
+    print("check of a %d word document: %.0f ms, longest event loop stall %.1f ms" % (args.words, elapsed * 1000, gap * 1000))
+
+    print()
+    asyncio.run(detection(args.variants, args.seed))
@@ -0,0 +1,165 @@
+import os
+import sys
+import math
+import time
+import random
+import asyncio
+import logging
+import argparse
+import resource
+import azure.functions as func
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "functions"))
+
+import cache
+import clients
+import telemetry
+import idempotency
+from fakes import (FakeAsyncDocumentAnalysisClient, FakeAsyncCosmosClient, FakeAsyncBlobServiceClient, FakeAsyncOpenAI,
+                   FakeContext, FakeInputStream, load_analyze_result, user_function)
+
+# End to end run of the invoice, receipt and fraud functions against the in-process stand-ins for
+# Document Intelligence, Cosmos DB, Blob Storage and Azure Open AI, with injected latency and errors.
+# Every application gets one of the files in sample-data as its invoice and receipt, and Document
+# Intelligence replays the recorded AnalyzeResult of that file. Reports throughput per function,
+# p50/p95/p99 latency per stage from the functions' own telemetry, the retry, etag conflict and
+# token counters and the peak RSS of the process, e.g. to compare a change against the main branch
+# before it is deployed.
+
+SAMPLE_DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "sample-data")
+INVOICES = [("sampleinvoice1", "sampleinvoice1.pdf"), ("sampleinvoice2", "sampleinvoice2.pdf")]
+RECEIPTS = [("samplereciept1", "samplereciept1.png"), ("samplereciept2", "samplereciept2.pdf")]
+
+def percentile(values, p):
+    # Nearest rank percentile
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+
+def _read(file_name):
+    with open(os.path.join(SAMPLE_DATA, file_name), "rb") as f:
+        return f.read()
+
+
+def setup(applications, args):
+    os.environ.setdefault("mfdocintell_STORAGE", "DefaultEndpointsProtocol=https;AccountName=bench;AccountKey=a2V5;EndpointSuffix=core.windows.net")
+    # Caches that keep nothing, so every application pays for its analysis and comparison
+    cache.set_analysis_cache(cache.AnalysisCache(maxsize=0))
+    cache.set_comparison_cache(cache.ComparisonCache(maxsize=0))
+    idempotency.set_run_store(idempotency.RunStore())
+
+    # Mix the sample files so the pre-match sees matches, mismatches and ambiguous pairs
+    rng = random.Random(args.seed)
+    fixtures, blobs, uploads = {}, {}, []
+    for number in range(applications):
+        for field, samples in (("invoice", INVOICES), ("receipt", RECEIPTS)):
+            fixture, file_name = rng.choice(samples)
+            blob_name = str(number) + "-" + field + os.path.splitext(file_name)[1]
+            # Distinct bytes per application, as the analysis cache keys on the content
+            data = _read(file_name) + b"\n%" + str(number).encode()
+            fixtures[blob_name] = fixture
+            blobs[(field, blob_name)] = data
+            uploads.append((field, blob_name, data))
+
+    recorded = {fixture: load_analyze_result(fixture) for fixture, _ in INVOICES + RECEIPTS}
+    # With receipt_preprocessing=true the photos are sent as bytes, samplereciept1 is the only photo
+    replay = lambda document: recorded["samplereciept1"] if isinstance(document, bytes) else recorded[fixtures[document.rsplit("/", 1)[1]]]
+    items = {str(number): {"id": str(number), "_etag": "0"} for number in range(applications)}
+    services = {
+        "docintell": FakeAsyncDocumentAnalysisClient({"prebuilt-invoice": replay, "prebuilt-receipt": replay}, request_latency=args.latency,
+                                                     analysis_latency=args.analysis_latency, error_rate=args.error_rate, seed=args.seed),
+        "cosmos": FakeAsyncCosmosClient(items, request_latency=args.latency, error_rate=args.error_rate, seed=args.seed),
+        "blob": FakeAsyncBlobServiceClient(blobs, request_latency=args.latency, error_rate=args.error_rate, seed=args.seed),
+        "openai": FakeAsyncOpenAI(request_latency=args.openai_latency, throttle_rate=args.throttle_rate, retry_after=args.openai_latency, seed=args.seed),
+    }
+    clients.register_factory("docintell_async", lambda endpoint, key: services["docintell"])
+    clients.register_factory("cosmos_async", lambda connection_string: services["cosmos"])
+    clients.register_factory("blob_async", lambda connection_string: services["blob"])
+    clients.register_factory("openai_async", lambda api_key, endpoint: services["openai"])
+    return uploads, items, services
+
+
+async def _invoke(coroutine):
+    try:
+        await coroutine
+        return None
+    except Exception as error:
+        return error
+
+
+async def run(uploads, items, args):
+    functions = {"invoice": user_function("invoice"), "receipt": user_function("receipt")}
+    # The Functions host runs a bounded number of blob triggered invocations at once
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def trigger(field, blob_name, data):
+        async with semaphore:
+            return await _invoke(functions[field](FakeInputStream(field + "/" + blob_name, data)))
+
+    start = time.perf_counter()
+    errors = await asyncio.gather(*(trigger(*upload) for upload in uploads))
+    blob_elapsed = time.perf_counter() - start
+
+    # The sample files pair up into clear matches and mismatches only. Lower the receipt total
+    # confidence of some applications so the pre-match hands them to Azure Open AI.
+    rng = random.Random(args.seed)
+    for item in items.values():
+        if item.get("receipt") and rng.random() < args.ambiguous_rate:
+            item["receipt"]["total_confidence"] = 0.5
+
+    # The change feed delivers the application documents to fraud() in batches, one batch at a time
+    fraud = user_function("fraud")
+    documents = [func.Document.from_dict(item) for item in items.values()]
+    start = time.perf_counter()
+    for i in range(0, len(documents), args.feed_batch):
+        errors.append(await _invoke(fraud(func.DocumentList(documents[i:i + args.feed_batch]), FakeContext())))
+    fraud_elapsed = time.perf_counter() - start
+    compared = sum(1 for item in items.values() if item.get("comparison"))
+    return errors, blob_elapsed, fraud_elapsed, compared
+
+
+def report(exporter):
+    print(f"{'function':9} {'stage':20} {'calls':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    # Stages in the order they first finished, grouped by function
+    stages = {}
+    for _, tags in exporter.histograms.get("stage_duration_ms", []):
+        stages.setdefault((tags["function"], tags["stage"]), None)
+    for function, stage in sorted(stages, key=lambda key: ["invoice", "receipt", "fraud"].index(key[0])):
+        values = exporter.values("stage_duration_ms", function=function, stage=stage)
+        print(f"{function:9} {stage:20} {len(values):6} " + " ".join(f"{percentile(values, p):9.1f}" for p in (50, 95, 99)))
+    print(f"retries: cosmos={exporter.total('retries', service='cosmos')} blob={exporter.total('retries', service='blob')} "
+          f"openai={exporter.total('retries', service='openai')}  etag conflicts: {exporter.total('etag_conflicts')}  "
+          f"LLM tokens: prompt={exporter.total('llm_tokens', kind='prompt')} completion={exporter.total('llm_tokens', kind='completion')}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--applications", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=32, help="blob triggered invocations in flight at once")
+    parser.add_argument("--feed-batch", type=int, default=50, help="documents per change feed batch")
+    parser.add_argument("--latency", type=float, default=0.02, help="seconds per Document Intelligence, Cosmos DB and Blob Storage request")
+    parser.add_argument("--analysis-latency", type=float, default=0.5, help="seconds per Document Intelligence analysis")
+    parser.add_argument("--openai-latency", type=float, default=0.5, help="seconds per chat completion")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of Document Intelligence, Cosmos DB and Blob Storage requests that fail")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="fraction of Azure Open AI requests answered with a 429")
+    parser.add_argument("--ambiguous-rate", type=float, default=0.3, help="fraction of applications the pre-match cannot settle")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    # Injected errors and retries are expected, keep their logs out of the report
+    logging.disable(logging.ERROR)
+
+    exporter = telemetry.LocalExporter()
+    telemetry.add_exporter(exporter)
+    uploads, items, services = setup(args.applications, args)
+    errors, blob_elapsed, fraud_elapsed, compared = asyncio.run(run(uploads, items, args))
+
+    print(f"{args.applications} applications, {args.latency * 1000:.0f}ms per request, {args.analysis_latency * 1000:.0f}ms per analysis, "
+          f"{args.openai_latency * 1000:.0f}ms per chat completion, {args.error_rate:.0%} errors, {args.throttle_rate:.0%} throttled")
+    print(f"invoice + receipt: {len(uploads) / blob_elapsed:7.1f} docs/sec  ({len(uploads)} documents in {blob_elapsed:.2f}s)")
+    print(f"fraud            : {args.applications / fraud_elapsed:7.1f} applications/sec  ({compared} compared in {fraud_elapsed:.2f}s)")
+    injected = sum(services[name].errors for name in ("docintell", "cosmos", "blob"))
+    print(f"failed invocations: {sum(error is not None for error in errors)}  injected errors: {injected}  throttled: {services['openai'].throttled}")
+    report(exporter)
+    # ru_maxrss is in kilobytes on Linux
+    print(f"peak RSS: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MB")
@@ -0,0 +1,31 @@
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "functions"))
+
+import extraction
+from fakes import load_analyze_result, fixture_names
+
+# Extraction cost per page of the schema driven extractor over the recorded AnalyzeResult fixtures.
+
+
+def bench(model_id, name, iterations):
+    result = load_analyze_result(name)
+    start = time.perf_counter()
+    for _ in range(iterations):
+        extraction.extract(model_id, result)
+    elapsed = time.perf_counter() - start
+    return elapsed / iterations / max(len(result.pages), 1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--iterations", type=int, default=20000)
+    args = parser.parse_args()
+
+    for model_id in extraction.SCHEMAS:
+        for name in fixture_names(model_id):
+            per_page = bench(model_id, name, args.iterations)
+            print(f"{model_id:18} {name:16} {per_page * 1e6:8.2f} us/page")
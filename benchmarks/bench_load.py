@@ -0,0 +1,78 @@
+import os
+import sys
+import time
+import asyncio
+import logging
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "functions"))
+
+import cache
+import clients
+from fakes import (FakeAsyncDocumentAnalysisClient, FakeAsyncCosmosClient, FakeAsyncBlobServiceClient,
+                   FakeInputStream, load_analyze_result, user_function)
+
+# Load test of one worker process: how many blobs are in flight at once and how many complete per
+# second when a burst of invoices lands.
+#   before - the previous synchronous pipeline, every stage blocking a thread of the worker's
+#            thread pool (PYTHON_THREADPOOL_THREAD_COUNT threads)
+#   after  - the async invoice() function from function_app.py on one event loop
+
+
+def before(blobs, threads, latency, analysis_latency):
+    in_flight = peak = 0
+    lock = threading.Lock()
+
+    def invocation(_):
+        nonlocal in_flight, peak
+        with lock:
+            in_flight += 1
+            peak = max(peak, in_flight)
+        time.sleep(latency) # submit the analysis
+        time.sleep(analysis_latency) # poller.result()
+        time.sleep(2 * latency) # Cosmos read and replace
+        time.sleep(2 * latency) # write the output binding, delete the blob
+        with lock:
+            in_flight -= 1
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(threads) as pool:
+        list(pool.map(invocation, range(blobs)))
+    return time.perf_counter() - start, peak
+
+
+def after(blobs, latency, analysis_latency):
+    os.environ.setdefault("mfdocintell_STORAGE", "DefaultEndpointsProtocol=https;AccountName=bench;AccountKey=a2V5;EndpointSuffix=core.windows.net")
+    cache.set_analysis_cache(cache.AnalysisCache())
+    items = {str(i): {"id": str(i), "_etag": "0"} for i in range(blobs)}
+    blob_store = {("invoice", str(i) + "-invoice.pdf"): b"" for i in range(blobs)}
+    docintell = FakeAsyncDocumentAnalysisClient({"prebuilt-invoice": load_analyze_result("sampleinvoice1")}, request_latency=latency, analysis_latency=analysis_latency)
+    clients.register_factory("docintell_async", lambda endpoint, key: docintell)
+    clients.register_factory("cosmos_async", lambda conn: FakeAsyncCosmosClient(items, request_latency=latency))
+    clients.register_factory("blob_async", lambda conn: FakeAsyncBlobServiceClient(blob_store, request_latency=latency))
+    invoice = user_function("invoice")
+
+    async def burst():
+        # Each blob has distinct content so the analysis cache cannot short circuit the load
+        await asyncio.gather(*(invoice(FakeInputStream("invoice/" + str(i) + "-invoice.pdf", str(i).encode())) for i in range(blobs)))
+
+    start = time.perf_counter()
+    asyncio.run(burst())
+    return time.perf_counter() - start, docintell.peak_in_flight
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--blobs", type=int, default=50)
+    parser.add_argument("--threads", type=int, default=1, help="PYTHON_THREADPOOL_THREAD_COUNT of the worker")
+    parser.add_argument("--latency", type=float, default=0.02, help="seconds per Cosmos, Blob or submit request")
+    parser.add_argument("--analysis-latency", type=float, default=1.0, help="seconds per Document Intelligence analysis")
+    args = parser.parse_args()
+    logging.disable(logging.WARNING)
+
+    elapsed, peak = before(args.blobs, args.threads, args.latency, args.analysis_latency)
+    print(f"before: {args.blobs} blobs in {elapsed:6.2f}s  {args.blobs / elapsed:6.2f} blobs/sec  peak concurrent blobs per worker={peak}")
+    elapsed, peak = after(args.blobs, args.latency, args.analysis_latency)
+    print(f"after : {args.blobs} blobs in {elapsed:6.2f}s  {args.blobs / elapsed:6.2f} blobs/sec  peak concurrent blobs per worker={peak}")
@@ -0,0 +1,69 @@
+import os
+import sys
+import time
+import asyncio
+import logging
+import argparse
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "functions"))
+
+import clients
+import pipeline
+from fakes import FakeAsyncBlobServiceClient, FakeInputStream, FakeOut
+
+# Peak Python memory per document while moving a large scanned PDF from invoice/ to processed/.
+#   output binding - the previous outputblob.set(inblobtrig.read()), which hands a second full copy
+#                    of the file back to the Functions host
+#   server copy    - pipeline.move_blob() with a same account server side copy
+#   streaming      - pipeline.move_blob() when the server side copy fails and the chunked fallback runs
+
+
+def synthetic_pdf(size):
+    header = b"%PDF-1.7\n% synthetic scanned invoice\n"
+    return header + os.urandom(size - len(header) - 6) + b"\n%%EOF"
+
+
+def measure(stage):
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    start = time.perf_counter()
+    stage()
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak, elapsed
+
+
+def output_binding(data):
+    outputblob = FakeOut()
+    trigger = FakeInputStream("invoice/1-invoice.pdf", data)
+    # The worker serialises the output binding value into its own message to the host
+    return lambda: outputblob.set(bytes(bytearray(trigger.read())))
+
+
+def move(data, server_copy, chunk_size):
+    service = FakeAsyncBlobServiceClient({("invoice", "1-invoice.pdf"): data}, server_copy=server_copy, retain_uploads=False, chunk_size=chunk_size)
+    clients.register_factory("blob_async", lambda conn: service)
+    return lambda: asyncio.run(pipeline.move_blob("invoice", "1-invoice.pdf"))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 50, 200], help="document sizes in MB")
+    parser.add_argument("--chunk-size", type=int, default=4, help="download chunk size in MB for the streaming fallback")
+    args = parser.parse_args()
+    logging.disable(logging.WARNING)
+    os.environ.setdefault("mfdocintell_STORAGE", "DefaultEndpointsProtocol=https;AccountName=bench;AccountKey=a2V5;EndpointSuffix=core.windows.net")
+
+    for size in args.sizes:
+        data = synthetic_pdf(size * 1024 * 1024)
+        chunk_size = args.chunk_size * 1024 * 1024
+        for label, stage in [
+            ("output binding", lambda: output_binding(data)),
+            ("server copy", lambda: move(data, True, chunk_size)),
+            ("streaming", lambda: move(data, False, chunk_size)),
+        ]:
+            peak, elapsed = measure(stage())
+            print(f"{size:5} MB  {label:15} peak {peak / 1024 / 1024:8.2f} MB  {elapsed * 1000:8.1f} ms")
+        del data
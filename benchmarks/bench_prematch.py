@@ -0,0 +1,97 @@
+import os
+import sys
+import copy
+import time
+import random
+import argparse
+import datetime
+from collections import Counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "functions"))
+
+import extraction
+import prematch
+from fakes import load_analyze_result
+
+# Azure Open AI skip rate and accuracy of the rules based pre-match over a corpus built from the
+# invoice/receipt pairs in the recorded fixtures that belong together, with seeded variations that
+# mimic OCR noise, rounding, renamed merchants, missing fields and tampered totals, and genuine
+# receipts whose merchant name differs from the vendor on the invoice (a trading name, a card
+# processor prefix, a store number). Each variation
+# is labelled with whether the documents should still match, so a verdict that contradicts the
+# label is counted as a false match or a false mismatch. Ambiguous verdicts go to Azure Open AI and
+# are neither.
+
+# (invoice, receipt) fixtures of the same purchase: both invoices are for the Contoso Ltd. solar
+# panels on samplereciept2
+PAIRS = [("sampleinvoice1", "samplereciept2"), ("sampleinvoice2", "samplereciept2")]
+# A receipt for another purchase, paired with the invoices above for the "unrelated" variation
+OTHER_RECEIPT = "samplereciept1"
+
+
+def _set_total(receipt, delta):
+    receipt["total"] = round(receipt["total"] + delta, 2)
+
+
+def _dated(invoice, receipt, days):
+    receipt.update(transaction_date=str(prematch.parse_date(invoice["invoice_date"]) + datetime.timedelta(days=days)), transaction_date_confidence=0.98)
+
+
+def _variations(other):
+    # name: (expected verdict, change to the invoice and receipt of a pair that belong together)
+    return {
+        "unchanged": (prematch.MATCH, lambda invoice, receipt, rng: None),
+        "rounding": (prematch.MATCH, lambda invoice, receipt, rng: _set_total(receipt, 0.01)),
+        "receipt_dated": (prematch.MATCH, lambda invoice, receipt, rng: _dated(invoice, receipt, rng.randint(0, 14))),
+        "low_confidence": (prematch.MATCH, lambda invoice, receipt, rng: receipt.update(total_confidence=rng.uniform(0.3, 0.7))),
+        "merchant_suffix": (prematch.MATCH, lambda invoice, receipt, rng: receipt.update(merchant_name=str(receipt.get("merchant_name")) + " Inc")),
+        "trading_name": (prematch.MATCH, lambda invoice, receipt, rng: receipt.update(merchant_name=rng.choice(["Contoso Solar Supplies", "Contoso Energy Store", "Solar Panels Direct"]))),
+        "processor_prefix": (prematch.MATCH, lambda invoice, receipt, rng: receipt.update(merchant_name=rng.choice(["SQ *", "PAYPAL *", "SP * "]) + str(receipt.get("merchant_name")).upper())),
+        "store_number": (prematch.MATCH, lambda invoice, receipt, rng: receipt.update(merchant_name=str(receipt.get("merchant_name")) + " #%04d Redmond WA" % rng.randrange(10000))),
+        "merchant_ocr": (prematch.MATCH, lambda invoice, receipt, rng: receipt.update(merchant_name=str(receipt.get("merchant_name")).replace("o", "0", 1))),
+        "missing_total": (prematch.MATCH, lambda invoice, receipt, rng: receipt.pop("total", None)),
+        "missing_items": (prematch.MATCH, lambda invoice, receipt, rng: receipt.update(items={})),
+        "tampered_total": (prematch.MISMATCH, lambda invoice, receipt, rng: _set_total(receipt, rng.choice([-1, 1]) * rng.uniform(5, 500))),
+        "other_merchant": (prematch.MISMATCH, lambda invoice, receipt, rng: receipt.update(merchant_name=rng.choice(["Fabrikam", "Northwind Traders", "Tailspin Toys"]))),
+        "unrelated": (prematch.MISMATCH, lambda invoice, receipt, rng: (receipt.clear(), receipt.update(copy.deepcopy(other)))),
+    }
+
+
+def corpus(size, seed):
+    # Yields (variation, expected verdict, invoice, receipt)
+    rng = random.Random(seed)
+    pairs = [(extraction.extract("prebuilt-invoice", load_analyze_result(invoice)), extraction.extract("prebuilt-receipt", load_analyze_result(receipt)))
+             for invoice, receipt in PAIRS]
+    variations = _variations(extraction.extract("prebuilt-receipt", load_analyze_result(OTHER_RECEIPT)))
+    names = list(variations)
+    for _ in range(size):
+        invoice, receipt = copy.deepcopy(rng.choice(pairs))
+        name = rng.choice(names)
+        expected, change = variations[name]
+        change(invoice, receipt, rng)
+        yield name, expected, invoice, receipt
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    pairs = list(corpus(args.size, args.seed))
+    verdicts = Counter()
+    by_variation = {}
+    start = time.perf_counter()
+    for name, expected, invoice, receipt in pairs:
+        verdict = prematch.prematch(invoice, receipt)["verdict"]
+        verdicts[(expected, verdict)] += 1
+        by_variation.setdefault((name, expected), Counter())[verdict] += 1
+    elapsed = time.perf_counter() - start
+
+    skipped = sum(count for (_, verdict), count in verdicts.items() if verdict != prematch.AMBIGUOUS)
+    false_matches = verdicts[(prematch.MISMATCH, prematch.MATCH)]
+    false_mismatches = verdicts[(prematch.MATCH, prematch.MISMATCH)]
+    print(f"{len(pairs)} pairs, {elapsed / len(pairs) * 1e6:.1f} us per pre-match")
+    print(f"LLM skip rate: {skipped / len(pairs):.1%}  false matches: {false_matches}  false mismatches: {false_mismatches}")
+    for (name, expected), counts in sorted(by_variation.items()):
+        print(f"  {name:16} expected {expected:9} " + "  ".join(f"{verdict}={counts[verdict]:4}" for verdict in (prematch.MATCH, prematch.MISMATCH, prematch.AMBIGUOUS)))
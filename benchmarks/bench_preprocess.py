@@ -0,0 +1,85 @@
+import io
+import os
+import sys
+import time
+import argparse
+
+FUNCTIONS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "functions")
+sys.path.insert(0, FUNCTIONS)
+
+import clients
+import extraction
+import imaging
+from PIL import Image
+
+# Receipt preprocessing: bytes sent to Document Intelligence, preprocessing time and upload time at
+# --bandwidth Mbit/s, for the sample receipt photo and copies of it in the other formats the intake
+# form allows, one of them stored sideways with an EXIF orientation like a phone photo.
+# With --live the original and the preprocessed receipt are also analysed by prebuilt-receipt with
+# the docintell_endpoint and docintell_key app settings, to compare the analysis time and how many
+# extracted fields agree.
+
+SAMPLE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "sample-data", "samplereciept1.png")
+EXIF_ORIENTATION = 0x0112
+ROTATED_90 = 6 # stored sideways, shown rotated 90 degrees clockwise
+
+
+def variants():
+    with open(SAMPLE, "rb") as f:
+        original = f.read()
+    image = Image.open(io.BytesIO(original)).convert("RGB")
+    yield "png", original
+    for name, format, options in [("jpeg", "JPEG", {"quality": 95}), ("bmp", "BMP", {}), ("tiff", "TIFF", {"compression": "tiff_lzw"})]:
+        output = io.BytesIO()
+        image.save(output, format, **options)
+        yield name, output.getvalue()
+    exif = Image.Exif()
+    exif[EXIF_ORIENTATION] = ROTATED_90
+    output = io.BytesIO()
+    image.transpose(Image.Transpose.ROTATE_90).save(output, "JPEG", quality=95, exif=exif)
+    yield "jpeg, sideways", output.getvalue()
+
+
+def _fields(data):
+    return {key: value for key, value in data.items() if key not in ("content", "content_fingerprint", "schema_version") and not key.endswith("_confidence")}
+
+
+def analyze(data):
+    start = time.perf_counter()
+    result = clients.get_document_analysis_client().begin_analyze_document("prebuilt-receipt", data).result()
+    return time.perf_counter() - start, _fields(extraction.extract("prebuilt-receipt", result))
+
+
+def live(original, prepared):
+    original_time, original_fields = analyze(original)
+    prepared_time, prepared_fields = analyze(prepared)
+    keys = set(original_fields) | set(prepared_fields)
+    agree = sum(original_fields.get(key) == prepared_fields.get(key) for key in keys)
+    print("    analysis %.2fs -> %.2fs, %d of %d fields agree%s" % (original_time, prepared_time, agree, len(keys),
+          "" if agree == len(keys) else ": " + ", ".join(sorted(key for key in keys if original_fields.get(key) != prepared_fields.get(key)))))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--max-side", type=int, default=imaging.DEFAULT_MAX_SIDE)
+    parser.add_argument("--bandwidth", type=float, default=20.0, help="upload Mbit/s to Document Intelligence")
+    parser.add_argument("--live", action="store_true", help="also analyse with the Document Intelligence resource in local.settings.json")
+    args = parser.parse_args()
+    if args.live:
+        sys.path.insert(0, os.path.join(FUNCTIONS, "..", "tools"))
+        from backfill import load_settings
+        load_settings(os.path.join(FUNCTIONS, "local.settings.json"))
+
+    print("%-16s %10s %10s %7s %12s %10s %10s" % ("receipt", "bytes", "prepared", "ratio", "size", "prep ms", "upload s"))
+    for name, data in variants():
+        start = time.perf_counter()
+        prepared = imaging.preprocess(data, args.max_side)
+        elapsed = (time.perf_counter() - start) * 1000
+        if prepared is None:
+            print("%-16s %10d %10s" % (name, len(data), "as is"))
+            continue
+        upload = lambda size: size * 8 / (args.bandwidth * 1e6)
+        print("%-16s %10d %10d %6.1fx %12s %10.1f %4.2f->%.2f" % (name, len(data), len(prepared[0]), len(data) / len(prepared[0]),
+              "%dx%d" % prepared[1]["size"], elapsed, upload(len(data)), upload(len(prepared[0]))))
+        if args.live:
+            live(data, prepared[0])
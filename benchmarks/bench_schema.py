@@ -0,0 +1,121 @@
+import os
+import sys
+import copy
+import json
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "functions"))
+
+import extraction
+from fakes import load_analyze_result, fixture_names
+
+# Size of the extracted data saved to Cosmos DB, schema version 1 against version 2, over the
+# recorded fixtures plus a long invoice made by repeating the line items of a fixture.
+# Version 1 is rebuilt here as it was saved: inline OCR text, "USD $12.5" amounts, "June 10, 2019"
+# dates and one "item_{idx}_{key}" and "item_{idx}_{key}_confidence" pair per line item value.
+# Request units are estimated from the item size, about 1 RU per KB for a point read and about 5 RU
+# per KB for a write with the default indexing policy, which indexes every distinct path.
+
+READ_RU_PER_KB = 1
+WRITE_RU_PER_KB = 5
+
+
+def _v1_value(convert, value):
+    if value is None:
+        return None
+    if convert is extraction._date:
+        return value.strftime("%B %d, %Y")
+    if convert is extraction._currency and hasattr(value, "amount"):
+        return str(value.code) + " $" + str(value.amount)
+    return convert(value)
+
+
+def _v1(model_id, result):
+    fields, item_fields = extraction.TABLES[model_id]
+    data = {"content": str(result.content)}
+    for document in result.documents:
+        for field_name, (key, convert) in fields.items():
+            field = document.fields.get(field_name)
+            if field:
+                data[key] = _v1_value(convert, field.value)
+                data[key + "_confidence"] = field.confidence
+        items = {}
+        item_list = document.fields.get("Items")
+        for idx, item in enumerate(item_list.value if item_list and item_list.value else []):
+            for field_name, (key, convert) in item_fields.items():
+                field = (item.value or {}).get(field_name)
+                if field:
+                    items["item_%d_%s" % (idx, key)] = _v1_value(convert, field.value)
+                    items["item_%d_%s_confidence" % (idx, key)] = field.confidence
+        data["items"] = items
+    return data
+
+
+def _v2(model_id, result):
+    # As saved by the functions: the OCR text is in blob storage and only its URL is kept
+    data = extraction.extract(model_id, result)
+    content = data.pop("content")
+    data["content_uri"] = "https://account.blob.core.windows.net/content/" + extraction.content_fingerprint(content) + ".txt"
+    data["content_length"] = len(content)
+    return data
+
+
+def _paths(value, prefix=""):
+    # Distinct index paths, arrays count as one path like the /items/[]/? paths of the indexing policy
+    if isinstance(value, dict):
+        return set().union(*[_paths(child, prefix + "/" + key) for key, child in value.items()]) if value else {prefix}
+    if isinstance(value, list):
+        return set().union(*[_paths(child, prefix + "/[]") for child in value]) if value else {prefix}
+    return {prefix}
+
+
+def _size(value):
+    return len(json.dumps(value, default=str).encode("utf-8"))
+
+
+def long_invoice(name, copies):
+    # The line items of the fixture repeated copies times
+    result = copy.deepcopy(load_analyze_result(name))
+    for document in result.documents:
+        items = document.fields.get("Items")
+        if items and items.value:
+            items.value = items.value * copies
+    return result
+
+
+def report(label, model_id, result):
+    v1, v2 = _v1(model_id, result), _v2(model_id, result)
+    # Version 1 has no item confidence, upgrade() uses the lowest confidence of the item values
+    upgraded = extraction.upgrade(model_id, v1)
+    upgraded.pop("content", None)
+    upgraded["items"].pop("confidence", None)
+    expected = {key: value for key, value in v2.items() if key not in ("content_uri", "content_length")}
+    expected["items"] = {key: value for key, value in v2["items"].items() if key != "confidence"}
+    same = "yes" if upgraded == expected else "NO"
+    size1, size2 = _size(v1), _size(v2)
+    print("%-28s %8d %8d %6.0f%% %7.1f %7.1f %7.1f %7.1f %6d %6d  %s" % (
+        label, size1, size2, 100 * (1 - size2 / size1),
+        READ_RU_PER_KB * size1 / 1024, READ_RU_PER_KB * size2 / 1024,
+        WRITE_RU_PER_KB * size1 / 1024, WRITE_RU_PER_KB * size2 / 1024,
+        len(_paths(v1)), len(_paths(v2)), same))
+    return size1, size2
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--items", type=int, default=200, help="line items of the long invoice")
+    args = parser.parse_args()
+
+    print("%-28s %8s %8s %7s %7s %7s %7s %7s %6s %6s  %s" % ("document", "v1 B", "v2 B", "saved", "read1", "read2", "write1", "write2", "paths1", "paths2", "upgrade"))
+    totals = [0, 0]
+    for model_id in extraction.SCHEMAS:
+        for name in fixture_names(model_id):
+            for idx, size in enumerate(report(name, model_id, load_analyze_result(name))):
+                totals[idx] += size
+
+    name = fixture_names("prebuilt-invoice")[0]
+    items = len(load_analyze_result(name).documents[0].fields["Items"].value)
+    copies = max(1, args.items // items)
+    report("%s x%d items" % (name, copies * items), "prebuilt-invoice", long_invoice(name, copies))
+
+    print("fixtures: %d bytes -> %d bytes (%.0f%% smaller)" % (totals[0], totals[1], 100 * (1 - totals[1] / totals[0])))
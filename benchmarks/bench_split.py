@@ -0,0 +1,120 @@
+import os
+import sys
+import copy
+import time
+import asyncio
+import logging
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "functions"))
+
+import cache
+import clients
+import extraction
+import pipeline
+from azure.ai.formrecognizer import AnalyzeResult
+from fakes import FakeAsyncDocumentAnalysisClient, load_analyze_result
+
+# Analysis time of a large invoice bundle as one call versus page ranges analysed at the same time.
+# The bundle is --invoices invoices of --pages pages each, built from the sampleinvoice1 fixture
+# with --items-per-page line items per page. The total, subtotal and amount due are on the last
+# page of each invoice, so invoices that straddle two page ranges have to be put back together.
+# The fake service takes --base-latency plus --page-latency per page for each analysis.
+
+TOTALS = ("SubTotal", "TotalTax", "InvoiceTotal", "AmountDue")
+
+
+class Bundle:
+    def __init__(self, invoices, pages, items_per_page):
+        self.invoices = invoices
+        self.pages = pages
+        self.items_per_page = items_per_page
+        self.template = load_analyze_result("sampleinvoice1")
+
+    @property
+    def page_count(self):
+        return self.invoices * self.pages
+
+    def pdf(self):
+        # Just enough of a PDF for pipeline.page_count()
+        return b"%PDF-1.7\n1 0 obj << /Type /Catalog /Pages 2 0 R >>\n2 0 obj << /Type /Pages /Count " + str(self.page_count).encode() + b" >>\n"
+
+    def _page_text(self, number):
+        invoice, page = divmod(number - 1, self.pages)
+        return "INVOICE INV-%d page %d of %d" % (invoice + 1, page + 1, self.pages)
+
+    def _document(self, invoice, first, last):
+        # The part of invoice (1 based) on pages first..last
+        start, end = (invoice - 1) * self.pages + 1, invoice * self.pages
+        document = copy.deepcopy(self.template.documents[0])
+        fields = document.fields
+        item = fields["Items"].value[0]
+        items = []
+        for page in range(max(first, start), min(last, end) + 1):
+            for idx in range(self.items_per_page):
+                line = copy.deepcopy(item)
+                line.value["Description"].value = "Item %d-%d-%d" % (invoice, page, idx)
+                items.append(line)
+        fields["Items"].value = items
+        if first > start:
+            # A continuation has no header, only line items and maybe the totals
+            document.fields = {name: field for name, field in fields.items() if name == "Items" or name in TOTALS}
+        else:
+            fields["InvoiceId"].value = "INV-%d" % invoice
+        if last < end:
+            document.fields = {name: field for name, field in document.fields.items() if name not in TOTALS}
+        return document
+
+    def analyze(self, document, pages=None):
+        first, last = (int(page) for page in pages.split("-")) if pages else (1, self.page_count)
+        page = self.template.pages[0]
+        result_pages = []
+        for number in range(first, last + 1):
+            result_pages.append(copy.copy(page))
+            result_pages[-1].page_number = number
+        invoices = range((first - 1) // self.pages + 1, (last - 1) // self.pages + 2)
+        return AnalyzeResult(
+            api_version=self.template.api_version,
+            model_id=self.template.model_id,
+            content="\n".join(self._page_text(number) for number in range(first, last + 1)),
+            pages=result_pages,
+            documents=[self._document(invoice, first, last) for invoice in invoices],
+        )
+
+
+async def _run(bundle, split):
+    data = bundle.pdf()
+    url = "https://bench/invoice/1-invoice.pdf"
+    start = time.perf_counter()
+    result = await (pipeline.analyze_document if split else pipeline.analyze)("prebuilt-invoice", url, data)
+    return time.perf_counter() - start, extraction.extract("prebuilt-invoice", result)
+
+
+def run(bundle, split, base_latency, page_latency):
+    fake = FakeAsyncDocumentAnalysisClient({"prebuilt-invoice": bundle.analyze}, analysis_latency=base_latency, page_latency=page_latency)
+    clients.register_factory("docintell_async", lambda endpoint, key: fake)
+    cache.set_analysis_cache(cache.AnalysisCache(None))
+    elapsed, data = asyncio.run(_run(bundle, split))
+    return elapsed, data, fake
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--invoices", type=int, default=8)
+    parser.add_argument("--pages", type=int, default=7, help="pages per invoice")
+    parser.add_argument("--items-per-page", type=int, default=5)
+    parser.add_argument("--base-latency", type=float, default=1.0, help="seconds per analysis")
+    parser.add_argument("--page-latency", type=float, default=0.1, help="seconds per page analysed")
+    args = parser.parse_args()
+    logging.disable(logging.INFO)
+
+    bundle = Bundle(args.invoices, args.pages, args.items_per_page)
+    print("%d pages, %d invoices, page ranges %s" % (bundle.page_count, bundle.invoices, ", ".join(pipeline.page_ranges(bundle.page_count))))
+    whole, whole_data, _ = run(bundle, False, args.base_latency, args.page_latency)
+    split, split_data, fake = run(bundle, True, args.base_latency, args.page_latency)
+    print("one analysis   : %6.2fs" % whole)
+    print("page ranges    : %6.2fs  (%d analyses, %d at the same time, %.1fx faster)" % (split, fake.analyses, fake.peak_in_flight, whole / split))
+
+    invoices = extraction.documents(split_data)
+    print("invoices       : %d, line items per invoice %s" % (len(invoices), sorted({len(invoice["items"]["confidence"]) for invoice in invoices})))
+    print("same as one analysis: %s" % ("yes" if split_data == whole_data else "NO"))
@@ -0,0 +1,477 @@
+import os
+import json
+import time
+import uuid
+import random
+import asyncio
+import threading
+from types import SimpleNamespace
+from openai import RateLimitError
+from azure.core.exceptions import ResourceNotFoundError, HttpResponseError
+from azure.cosmos.exceptions import CosmosAccessConditionFailedError, CosmosHttpResponseError, CosmosResourceExistsError, CosmosResourceNotFoundError
+import cache
+
+# In-process stand-ins for the Azure services used by the functions. Each fake mimics the slice of
+# the SDK surface function_app.py uses and sleeps to simulate network cost:
+#   connect_latency - paid once per client instance (TLS handshake, account metadata fetch)
+#   request_latency - paid on every request
+#   error_rate      - fraction of requests of the async fakes that fail with the service's transient error
+
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+
+def load_analyze_result(name):
+    # Recorded AnalyzeResult for one of the files in sample-data, e.g. "sampleinvoice1"
+    with open(os.path.join(FIXTURES, name + ".json"), "rb") as f:
+        return cache.load_result(f.read())
+
+
+def fixture_names(model_id=None):
+    names = sorted(os.path.splitext(name)[0] for name in os.listdir(FIXTURES) if name.endswith(".json"))
+    if model_id == "prebuilt-invoice":
+        return [name for name in names if "invoice" in name]
+    if model_id == "prebuilt-receipt":
+        return [name for name in names if "invoice" not in name]
+    return names
+
+
+class _Connection:
+    def __init__(self, connect_latency=0.0, request_latency=0.0):
+        self.connect_latency = connect_latency
+        self.request_latency = request_latency
+        self._connected = False
+
+    def request(self):
+        if not self._connected:
+            time.sleep(self.connect_latency)
+            self._connected = True
+        time.sleep(self.request_latency)
+
+
+def _json_number(text):
+    # Cosmos DB keeps numbers as IEEE-754 doubles, integers above 2^53 lose their low bits
+    value = int(text)
+    return value if abs(value) <= 1 << 53 else int(float(value))
+
+
+def _stored(body):
+    # What Cosmos DB gives back for a JSON body
+    return json.loads(json.dumps(body, default=str), parse_int=_json_number)
+
+
+class _Items:
+    # Document store with Cosmos DB etag semantics behind FakeAsyncContainer.
+    # Items are stored as JSON, so values that do not survive that come back changed.
+    # transferred counts the JSON bytes sent and received, a proxy for request units.
+    def __init__(self, items=None):
+        self.items = items if items is not None else {}
+        self.lock = threading.Lock()
+        self.transferred = 0
+
+    def _count(self, body):
+        self.transferred += len(json.dumps(body, default=str))
+
+    def _current(self, item_id):
+        if item_id not in self.items:
+            raise CosmosResourceNotFoundError(status_code=404, message="Entity with the specified id does not exist in the system.")
+        return self.items[item_id]
+
+    def _check(self, current, etag):
+        if etag is not None and current["_etag"] != etag:
+            raise CosmosAccessConditionFailedError(status_code=412, message="Operation cannot be performed because one of the specified precondition is not met.")
+
+    def upsert(self, body):
+        with self.lock:
+            item = _stored(dict(body, _etag=uuid.uuid4().hex))
+            self.items[item["id"]] = item
+            self._count(item)
+            return dict(item)
+
+    def create(self, body):
+        with self.lock:
+            if body["id"] in self.items:
+                raise CosmosResourceExistsError(status_code=409, message="Entity with the specified id already exists in the system.")
+        return self.upsert(body)
+
+    def read(self, item_id):
+        with self.lock:
+            item = dict(self._current(item_id))
+            self._count(item)
+            return item
+
+    def replace(self, body, if_match=None):
+        with self.lock:
+            self._check(self._current(body["id"]), if_match)
+            item = _stored(dict(body, _etag=uuid.uuid4().hex))
+            self.items[body["id"]] = item
+            self._count(item)
+            return dict(item)
+
+    def delete(self, item_id):
+        with self.lock:
+            self._current(item_id)
+            del self.items[item_id]
+
+    def patch(self, item_id, operations, etag=None):
+        with self.lock:
+            current = self._current(item_id)
+            self._check(current, etag)
+            item = json.loads(json.dumps(current, default=str))
+            for operation in operations:
+                *parents, name = operation["path"].strip("/").split("/")
+                target = item
+                for parent in parents:
+                    target = target[parent]
+                if operation["op"] == "remove":
+                    del target[name]
+                elif operation["op"] == "incr":
+                    target[name] = target.get(name, 0) + operation["value"]
+                elif operation["op"] == "add" and name == "-":
+                    target.append(operation["value"])
+                else:
+                    target[name] = operation["value"]
+            item["_etag"] = uuid.uuid4().hex
+            item = _stored(item)
+            self.items[item_id] = item
+            self._count(operations)
+            return dict(item)
+
+
+class FakeBlobClient:
+    def __init__(self, service, container, blob):
+        self._service = service
+        self.container_name = container
+        self.blob_name = blob
+
+    def upload_blob(self, data, **kwargs):
+        self._service._connection.request()
+        self._service.blobs[(self.container_name, self.blob_name)] = data if isinstance(data, bytes) else data.read()
+
+    def download_blob(self):
+        self._service._connection.request()
+        data = self._service.blobs[(self.container_name, self.blob_name)]
+        return SimpleNamespace(readall=lambda: data)
+
+    def delete_blob(self):
+        self._service._connection.request()
+        self._service.blobs.pop((self.container_name, self.blob_name), None)
+
+
+class FakeBlobServiceClient:
+    def __init__(self, blobs=None, connect_latency=0.0, request_latency=0.0):
+        self._connection = _Connection(connect_latency, request_latency)
+        self.blobs = blobs if blobs is not None else {}
+
+    def get_blob_client(self, container, blob):
+        return FakeBlobClient(self, container, blob)
+
+
+class FakeAsyncOpenAI:
+    # Async stand-in for AsyncAzureOpenAI; throttle_rate is the fraction of requests answered with a 429
+    def __init__(self, reply="The invoice and receipt match.", request_latency=0.0, throttle_rate=0.0, retry_after=None, seed=0, connect_latency=0.0):
+        self._reply = reply
+        self.request_latency = request_latency
+        self.connect_latency = connect_latency
+        self._connected = False
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self._random = random.Random(seed)
+        self.requests = 0
+        self.throttled = 0
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create))
+
+    async def _create(self, model, messages, **kwargs):
+        self.requests += 1
+        if not self._connected:
+            self._connected = True
+            await asyncio.sleep(self.connect_latency)
+        await asyncio.sleep(self.request_latency)
+        if self._random.random() < self.throttle_rate:
+            self.throttled += 1
+            headers = {"retry-after": str(self.retry_after)} if self.retry_after is not None else {}
+            response = SimpleNamespace(status_code=429, headers=headers, request=None)
+            raise RateLimitError("Rate limit reached", response=response, body=None)
+        message = SimpleNamespace(content=self._reply)
+        # Token counts estimated at four characters per token
+        usage = SimpleNamespace(prompt_tokens=sum(len(m["content"]) for m in messages) // 4, completion_tokens=len(self._reply) // 4)
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)], usage=usage)
+
+
+# Async stand-ins for the azure.ai.formrecognizer.aio, azure.cosmos.aio and azure.storage.blob.aio
+# clients. Latencies are awaited, so many requests can be in flight on one event loop.
+
+
+def _service_unavailable():
+    return HttpResponseError("(ServiceUnavailable) The service is temporarily unavailable.")
+
+
+def _cosmos_unavailable():
+    return CosmosHttpResponseError(status_code=503, message="Service is currently unavailable.")
+
+
+class _AsyncConnection:
+    def __init__(self, connect_latency=0.0, request_latency=0.0, error_rate=0.0, error=_service_unavailable, seed=0):
+        self.connect_latency = connect_latency
+        self.request_latency = request_latency
+        self.error_rate = error_rate
+        self._error = error
+        self._random = random.Random(seed)
+        self._connected = False
+        self.errors = 0
+        self.requests = 0
+
+    async def request(self):
+        self.requests += 1
+        if not self._connected:
+            self._connected = True
+            await asyncio.sleep(self.connect_latency)
+        await asyncio.sleep(self.request_latency)
+        if self.error_rate and self._random.random() < self.error_rate:
+            self.errors += 1
+            raise self._error()
+
+
+class FakeAsyncPoller:
+    def __init__(self, client, result):
+        self._client = client
+        self._result = result
+
+    async def result(self):
+        self._client.in_flight += 1
+        self._client.peak_in_flight = max(self._client.peak_in_flight, self._client.in_flight)
+        try:
+            await asyncio.sleep(self._client.analysis_latency + self._client.page_latency * len(self._result.pages or []))
+            return self._result
+        finally:
+            self._client.in_flight -= 1
+
+
+class FakeAsyncDocumentAnalysisClient:
+    # analysis_latency is how long the long running operation takes once submitted, plus page_latency
+    # for each page of the result. results maps a model id to its AnalyzeResult, or to a function of
+    # the document URL or bytes that returns one. When pages are requested the function is also
+    # passed the pages, e.g. "1-10".
+    def __init__(self, results=None, connect_latency=0.0, request_latency=0.0, analysis_latency=0.0, error_rate=0.0, seed=0, page_latency=0.0):
+        self.results = results or {}
+        self.analysis_latency = analysis_latency
+        self.page_latency = page_latency
+        self._connection = _AsyncConnection(connect_latency, request_latency, error_rate, seed=seed)
+        self.analyses = 0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+
+    @property
+    def errors(self):
+        return self._connection.errors
+
+    async def _begin(self, model_id, document, pages=None):
+        self.analyses += 1
+        await self._connection.request()
+        result = self.results.get(model_id)
+        if callable(result):
+            result = result(document, pages) if pages else result(document)
+        return FakeAsyncPoller(self, result)
+
+    async def begin_analyze_document_from_url(self, model_id, document_url, pages=None, **kwargs):
+        return await self._begin(model_id, document_url, pages)
+
+    async def begin_analyze_document(self, model_id, document, pages=None, **kwargs):
+        return await self._begin(model_id, document, pages)
+
+
+class FakeAsyncContainer:
+    def __init__(self, connection, items=None):
+        self._connection = connection
+        self._items = _Items(items)
+
+    async def upsert_item(self, body):
+        await self._connection.request()
+        return self._items.upsert(body)
+
+    async def create_item(self, body):
+        await self._connection.request()
+        return self._items.create(body)
+
+    async def read_item(self, item, partition_key):
+        await self._connection.request()
+        return self._items.read(item)
+
+    async def replace_item(self, item, body, if_match=None, etag=None, **kwargs):
+        await self._connection.request()
+        return self._items.replace(body, if_match or etag)
+
+    async def delete_item(self, item, partition_key):
+        await self._connection.request()
+        self._items.delete(item)
+
+    async def patch_item(self, item, partition_key, patch_operations, etag=None, **kwargs):
+        await self._connection.request()
+        return self._items.patch(item, patch_operations, etag)
+
+
+class FakeAsyncCosmosClient:
+    def __init__(self, items=None, connect_latency=0.0, request_latency=0.0, error_rate=0.0, seed=0):
+        self._container = FakeAsyncContainer(_AsyncConnection(connect_latency, request_latency, error_rate, _cosmos_unavailable, seed), items)
+
+    @property
+    def errors(self):
+        return self._container._connection.errors
+
+    @property
+    def requests(self):
+        return self._container._connection.requests
+
+    def get_database_client(self, database):
+        return SimpleNamespace(get_container_client=lambda container: self._container)
+
+
+class _UploadedSize:
+    # Placeholder for uploaded content when the fake does not retain bytes, so a benchmark measures
+    # the memory of the function rather than of the stand-in storage account
+    def __init__(self, size):
+        self.size = size
+
+    def __len__(self):
+        return self.size
+
+
+class FakeAsyncDownloader:
+    def __init__(self, data, chunk_size):
+        self._data = data
+        self._chunk_size = chunk_size
+        self.size = len(data)
+
+    async def readall(self):
+        return bytes(self._data)
+
+    async def _chunks(self):
+        view = memoryview(self._data)
+        for start in range(0, len(view), self._chunk_size):
+            yield bytes(view[start:start + self._chunk_size])
+
+    def chunks(self):
+        return self._chunks()
+
+
+class FakeAsyncBlobClient:
+    def __init__(self, service, container, blob):
+        self._service = service
+        self.container_name = container
+        self.blob_name = blob
+        self.url = "https://" + service.account + ".blob.core.windows.net/" + container + "/" + blob
+
+    def _key(self):
+        return (self.container_name, self.blob_name)
+
+    def _stored(self):
+        if self._key() not in self._service.blobs:
+            raise ResourceNotFoundError("The specified blob does not exist.")
+        return self._service.blobs[self._key()]
+
+    async def upload_blob(self, data, **kwargs):
+        await self._service._connection.request()
+        data = data if isinstance(data, bytes) else data.read()
+        self._service.blobs[self._key()] = data if self._service.retain_uploads else _UploadedSize(len(data))
+
+    async def download_blob(self):
+        await self._service._connection.request()
+        return FakeAsyncDownloader(self._stored(), self._service.chunk_size)
+
+    async def get_blob_properties(self):
+        await self._service._connection.request()
+        copy = SimpleNamespace(status="success" if self._key() in self._service.copied else None)
+        return SimpleNamespace(size=len(self._stored()), copy=copy)
+
+    async def start_copy_from_url(self, source_url, **kwargs):
+        await self._service._connection.request()
+        if not self._service.server_copy:
+            raise HttpResponseError("Server side copy is not available")
+        container, blob = source_url.split(".blob.core.windows.net/", 1)[1].split("/", 1)
+        # Copies share the stored object, nothing is read into the function
+        self._service.blobs[self._key()] = self._service.blobs[(container, blob)]
+        self._service.copied.add(self._key())
+        return {"copy_status": "success", "copy_id": uuid.uuid4().hex}
+
+    async def stage_block(self, block_id, data, length=None, **kwargs):
+        await self._service._connection.request()
+        staged = self._service.staged.setdefault(self._key(), {})
+        staged[block_id] = data if self._service.retain_uploads else _UploadedSize(len(data))
+
+    async def commit_block_list(self, block_list, **kwargs):
+        await self._service._connection.request()
+        staged = self._service.staged.pop(self._key(), {})
+        blocks = [staged[block.id] for block in block_list]
+        if self._service.retain_uploads:
+            self._service.blobs[self._key()] = b"".join(blocks)
+        else:
+            self._service.blobs[self._key()] = _UploadedSize(sum(len(block) for block in blocks))
+
+    async def delete_blob(self):
+        await self._service._connection.request()
+        if self._service.blobs.pop(self._key(), None) is None:
+            raise ResourceNotFoundError("The specified blob does not exist.")
+
+
+class FakeAsyncBlobServiceClient:
+    # server_copy=False makes start_copy_from_url fail so the streaming fallback is used
+    def __init__(self, blobs=None, connect_latency=0.0, request_latency=0.0, server_copy=True, retain_uploads=True, chunk_size=4 * 1024 * 1024, account="bench", error_rate=0.0, seed=0):
+        self._connection = _AsyncConnection(connect_latency, request_latency, error_rate, seed=seed)
+        self.blobs = blobs if blobs is not None else {}
+        self.staged = {}
+        self.copied = set()
+        self.server_copy = server_copy
+        self.retain_uploads = retain_uploads
+        self.chunk_size = chunk_size
+        self.account = account
+
+    @property
+    def errors(self):
+        return self._connection.errors
+
+    def get_blob_client(self, container, blob):
+        return FakeAsyncBlobClient(self, container, blob)
+
+
+# Blob trigger and output binding stand-ins, for calling the functions in function_app.py directly
+
+
+class FakeInputStream:
+    def __init__(self, name, data, account="bench"):
+        self.name = name
+        self.uri = "https://" + account + ".blob.core.windows.net/" + name
+        self.length = len(data)
+        self._data = data
+
+    def read(self, size=-1):
+        return self._data
+
+
+class FakeOut:
+    def __init__(self):
+        self.value = None
+
+    def set(self, value):
+        self.value = value
+
+    def get(self):
+        return self.value
+
+
+class FakeContext:
+    # Invocation context, by default of the last attempt allowed by the retry policy
+    def __init__(self, retry_count=0, max_retry_count=0):
+        self.retry_context = SimpleNamespace(retry_count=retry_count, max_retry_count=max_retry_count)
+
+
+_user_functions = {}
+
+
+def user_function(name):
+    # The undecorated function registered under name in function_app.app. get_functions() can only
+    # be called once, its second call sees every function twice.
+    if not _user_functions:
+        import function_app
+        for function in function_app.app.get_functions():
+            _user_functions[function.get_function_name()] = function.get_user_function()
+    return _user_functions[name]
@@ -0,0 +1,276 @@
+import os
+import gzip
+import json
+import time
+import logging
+import datetime
+import threading
+from collections import OrderedDict
+from azure.core.exceptions import ResourceNotFoundError
+from azure.ai.formrecognizer import AnalyzeResult
+import clients
+
+# Two level caches shared by the functions: a bounded in-memory LRU in front of a durable backend.
+#   AnalysisCache   - Document Intelligence results keyed by (model id, API version, SHA-256 of the
+#                     document bytes), so re-uploads of the same file and function retries skip the
+#                     analysis. Durable backend: the analysis_cache_container blob container.
+#   ComparisonCache - Azure Open AI comparisons keyed by a fingerprint of the invoice and receipt
+#                     content plus the prompt and model, with a TTL. Durable backend: the
+#                     comparison_cache_container blob container.
+# Set a container app setting to an empty value to keep that cache in memory only.
+# Expired entries are deleted from the durable backend when they are read. Entries never read again
+# are left to a lifecycle management rule on the blob containers (see README.md).
+
+DEFAULT_MAXSIZE = 128
+DEFAULT_COMPARISON_MAXSIZE = 1024
+DEFAULT_COMPARISON_TTL = 7 * 24 * 60 * 60
+# Returned by _decode() for an entry past its TTL
+_EXPIRED = object()
+
+
+class LRUCache:
+    def __init__(self, maxsize=DEFAULT_MAXSIZE, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._items:
+                return None
+            expires, value = self._items[key]
+            if expires is not None and expires < time.monotonic():
+                del self._items[key]
+                return None
+            self._items.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            expires = time.monotonic() + self.ttl if self.ttl is not None else None
+            self._items[key] = (expires, value)
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def __len__(self):
+        return len(self._items)
+
+
+class BlobCacheBackend:
+    # Stores each entry as a gzipped JSON blob named after its cache key
+    def __init__(self, container):
+        self.container = container
+
+    def get(self, key):
+        try:
+            return gzip.decompress(clients.get_blob_client(self.container, key).download_blob().readall())
+        except ResourceNotFoundError:
+            return None
+
+    def put(self, key, data):
+        clients.get_blob_client(self.container, key).upload_blob(gzip.compress(data), overwrite=True)
+
+    def delete(self, key):
+        try:
+            clients.get_blob_client(self.container, key).delete_blob()
+        except ResourceNotFoundError:
+            pass
+
+
+class DirectoryCacheBackend:
+    # Stores each entry as a gzipped JSON file, for local runs and offline tooling
+    def __init__(self, path):
+        self.path = path
+
+    def _file(self, key):
+        return os.path.join(self.path, key.replace("/", os.sep) + ".json.gz")
+
+    def get(self, key):
+        try:
+            with open(self._file(key), "rb") as f:
+                return gzip.decompress(f.read())
+        except FileNotFoundError:
+            return None
+
+    def put(self, key, data):
+        file = self._file(key)
+        os.makedirs(os.path.dirname(file), exist_ok=True)
+        with open(file + ".tmp", "wb") as f:
+            f.write(gzip.compress(data))
+        os.replace(file + ".tmp", file)
+
+    def delete(self, key):
+        try:
+            os.remove(self._file(key))
+        except FileNotFoundError:
+            pass
+
+
+def _json_default(value):
+    # AnalyzeResult.to_dict() keeps date and time field values as Python objects
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    raise TypeError("Cannot serialise " + type(value).__name__)
+
+
+def _parse_field_values(node):
+    if isinstance(node, dict):
+        value = node.get("value")
+        if node.get("value_type") == "date" and isinstance(value, str):
+            node["value"] = datetime.date.fromisoformat(value)
+        elif node.get("value_type") == "time" and isinstance(value, str):
+            node["value"] = datetime.time.fromisoformat(value)
+        for child in node.values():
+            _parse_field_values(child)
+    elif isinstance(node, list):
+        for child in node:
+            _parse_field_values(child)
+    return node
+
+
+def dump_result(result):
+    return json.dumps(result.to_dict(), default=_json_default).encode("utf-8")
+
+
+def load_result(data):
+    return AnalyzeResult.from_dict(_parse_field_values(json.loads(data)))
+
+
+class TieredCache:
+    # Subclasses convert values to and from the bytes kept by the durable backend
+    def __init__(self, backend=None, maxsize=DEFAULT_MAXSIZE, ttl=None):
+        self.backend = backend
+        self.memory = LRUCache(maxsize, ttl)
+        self.counters = {"memory_hits": 0, "durable_hits": 0, "misses": 0, "errors": 0}
+        self._lock = threading.Lock()
+
+    def _encode(self, value):
+        raise NotImplementedError
+
+    def _decode(self, data):
+        raise NotImplementedError
+
+    def _count(self, name):
+        with self._lock:
+            self.counters[name] += 1
+
+    def get(self, key):
+        value = self.memory.get(key)
+        if value is not None:
+            self._count("memory_hits")
+            return value
+
+        if self.backend is not None:
+            try:
+                data = self.backend.get(key)
+                value = self._decode(data) if data is not None else None
+                if value is _EXPIRED:
+                    self.backend.delete(key)
+                    value = None
+            except Exception as error:
+                # The cache must never fail an invocation, fall back to doing the work
+                logging.warning("Cache read failed for %s: %s", key, error)
+                self._count("errors")
+                value = None
+            if value is not None:
+                self.memory.put(key, value)
+                self._count("durable_hits")
+                return value
+
+        self._count("misses")
+        return None
+
+    def put(self, key, value):
+        self.memory.put(key, value)
+        if self.backend is not None:
+            try:
+                self.backend.put(key, self._encode(value))
+            except Exception as error:
+                logging.warning("Cache write failed for %s: %s", key, error)
+                self._count("errors")
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+        lookups = stats["memory_hits"] + stats["durable_hits"] + stats["misses"]
+        stats["hit_rate"] = (lookups - stats["misses"]) / lookups if lookups else 0.0
+        stats["memory_entries"] = len(self.memory)
+        return stats
+
+
+class AnalysisCache(TieredCache):
+    @staticmethod
+    def key(model_id, api_version, sha256):
+        return model_id + "/" + api_version + "/" + sha256
+
+    def _encode(self, result):
+        return dump_result(result)
+
+    def _decode(self, data):
+        return load_result(data)
+
+
+class ComparisonCache(TieredCache):
+    def __init__(self, backend=None, maxsize=DEFAULT_COMPARISON_MAXSIZE, ttl=DEFAULT_COMPARISON_TTL):
+        super().__init__(backend, maxsize, ttl)
+        self.ttl = ttl
+
+    def _encode(self, comparison):
+        return json.dumps({"comparison": comparison, "created": time.time()}).encode("utf-8")
+
+    def _decode(self, data):
+        entry = json.loads(data)
+        if self.ttl is not None and time.time() - entry["created"] > self.ttl:
+            return _EXPIRED
+        return entry["comparison"]
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def _shared(name, factory):
+    cached = _caches.get(name)
+    if cached is None:
+        with _caches_lock:
+            cached = _caches.get(name)
+            if cached is None:
+                cached = _caches[name] = factory()
+    return cached
+
+
+def _new_analysis_cache():
+    container = os.getenv("analysis_cache_container", "analysis-cache")
+    maxsize = int(os.getenv("analysis_cache_maxsize", DEFAULT_MAXSIZE))
+    return AnalysisCache(BlobCacheBackend(container) if container else None, maxsize)
+
+
+def _new_comparison_cache():
+    container = os.getenv("comparison_cache_container", "comparison-cache")
+    maxsize = int(os.getenv("comparison_cache_maxsize", DEFAULT_COMPARISON_MAXSIZE))
+    ttl = float(os.getenv("comparison_cache_ttl", DEFAULT_COMPARISON_TTL))
+    return ComparisonCache(BlobCacheBackend(container) if container else None, maxsize, ttl)
+
+
+def get_analysis_cache():
+    # Process-wide cache shared by the invoice and receipt functions
+    return _shared("analysis", _new_analysis_cache)
+
+
+def set_analysis_cache(analysis_cache):
+    _caches["analysis"] = analysis_cache
+
+
+def get_comparison_cache():
+    # Process-wide cache used by the fraud function
+    return _shared("comparison", _new_comparison_cache)
+
+
+def set_comparison_cache(comparison_cache):
+    _caches["comparison"] = comparison_cache
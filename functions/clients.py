@@ -0,0 +1,158 @@
+import os
+import threading
+from functools import lru_cache
+from openai import AsyncAzureOpenAI
+from azure.core.credentials import AzureKeyCredential
+from azure.ai.formrecognizer import DocumentAnalysisClient
+from azure.ai.formrecognizer.aio import DocumentAnalysisClient as AsyncDocumentAnalysisClient
+from azure.storage.blob import BlobServiceClient
+from azure.storage.blob.aio import BlobServiceClient as AsyncBlobServiceClient
+from azure.cosmos.aio import CosmosClient as AsyncCosmosClient
+
+# Process-wide registry of the Azure clients used by the invoice, receipt and fraud functions.
+# Clients are created the first time they are needed and then reused by every invocation on the
+# same host process, so TLS connections, connection pools and Cosmos account metadata stay warm.
+# The functions use the async clients, which are bound to the event loop of the Functions worker, so
+# only use them from async functions. The sync blob client serves the blob backed caches, which are
+# called on worker threads. The sync Document Intelligence client is for tooling only
+# (bench_preprocess.py --live).
+
+DATABASE_NAME = "ToDoList"
+CONTAINER_NAME = "docs"
+OPENAI_API_VERSION = "2023-05-15"
+DOCINTELL_API_VERSION = "2023-07-31"
+
+_lock = threading.Lock()
+_clients = {}
+
+
+def _config(*names):
+    return tuple(os.getenv(name) for name in names)
+
+
+def _new_document_analysis_client(endpoint, key):
+    return DocumentAnalysisClient(endpoint=endpoint, credential=AzureKeyCredential(key), api_version=DOCINTELL_API_VERSION)
+
+
+def _new_blob_service_client(connection_string):
+    return BlobServiceClient.from_connection_string(connection_string)
+
+
+def _new_async_document_analysis_client(endpoint, key):
+    return AsyncDocumentAnalysisClient(endpoint=endpoint, credential=AzureKeyCredential(key), api_version=DOCINTELL_API_VERSION)
+
+
+def _new_async_cosmos_client(connection_string):
+    return AsyncCosmosClient.from_connection_string(connection_string)
+
+
+def _new_async_blob_service_client(connection_string):
+    return AsyncBlobServiceClient.from_connection_string(connection_string)
+
+
+def _new_async_openai_client(api_key, azure_endpoint):
+    # Retries (429, 5xx, timeouts, connection errors) are handled by comparison.py so they can share
+    # the concurrency limit
+    return AsyncAzureOpenAI(api_key=api_key, api_version=OPENAI_API_VERSION, azure_endpoint=azure_endpoint, max_retries=0)
+
+
+# Each entry maps a client name to the app settings it is built from and the factory that builds it.
+# register_factory() lets benchmarks and local tooling swap in stand-in services.
+_factories = {
+    "docintell": (("docintell_endpoint", "docintell_key"), _new_document_analysis_client),
+    "blob": (("mfdocintell_STORAGE",), _new_blob_service_client),
+    "docintell_async": (("docintell_endpoint", "docintell_key"), _new_async_document_analysis_client),
+    "cosmos_async": (("cosmosdb_config",), _new_async_cosmos_client),
+    "blob_async": (("mfdocintell_STORAGE",), _new_async_blob_service_client),
+    "openai_async": (("AZURE_OPENAI_API_KEY", "AZURE_OPENAI_ENDPOINT"), _new_async_openai_client),
+}
+
+
+def _get(name):
+    settings, factory = _factories[name]
+    config = _config(*settings)
+
+    # Fast path, no locking once the client is warm and the app settings have not changed
+    entry = _clients.get(name)
+    if entry is not None and entry[0] == config:
+        return entry[1]
+
+    with _lock:
+        entry = _clients.get(name)
+        if entry is None or entry[0] != config:
+            entry = (config, factory(*config))
+            _clients[name] = entry
+        return entry[1]
+
+
+def register_factory(name, factory, settings=None):
+    # Replace the factory used to build a client and drop any cached instance of it
+    with _lock:
+        current_settings, _ = _factories[name]
+        _factories[name] = (settings or current_settings, factory)
+        _clients.pop(name, None)
+
+
+def reset_clients(*names):
+    # Drop cached clients so the next call rebuilds them, e.g. after rotating keys
+    with _lock:
+        for name in names or list(_clients):
+            _clients.pop(name, None)
+
+
+async def close_async_clients():
+    # Close and drop the async clients, for tools that run the functions' code on their own event loop
+    with _lock:
+        entries = [_clients.pop(name) for name in list(_clients) if name.endswith("_async")]
+    for _, client in entries:
+        close = getattr(client, "close", None)
+        if close is not None:
+            await close()
+
+
+def get_document_analysis_client():
+    return _get("docintell")
+
+
+def get_blob_service_client():
+    return _get("blob")
+
+
+def get_blob_client(container, blob_name):
+    return get_blob_service_client().get_blob_client(container=container, blob=blob_name)
+
+
+def get_async_document_analysis_client():
+    return _get("docintell_async")
+
+
+def get_async_container(container_name):
+    return _get("cosmos_async").get_database_client(DATABASE_NAME).get_container_client(container_name)
+
+
+def get_async_docs_container():
+    return get_async_container(CONTAINER_NAME)
+
+
+def get_async_blob_client(container, blob_name):
+    return _get("blob_async").get_blob_client(container=container, blob=blob_name)
+
+
+def get_async_openai_client():
+    return _get("openai_async")
+
+
+def parse_connection_string(connection_string):
+    # "DefaultEndpointsProtocol=https;AccountName=...;AccountKey=...;EndpointSuffix=..." -> dict
+    return dict(part.split("=", 1) for part in connection_string.split(";") if "=" in part)
+
+
+@lru_cache(maxsize=4)
+def _blob_endpoint(connection_string):
+    storage = parse_connection_string(connection_string)
+    return "https://" + storage["AccountName"] + ".blob." + storage.get("EndpointSuffix", "core.windows.net")
+
+
+def processed_blob_uri(blob_name):
+    # Pre generated URI of a document after it has been moved to the processed container
+    return _blob_endpoint(os.getenv("mfdocintell_STORAGE")) + "/processed/" + blob_name
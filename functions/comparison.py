@@ -0,0 +1,156 @@
+import os
+import time
+import random
+import asyncio
+import hashlib
+import logging
+from openai import APIConnectionError, InternalServerError, RateLimitError
+import extraction
+import pipeline
+import prompt
+import telemetry
+
+# Concurrent invoice/receipt comparison with Azure Open AI for a batch of Cosmos DB changes.
+# At most fraud_max_concurrency requests are in flight at once and requests that are throttled
+# (HTTP 429), fail with a 5xx, time out or lose their connection are retried with exponential
+# backoff, honouring the Retry-After header when present. The client is built without SDK retries.
+# Results are memoised in the comparison cache, so identical invoice/receipt pairs are only sent to
+# Azure Open AI once per prompt and model. Prompts are kept to a token budget by prompt.py; pairs
+# that still do not fit are summarised chunk by chunk first (map) and then compared (reduce).
+
+MODEL = "gpt-4" # model = "deployment_name".
+DEFAULT_CONCURRENCY = 8
+DEFAULT_MAX_RETRIES = 5
+BASE_DELAY = 1.0
+MAX_DELAY = 30.0
+
+SYSTEM_PROMPT = '''You are an AI assistant that helps audit invoices and receipts to make sure match. 
+                                                If the invoice and receipt do not match, state they do not match. Then explain the reasons why they do not match in bullet point form.
+                                                If the invoice and receipt do match, state they match. Then explain the reasons why they do match in bullet point form.'''
+
+SUMMARY_PROMPT = '''You are an AI assistant that helps audit invoices and receipts. You are given one part of a long document.
+List the vendor or merchant, dates, line items with quantities and prices, totals, taxes and payment details it contains.
+Only list facts that appear in the text.'''
+
+# Changing the prompt or the model changes every cache key
+PROMPT_VERSION = hashlib.sha256((MODEL + "\0" + SYSTEM_PROMPT + "\0" + SUMMARY_PROMPT + "\0" + prompt.FORMAT_VERSION).encode("utf-8")).hexdigest()[:16]
+
+def _content_fingerprint(data):
+    return data.get("content_fingerprint") or extraction.content_fingerprint(data.get("content"))
+
+
+def fingerprint(invoice, receipt):
+    # Keyed on the content fingerprints saved with the extracted data, so a cached comparison is found
+    # without reading the OCR text back from blob storage. Whitespace and case differences in the
+    # OCR text do not change the comparison.
+    digest = hashlib.sha256((_content_fingerprint(invoice) + "\0" + _content_fingerprint(receipt)).encode("utf-8")).hexdigest()
+    return "comparison/" + PROMPT_VERSION + "/" + digest
+
+
+def build_messages(user_message, system_prompt=SYSTEM_PROMPT):
+    return [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": user_message},
+    ]
+
+
+def _retry_delay(error, attempt):
+    response = getattr(error, "response", None)
+    retry_after = response.headers.get("retry-after") if response is not None else None
+    try:
+        return min(float(retry_after), MAX_DELAY)
+    except (TypeError, ValueError):
+        return min(BASE_DELAY * 2 ** attempt, MAX_DELAY) * random.uniform(0.5, 1.0)
+
+
+async def _chat(client, messages, semaphore, max_retries):
+    for attempt in range(max_retries + 1):
+        async with semaphore:
+            try:
+                response = await client.chat.completions.create(model=MODEL, messages=messages)
+                usage = getattr(response, "usage", None)
+                if usage is not None:
+                    telemetry.count("llm_tokens", usage.prompt_tokens, kind="prompt")
+                    telemetry.count("llm_tokens", usage.completion_tokens, kind="completion")
+                return response.choices[0].message.content
+            except (RateLimitError, InternalServerError, APIConnectionError) as error:
+                # APITimeoutError is an APIConnectionError
+                if attempt == max_retries:
+                    raise
+                status = getattr(error, "status_code", None) or type(error).__name__
+                telemetry.count("retries", service="openai", status=status)
+                delay = _retry_delay(error, attempt)
+        # Back off outside the semaphore so other comparisons can use the slot
+        logging.warning("Azure Open AI request failed (%s), retrying in %.1fs", status, delay)
+        await asyncio.sleep(delay)
+
+
+def _chunks(invoice, receipt, budget):
+    chunks = [("Invoice", chunk) for chunk in prompt.chunk_text(prompt.document_text("Invoice", invoice), budget)]
+    return chunks + [("Receipt", chunk) for chunk in prompt.chunk_text(prompt.document_text("Receipt", receipt), budget)]
+
+
+def _summaries_message(invoice_summary, receipt_summary, budget):
+    half = budget // 2
+    return "Invoice:\n" + prompt.excerpt(invoice_summary, half) + "\n\nReceipt:\n" + prompt.excerpt(receipt_summary, half)
+
+
+async def _map_reduce(client, invoice, receipt, budget, semaphore, max_retries):
+    # Summarise each budget sized chunk of both documents, then compare the summaries. Token
+    # counting runs on a worker thread, like build_user_message().
+    chunks = await asyncio.to_thread(_chunks, invoice, receipt, budget)
+    summaries = await asyncio.gather(*(_chat(client, build_messages(chunk, SUMMARY_PROMPT), semaphore, max_retries) for _, chunk in chunks))
+
+    invoice_summary = "\n".join(summary for (title, _), summary in zip(chunks, summaries) if title == "Invoice")
+    receipt_summary = "\n".join(summary for (title, _), summary in zip(chunks, summaries) if title == "Receipt")
+    message = await asyncio.to_thread(_summaries_message, invoice_summary, receipt_summary, budget)
+    return await _chat(client, build_messages(message), semaphore, max_retries), len(chunks) + 1
+
+
+async def compare(client, invoice, receipt, semaphore, max_retries=DEFAULT_MAX_RETRIES, comparison_cache=None, label=None):
+    # Compare the extracted invoice and receipt data (extraction.extract() dictionaries), timed as the
+    # "compare" stage of application label
+    with telemetry.span("compare", application=label):
+        return await _compare(client, invoice, receipt, semaphore, max_retries, comparison_cache, label)
+
+
+async def _compare(client, invoice, receipt, semaphore, max_retries, comparison_cache, label):
+    key = fingerprint(invoice, receipt)
+    if comparison_cache is not None:
+        # The durable backend is a blocking call, keep it off the event loop
+        cached = await asyncio.to_thread(comparison_cache.get, key)
+        if cached is not None:
+            return cached
+
+    # The OCR text is only needed for the prompt
+    invoice, receipt = await asyncio.gather(pipeline.load_content(invoice), pipeline.load_content(receipt))
+
+    start = time.perf_counter()
+    budget = prompt.token_budget()
+    # Encodes both OCR texts, and loads the tiktoken vocabulary the first time: keep it off the event loop
+    built = await asyncio.to_thread(prompt.build_user_message, invoice, receipt, budget)
+    if built is not None:
+        message, tokens = built
+        result = await _chat(client, build_messages(message), semaphore, max_retries)
+        logging.info("Compared %s with a %d token prompt in %.2fs", label, tokens, time.perf_counter() - start)
+    else:
+        result, calls = await _map_reduce(client, invoice, receipt, budget, semaphore, max_retries)
+        logging.info("Compared %s with map-reduce over %d requests of up to %d tokens in %.2fs", label, calls, budget, time.perf_counter() - start)
+
+    if comparison_cache is not None:
+        await asyncio.to_thread(comparison_cache.put, key, result)
+    return result
+
+
+async def compare_all(client, pairs, concurrency=None, max_retries=DEFAULT_MAX_RETRIES, comparison_cache=None, labels=None):
+    # Compare (invoice, receipt) pairs concurrently. Results are returned in the same order as
+    # pairs; a pair that failed has its exception in place of the comparison. labels, e.g. the
+    # application numbers, identify each pair in the logs.
+    if concurrency is None:
+        concurrency = int(os.getenv("fraud_max_concurrency", DEFAULT_CONCURRENCY))
+    labels = labels or [None] * len(pairs)
+    semaphore = asyncio.Semaphore(concurrency)
+    return await asyncio.gather(
+        *(compare(client, invoice, receipt, semaphore, max_retries, comparison_cache, label) for (invoice, receipt), label in zip(pairs, labels)),
+        return_exceptions=True,
+    )
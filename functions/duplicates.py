@@ -0,0 +1,238 @@
+import os
+import re
+import random
+import asyncio
+import hashlib
+import logging
+import threading
+from azure.cosmos.exceptions import CosmosResourceNotFoundError, CosmosResourceExistsError
+import clients
+import prematch
+import telemetry
+
+# Cross application duplicate detection for invoices and receipts, run by the invoice and receipt
+# functions right after extraction.
+# Every document gets two fingerprints:
+#   key       - SHA-256 of its normalised vendor/merchant name, total, date and line items, the same
+#               receipt extracted again gives the same key. Only built when the party, the total and
+#               the date or line items are all there, a name and an amount alone are not a document.
+#   signature - MinHash of the word shingles of its OCR text, two signatures agree in about the share
+#               of values that the Jaccard similarity of the two texts is, so a rescan or photo of
+#               the same receipt still matches. The values are below 2^33, Cosmos DB stores numbers
+#               as doubles and rounds anything above 2^53.
+# The index has one entry per exact key and one per LSH band of the signature (BANDS bands of ROWS
+# values), each listing the applications that have it, plus the signature of every document. A
+# lookup is BANDS + 1 point reads whatever the size of the index, candidates from the bands are
+# confirmed against their signatures with SIMILARITY_THRESHOLD (up to MAX_CANDIDATES more reads, the
+# same key is confirmed the same way when both documents have a signature), and
+# the document is then added with up to BANDS + 2 writes. The reads and writes of each step are sent
+# at the same time, so a check costs three Cosmos DB round trips plus the signature. Durable backend: the Cosmos DB
+# container named by the duplicate_index_container app setting (partition key /id). Set it to an
+# empty value to keep the index in memory only.
+
+NUM_PERM = 100
+BANDS = 25
+ROWS = NUM_PERM // BANDS
+SHINGLE_SIZE = 3 # words
+SIMILARITY_THRESHOLD = 0.6
+MAX_CANDIDATES = 50
+MAX_BUCKET_SIZE = 1000 # applications listed per entry, a very common entry says nothing
+DEFAULT_CONTAINER = "fingerprints"
+
+# Fields that identify a document, per model: party, total, date
+IDENTITY = {
+    "prebuilt-invoice": ("vendor_name", "invoice_total", "invoice_date"),
+    "prebuilt-receipt": ("merchant_name", "total", "transaction_date"),
+}
+
+_word = re.compile(r"[a-z0-9]+")
+# Smallest prime above the 32-bit shingle hashes, (a * x + b) % _PRIME permutes them
+_PRIME = (1 << 32) + 15
+# Fixed seed, signatures are only comparable when every process uses the same permutations
+_random = random.Random(20240101)
+_PERMUTATIONS = [(_random.randrange(1, _PRIME), _random.randrange(0, _PRIME)) for _ in range(NUM_PERM)]
+
+
+def _hash32(text):
+    return int.from_bytes(hashlib.blake2b(text.encode("utf-8"), digest_size=4).digest(), "little")
+
+
+def shingles(content):
+    words = _word.findall((content or "").lower())
+    if len(words) < SHINGLE_SIZE:
+        return {_hash32(" ".join(words))} if words else set()
+    return {_hash32(" ".join(words[i:i + SHINGLE_SIZE])) for i in range(len(words) - SHINGLE_SIZE + 1)}
+
+
+def signature(content):
+    # MinHash of the OCR text, None when it has no words
+    hashes = shingles(content)
+    if not hashes:
+        return None
+    return [min((a * value + b) % _PRIME for value in hashes) for a, b in _PERMUTATIONS]
+
+
+def similarity(a, b):
+    # Estimated Jaccard similarity of the texts behind two signatures
+    return sum(x == y for x, y in zip(a, b)) / NUM_PERM
+
+
+def _number(value):
+    return "%.2f" % value if isinstance(value, (int, float)) else ""
+
+
+def key(model_id, data):
+    # Exact fingerprint of the extracted fields, None unless the document has a party, a total and a
+    # date or line items
+    party, total, date = (data.get(field) for field in IDENTITY[model_id])
+    items = data.get("items") or {}
+    columns = sorted(column for column in items if column != "confidence")
+    if not party or total is None or not (date or any(items[column] for column in columns)):
+        return None
+    parts = [prematch.normalise_name(party), _number(total), str(date or "")]
+    rows = zip(*(items[column] for column in columns)) if columns else []
+    for row in sorted(str([prematch.normalise_name(value) if isinstance(value, str) else _number(value) for value in row]) for row in rows):
+        parts.append(row)
+    return hashlib.sha256("|".join(parts).encode("utf-8")).hexdigest()
+
+
+def bands(values):
+    return [hashlib.sha1(str(values[band * ROWS:(band + 1) * ROWS]).encode("utf-8")).hexdigest()[:16] for band in range(BANDS)]
+
+
+class MemoryIndexBackend:
+    def __init__(self):
+        self.items = {}
+        self._lock = threading.Lock()
+
+    async def get_many(self, ids):
+        with self._lock:
+            return {item_id: self.items[item_id] for item_id in ids if item_id in self.items}
+
+    async def append(self, item_id, application, exists=True):
+        with self._lock:
+            item = self.items.setdefault(item_id, {"id": item_id, "applications": []})
+            item["applications"].append(application)
+
+    async def put(self, item):
+        with self._lock:
+            self.items[item["id"]] = item
+
+
+class CosmosIndexBackend:
+    # One small item per entry, read and written by id, which is also the partition key
+    def __init__(self, container):
+        self.container = container
+
+    def _container(self):
+        return clients.get_async_container(self.container)
+
+    async def _read(self, item_id):
+        try:
+            return await self._container().read_item(item=item_id, partition_key=item_id)
+        except CosmosResourceNotFoundError:
+            return None
+
+    async def get_many(self, ids):
+        items = await asyncio.gather(*(self._read(item_id) for item_id in ids))
+        return {item_id: item for item_id, item in zip(ids, items) if item is not None}
+
+    async def _create(self, item_id, application):
+        try:
+            await self._container().create_item({"id": item_id, "applications": [application]})
+            return True
+        except CosmosResourceExistsError:
+            # Another document created the entry first
+            return False
+
+    async def append(self, item_id, application, exists=True):
+        # exists is whether the entry was there when it was read, a new entry is created in one request
+        if not exists and await self._create(item_id, application):
+            return
+        operations = [{"op": "add", "path": "/applications/-", "value": application}]
+        try:
+            await self._container().patch_item(item=item_id, partition_key=item_id, patch_operations=operations)
+        except CosmosResourceNotFoundError:
+            if not await self._create(item_id, application):
+                await self._container().patch_item(item=item_id, partition_key=item_id, patch_operations=operations)
+
+    async def put(self, item):
+        await self._container().upsert_item(item)
+
+
+class DuplicateIndex:
+    def __init__(self, backend=None):
+        self.backend = backend if backend is not None else MemoryIndexBackend()
+
+    async def check(self, field, model_id, application, data):
+        # Add the document to the index and return the other applications with the same or a near
+        # duplicate document, most similar first: [{"application", "similarity", "exact"}].
+        # data must still hold the OCR text in "content".
+        exact = key(model_id, data)
+        # Pure Python and about 20 ms per 1000 words of OCR text, keep it off the event loop
+        values = await asyncio.to_thread(signature, data.get("content"))
+        exact_id = field + "-x-" + exact if exact else None
+        band_ids = [field + "-b" + str(band) + "-" + value for band, value in enumerate(bands(values))] if values else []
+        entries = await self.backend.get_many(([exact_id] if exact_id else []) + band_ids)
+
+        exact_matches = set(entries.get(exact_id, {}).get("applications", [])) - {application}
+        near = set()
+        for band_id in band_ids:
+            near.update(entries.get(band_id, {}).get("applications", []))
+        near -= exact_matches | {application}
+        candidates = (sorted(exact_matches) + sorted(near))[:MAX_CANDIDATES]
+
+        signatures = await self.backend.get_many([field + "-s-" + candidate for candidate in candidates]) if values and candidates else {}
+        matches = []
+        for candidate in candidates:
+            stored = signatures.get(field + "-s-" + candidate)
+            # Identical extracted fields with OCR text that disagrees are two documents
+            score = similarity(values, stored["signature"]) if stored else (1.0 if candidate in exact_matches else 0.0)
+            if score >= SIMILARITY_THRESHOLD:
+                matches.append({"application": candidate, "similarity": round(score, 3), "exact": candidate in exact_matches})
+        matches.sort(key=lambda match: (not match["exact"], -match["similarity"]))
+
+        # Register the document. Entries it is already in are left alone, so processing an
+        # application again does not list it twice.
+        writes = []
+        if values:
+            writes.append(self.backend.put({"id": field + "-s-" + application, "signature": values, "key": exact}))
+        for item_id in ([exact_id] if exact_id else []) + band_ids:
+            listed = entries.get(item_id, {}).get("applications", [])
+            if application not in listed and len(listed) < MAX_BUCKET_SIZE:
+                writes.append(self.backend.append(item_id, application, exists=item_id in entries))
+        await asyncio.gather(*writes)
+        return matches
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_duplicate_index():
+    # Process-wide index shared by the invoice and receipt functions
+    global _index
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                container = os.getenv("duplicate_index_container", DEFAULT_CONTAINER)
+                _index = DuplicateIndex(CosmosIndexBackend(container) if container else None)
+    return _index
+
+
+def set_duplicate_index(index):
+    global _index
+    _index = index
+
+
+async def check(field, model_id, application, data):
+    # Duplicate check that never fails an invocation, the index being unavailable means no matches
+    try:
+        matches = await get_duplicate_index().check(field, model_id, application, data)
+    except Exception as error:
+        logging.warning("Duplicate check failed for application %s: %s", application, error)
+        return []
+    if matches:
+        logging.warning("The %s of application %s is also in applications %s", field, application, ", ".join(match["application"] for match in matches))
+        telemetry.count("duplicates", len(matches), field=field)
+    return matches
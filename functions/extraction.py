@@ -0,0 +1,316 @@
+import re
+import hashlib
+import datetime
+
+# Schema driven field extraction for the Document Intelligence prebuilt models.
+# Each model has a declarative table of Document Intelligence field -> (output key, converter) for the
+# document level fields and for its line items. The tables are compiled once at import into flat
+# lists of (field, key, confidence key, converter) so extracting a document is a single loop.
+# To support a new document type add its tables to SCHEMAS.
+#
+# Saved documents carry schema_version. Version 2 is compact and typed:
+#   - amounts are numbers, with the ISO 4217 code of the document in "currency"
+#   - dates are ISO 8601 strings
+#   - line items are columns, "items": {"description": [...], "amount": [...], "confidence": [...]},
+#     one value per item and one confidence per item
+#   - the OCR text is in "content" only until pipeline.store_content() moves it to blob storage and
+#     leaves "content_uri"; "content_fingerprint" identifies it for the comparison cache
+#   - a file with several documents, e.g. a bundle of invoices, has the first one at the top level
+#     and the others in "additional_documents", each with its own fields, currency and items
+# Version 1 documents (flat "item_{idx}_*" keys, "USD $12.5" or "€12.5" amounts, "June 10, 2019" dates, inline
+# content) are converted with upgrade().
+
+SCHEMA_VERSION = 2
+
+_whitespace = re.compile(r"\s+")
+_v1_amount = re.compile(r"^(?:([A-Za-z]{3}|None) )?([^\d\s-]*)\s*(-?[\d,]*\.?\d+)$")
+# Version 1 receipt item prices are the repr of the whole DocumentField
+_v1_field_amount = re.compile(r"CurrencyValue\(amount=(-?[\d.eE+-]+), symbol=([^,]*), code=([^)]*)\)")
+# Symbols that name one currency, "$" and "¥" do not
+_currency_symbols = {"€": "EUR", "£": "GBP", "₹": "INR", "R$": "BRL"}
+_v1_item_key = re.compile(r"^item_(\d+)_(.+)$")
+
+
+def _value(value):
+    return value
+
+
+def _address(value):
+    # "123 Main Street, Redmond, WA 98052" instead of the AddressValue repr
+    street = value.street_address or " ".join(part for part in (value.house_number, value.road) if part)
+    region = " ".join(part for part in (value.state, value.postal_code) if part)
+    return ", ".join(part for part in (street, value.city, region, value.country_region) if part)
+
+
+def _date(value):
+    return value.isoformat()
+
+
+def _currency(value):
+    # Older API versions return plain numbers for some receipt amounts
+    if not hasattr(value, "amount"):
+        return value
+    return value.amount
+
+
+INVOICE_FIELDS = {
+    "VendorName": ("vendor_name", _value),
+    "VendorAddress": ("vendor_address", _address),
+    "VendorAddressRecipient": ("vendor_address_recipient", _value),
+    "CustomerName": ("customer_name", _value),
+    "CustomerId": ("customer_id", _value),
+    "CustomerAddress": ("customer_address", _address),
+    "CustomerAddressRecipient": ("customer_address_recipient", _value),
+    "InvoiceId": ("invoice_id", _value),
+    "InvoiceDate": ("invoice_date", _date),
+    "InvoiceTotal": ("invoice_total", _currency),
+    "DueDate": ("due_date", _date),
+    "PurchaseOrder": ("purchase_order", _value),
+    "BillingAddress": ("billing_address", _address),
+    "BillingAddressRecipient": ("billing_address_recipient", _value),
+    "ShippingAddress": ("shipping_address", _address),
+    "ShippingAddressRecipient": ("shipping_address_recipient", _value),
+    "SubTotal": ("subtotal", _currency),
+    "TotalTax": ("total_tax", _currency),
+    "PreviousUnpaidBalance": ("previous_unpaid_balance", _currency),
+    "AmountDue": ("amount_due", _currency),
+    "ServiceStartDate": ("service_start_date", _date),
+    "ServiceEndDate": ("service_end_date", _date),
+    "ServiceAddress": ("service_address", _address),
+    "ServiceAddressRecipient": ("service_address_recipient", _value),
+    "RemittanceAddress": ("remittance_address", _address),
+    "RemittanceAddressRecipient": ("remittance_address_recipient", _value),
+}
+
+INVOICE_ITEM_FIELDS = {
+    "Description": ("description", _value),
+    "Quantity": ("quantity", _value),
+    "Unit": ("unit", _value),
+    "UnitPrice": ("unit_price", _currency),
+    "ProductCode": ("product_code", _value),
+    "Date": ("date", _date),
+    "Tax": ("tax", _currency),
+    "Amount": ("amount", _currency),
+}
+
+RECEIPT_FIELDS = {
+    "MerchantName": ("merchant_name", _value),
+    "TransactionDate": ("transaction_date", _date),
+    "Subtotal": ("subtotal", _currency),
+    "TotalTax": ("total_tax", _currency),
+    "Tip": ("tip", _currency),
+    "Total": ("total", _currency),
+}
+
+RECEIPT_ITEM_FIELDS = {
+    "Description": ("description", _value),
+    "Quantity": ("quantity", _value),
+    "Price": ("price", _currency),
+    "TotalPrice": ("total_price", _currency),
+}
+
+
+def _compile(fields):
+    return [(field, key, key + "_confidence", convert) for field, (key, convert) in fields.items()]
+
+
+def _compile_items(fields):
+    # Item fields become columns, with one confidence per item rather than per value
+    return [(field, key, convert) for field, (key, convert) in fields.items()]
+
+
+SCHEMAS = {
+    "prebuilt-invoice": (_compile(INVOICE_FIELDS), _compile_items(INVOICE_ITEM_FIELDS)),
+    "prebuilt-receipt": (_compile(RECEIPT_FIELDS), _compile_items(RECEIPT_ITEM_FIELDS)),
+}
+
+# The field that tells documents of a model apart. At the start of a page range, a document without
+# it, or with the same value as the last document of the previous range, is the rest of that document.
+DOCUMENT_IDS = {
+    "prebuilt-invoice": "invoice_id",
+}
+
+# Uncompiled tables, for upgrade()
+TABLES = {
+    "prebuilt-invoice": (INVOICE_FIELDS, INVOICE_ITEM_FIELDS),
+    "prebuilt-receipt": (RECEIPT_FIELDS, RECEIPT_ITEM_FIELDS),
+}
+
+
+def content_fingerprint(content):
+    # Whitespace and case differences in the OCR text do not change the fingerprint
+    text = _whitespace.sub(" ", content or "").strip().lower()
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def _set_currency(data, value):
+    # The first currency code found is the document currency
+    code = getattr(value, "code", None)
+    if code and "currency" not in data:
+        data["currency"] = code
+
+
+def _extract_fields(fields, compiled, data):
+    for field_name, key, confidence_key, convert in compiled:
+        field = fields.get(field_name)
+        if not field:
+            continue
+        data[key] = None if field.value is None else convert(field.value)
+        data[confidence_key] = field.confidence
+        _set_currency(data, field.value)
+
+
+def _extract_items(items, compiled, data):
+    columns = {}
+    for idx, item in enumerate(items):
+        for field_name, key, convert in compiled:
+            field = (item.value or {}).get(field_name)
+            if not field or field.value is None:
+                continue
+            columns.setdefault(key, [None] * len(items))[idx] = convert(field.value)
+            _set_currency(data, field.value)
+    if items:
+        columns["confidence"] = [item.confidence for item in items]
+    return columns
+
+
+def _extract_document(document, fields_schema, items_schema):
+    data = {}
+    _extract_fields(document.fields, fields_schema, data)
+    item_list = document.fields.get("Items")
+    data["items"] = _extract_items(item_list.value if item_list and item_list.value else [], items_schema, data)
+    return data
+
+
+def _continue(data, rest):
+    # Fields only found on the later pages fill the gaps, their line items are appended
+    for key, value in rest.items():
+        if key == "items" or key.endswith("_confidence") or value is None or data.get(key) is not None:
+            continue
+        data[key] = value
+        if key + "_confidence" in rest:
+            data[key + "_confidence"] = rest[key + "_confidence"]
+    items, more = data["items"], rest["items"]
+    count, more_count = len(items.get("confidence", [])), len(more.get("confidence", []))
+    data["items"] = {column: items.get(column, [None] * count) + more.get(column, [None] * more_count) for column in list(items) + [column for column in more if column not in items]}
+
+
+def extract(model_id, result):
+    # Convert an AnalyzeResult from one of the prebuilt models into the dictionary saved to Cosmos DB.
+    # result can also be the list of results of consecutive page ranges of one file, from
+    # pipeline.analyze_document(), which are merged in page order.
+    results = result if isinstance(result, list) else [result]
+    fields_schema, items_schema = SCHEMAS[model_id]
+    document_id = DOCUMENT_IDS.get(model_id)
+    content = "\n".join(str(part.content) for part in results)
+    data = {"schema_version": SCHEMA_VERSION, "content": content, "content_fingerprint": content_fingerprint(content)}
+
+    documents = []
+    for part in results:
+        for idx, document in enumerate(part.documents):
+            extracted = _extract_document(document, fields_schema, items_schema)
+            if idx == 0 and documents and document_id and extracted.get(document_id) in (None, documents[-1].get(document_id)):
+                _continue(documents[-1], extracted)
+            else:
+                documents.append(extracted)
+
+    if documents:
+        data.update(documents[0])
+    if len(documents) > 1:
+        data["additional_documents"] = documents[1:]
+    return data
+
+
+def documents(data):
+    # Every document of the extracted data of a file, the one at the top level first
+    first = {key: value for key, value in data.items() if key != "additional_documents"}
+    return [first] + list(data.get("additional_documents") or [])
+
+
+def parse_amount(text):
+    # Version 1 amounts: "USD $2624.99" -> ("USD", 2624.99), "€11.7" -> ("EUR", 11.7), "12.5" -> (None, 12.5)
+    # and the DocumentField repr of receipt item prices. (None, None) when text is not an amount.
+    if isinstance(text, (int, float)):
+        return None, text
+    if isinstance(text, dict) and isinstance(text.get("amount"), (int, float)):
+        return text.get("code") or _currency_symbols.get(text.get("symbol")), text["amount"]
+    text = str(text).strip() if text is not None else ""
+    field = _v1_field_amount.search(text)
+    if field:
+        code = field.group(3) if field.group(3) != "None" else None
+        return code or _currency_symbols.get(field.group(2)), float(field.group(1))
+    match = _v1_amount.match(text)
+    if not match or (match.group(2) and match.group(2) != "$" and match.group(2) not in _currency_symbols):
+        return None, None
+    code = match.group(1) if match.group(1) != "None" else None
+    return code or _currency_symbols.get(match.group(2)), float(match.group(3).replace(",", ""))
+
+
+def _upgrade_value(data, convert, value):
+    if value is None:
+        return None
+    if convert is _currency:
+        code, amount = parse_amount(value)
+        if amount is None:
+            # Kept as saved, see unparsed_amounts()
+            return value
+        if code and "currency" not in data:
+            data["currency"] = code
+        return amount
+    if convert is _date:
+        try:
+            return datetime.datetime.strptime(value, "%B %d, %Y").date().isoformat()
+        except (TypeError, ValueError):
+            return value
+    return value
+
+
+def unparsed_amounts(model_id, data):
+    # Amount fields of upgraded data still holding the version 1 value, because upgrade() could not
+    # read an amount from it
+    fields, item_fields = TABLES[model_id]
+    names = [key for key, convert in fields.values() if convert is _currency and data.get(key) is not None and not isinstance(data.get(key), (int, float))]
+    items = data.get("items") or {}
+    names += ["items." + key for key, convert in item_fields.values()
+              if convert is _currency and any(value is not None and not isinstance(value, (int, float)) for value in items.get(key) or [])]
+    return names
+
+
+def upgrade(model_id, data):
+    # Convert extracted data saved by an earlier schema version to the current one. The result may
+    # still hold the OCR text in "content". Anything that is not version 1 data is returned as is.
+    if not isinstance(data, dict) or data.get("schema_version", 1) != 1:
+        return data
+    fields, item_fields = TABLES[model_id]
+    converters = {key: convert for key, convert in fields.values()}
+    item_converters = {key: convert for key, convert in item_fields.values()}
+
+    upgraded = {"schema_version": SCHEMA_VERSION}
+    for key, value in data.items():
+        if key != "items":
+            upgraded[key] = _upgrade_value(upgraded, converters.get(key), value)
+    if "content" in data:
+        upgraded["content_fingerprint"] = content_fingerprint(data["content"])
+
+    # "item_3_unit_price" -> items["unit_price"][3]. Version 1 has a confidence per value, the
+    # confidence of an item is the lowest of them.
+    values, confidences = {}, {}
+    for key, value in (data.get("items") or {}).items():
+        match = _v1_item_key.match(key)
+        if not match:
+            continue
+        idx, name = int(match.group(1)), match.group(2)
+        if name.endswith("_confidence"):
+            if value is not None:
+                confidences[idx] = min(confidences.get(idx, value), value)
+        else:
+            values[(idx, name)] = value
+    count = max([idx + 1 for idx, _ in values] + [idx + 1 for idx in confidences], default=0)
+    columns = {}
+    for (idx, name), value in sorted(values.items()):
+        if value is not None:
+            columns.setdefault(name, [None] * count)[idx] = _upgrade_value(upgraded, item_converters.get(name), value)
+    if count:
+        columns["confidence"] = [confidences.get(idx) for idx in range(count)]
+    upgraded["items"] = columns
+    return upgraded
@@ -1,20 +1,27 @@
 import azure.functions as func
+from azure.core import MatchConditions
+from azure.cosmos.exceptions import CosmosAccessConditionFailedError
 import logging
 import re
 import json
-import os
-from openai import AzureOpenAI
-from azure.core.credentials import AzureKeyCredential
-from azure.ai.formrecognizer import DocumentAnalysisClient
-from azure.storage.blob import BlobClient
-from azure.cosmos import CosmosClient, PartitionKey
+import time
+import asyncio
+import cache
+import clients
+import comparison
+import prematch
+import extraction
+import duplicates
+import idempotency
+import imaging
+import pipeline
+import telemetry
 
 app = func.FunctionApp()
 
 @app.blob_trigger(arg_name="inblobtrig", path="invoice/{name}", connection="mfdocintell_STORAGE")
-@app.blob_output(arg_name="outputblob", path="processed/{name}", connection="mfdocintell_STORAGE")
 
-def invoice(inblobtrig: func.InputStream, outputblob: func.Out[str]):
+async def invoice(inblobtrig: func.InputStream):
     
     # Extract the invoice number from the blob name
     application_number = re.search(r'^invoice\/(\d+)-invoice\.pdf$', inblobtrig.name).group(1)
@@ -23,243 +30,46 @@ def invoice(inblobtrig: func.InputStream, outputblob: func.Out[str]):
     # Future feature: Check document type using Document Intelligence Custom Classification model. If not invoice, alert ops team.
     # https://learn.microsoft.com/en-us/azure/ai-services/document-intelligence/concept-custom-classifier?view=doc-intel-4.0.0
 
-    # Call the AI model to extract the invoice data
-    endpoint = os.getenv("docintell_endpoint")
-    key = os.getenv("docintell_key")
+    # Every stage is timed and tagged with the application number
+    with telemetry.invocation("invoice", application_number):
 
-    document_analysis_client = DocumentAnalysisClient(endpoint=endpoint, credential=AzureKeyCredential(key))
-    poller = document_analysis_client.begin_analyze_document_from_url("prebuilt-invoice", inblobtrig.uri)
-    invoices = poller.result()
+        # Call the AI model to extract the invoice data, unless this exact file has been analysed before
+        with telemetry.span("read"):
+            invoice_bytes = inblobtrig.read()
+        # A large PDF is analysed as page ranges at the same time
+        with telemetry.span("analyze"):
+            invoices = await pipeline.analyze_document("prebuilt-invoice", inblobtrig.uri, invoice_bytes)
 
-    invoice_data = {}
+        # Convert the extracted invoice fields into a dictionary, each invoice of a bundle is kept separate
+        with telemetry.span("extract"):
+            invoice_data = extraction.extract("prebuilt-invoice", invoices)
 
-    # Pre generated invoice URI after its been processed
-    storage_config_str = os.getenv("mfdocintell_STORAGE")
-    key_value_pairs = storage_config_str.split(';')
-    storage_account_name = key_value_pairs[1].split('=')[1]
-    storage_account_suffix = key_value_pairs[3].split('=')[1]
-    invoice_data["invoice_uri"] = "https://" + storage_account_name + ".blob." + storage_account_suffix + "/processed/" + blob_name
-    
-    invoice_data["content"] = str(invoices.content)
-
-    # Loop through the extracted invoice data and save it to a dictionary
-    for idx, invoice in enumerate(invoices.documents):
-        vendor_name = invoice.fields.get("VendorName")
-        if vendor_name:
-            invoice_data["vendor_name"] = vendor_name.value
-            invoice_data["vendor_name_confidence"] = vendor_name.confidence
- 
-        vendor_address = invoice.fields.get("VendorAddress")
-        if vendor_address:
-            invoice_data["vendor_address"] = str(vendor_address.value)
-            invoice_data["vendor_address_confidence"] = vendor_address.confidence
-
-        vendor_address_recipient = invoice.fields.get("VendorAddressRecipient")
-        if vendor_address_recipient:
-            invoice_data["vendor_address_recipient"] = vendor_address_recipient.value
-            invoice_data["vendor_address_recipient_confidence"] = vendor_address_recipient.confidence
-
-        customer_name = invoice.fields.get("CustomerName")
-        if customer_name:
-            invoice_data["customer_name"] = customer_name.value
-            invoice_data["customer_name_confidence"] = customer_name.confidence
-
-        customer_id = invoice.fields.get("CustomerId")
-        if customer_id:
-            invoice_data["customer_id"] = customer_id.value
-            invoice_data["customer_id_confidence"] = customer_id.confidence
-
-        customer_address = invoice.fields.get("CustomerAddress")
-        if customer_address:
-            invoice_data["customer_address"] = customer_address.value
-            invoice_data["customer_address_confidence"] = customer_address.confidence
-
-        customer_address_recipient = invoice.fields.get("CustomerAddressRecipient")
-        if customer_address_recipient:
-            invoice_data["customer_address_recipient"] = str(customer_address_recipient.value)
-            invoice_data["customer_address_recipient_confidence"] = customer_address_recipient.confidence
-
-        invoice_id = invoice.fields.get("InvoiceId")
-        if invoice_id:
-            invoice_data["invoice_id"] = invoice_id.value
-            invoice_data["invoice_id_confidence"] = invoice_id.confidence
-
-        invoice_date = invoice.fields.get("InvoiceDate")
-        if invoice_date:
-            invoice_data["invoice_date"] = invoice_date.value.strftime("%B %d, %Y")
-            invoice_data["invoice_date_confidence"] = invoice_date.confidence
-
-        invoice_total = invoice.fields.get("InvoiceTotal")
-        if invoice_total:
-            invoice_data["invoice_total"] = str(invoice_total.value.code) + " $" + str(invoice_total.value.amount)
-            invoice_data["invoice_total_confidence"] = invoice_total.confidence
-
-        due_date = invoice.fields.get("DueDate")
-        if due_date:
-            invoice_data["due_date"] = due_date.value
-            invoice_data["due_date_confidence"] = due_date.confidence
-
-        purchase_order = invoice.fields.get("PurchaseOrder")
-        if purchase_order:
-            invoice_data["purchase_order"] = purchase_order.value
-            invoice_data["purchase_order_confidence"] = purchase_order.confidence
-
-        billing_address = invoice.fields.get("BillingAddress")
-        if billing_address:
-            invoice_data["billing_address"] = str(billing_address.value)
-            invoice_data["billing_address_confidence"] = billing_address.confidence
-
-        billing_address_recipient = invoice.fields.get("BillingAddressRecipient")
-        if billing_address_recipient:
-            invoice_data["billing_address_recipient"] = billing_address_recipient.value
-            invoice_data["billing_address_recipient_confidence"] = billing_address_recipient.confidence
-
-        shipping_address = invoice.fields.get("ShippingAddress")
-        if shipping_address:
-            invoice_data["shipping_address"] = shipping_address.value
-            invoice_data["shipping_address_confidence"] = shipping_address.confidence
-
-        shipping_address_recipient = invoice.fields.get("ShippingAddressRecipient")
-        if shipping_address_recipient: 
-            invoice_data["shipping_address_recipient"] = shipping_address_recipient.value
-            invoice_data["shipping_address_recipient_confidence"] = shipping_address_recipient.confidence
-
-        items = {}
-        for idx, item in enumerate(invoice.fields.get("Items").value):
-            item_description = item.value.get("Description")
-            if item_description:
-                items[f"item_{idx}_description"] = item_description.value
-                items[f"item_{idx}_description_confidence"] = item_description.confidence
-
-            item_quantity = item.value.get("Quantity")
-            if item_quantity:
-                items[f"item_{idx}_quantity"] = item_quantity.value
-                items[f"item_{idx}_quantity_confidence"] = item_quantity.confidence
-
-            unit = item.value.get("Unit")
-            if unit:
-                items[f"item_{idx}_unit"] = unit.value
-                items[f"item_{idx}_unit_confidence"] = unit.confidence
-
-            unit_price = item.value.get("UnitPrice")
-            if unit_price:
-                items[f"item_{idx}_unit_price"] = str(unit_price.value.code) + " $" + str(unit_price.value.amount)
-                items[f"item_{idx}_unit_price_confidence"] = unit_price.confidence
-
-            product_code = item.value.get("ProductCode")
-            if product_code:
-                items[f"item_{idx}_product_code"] = product_code.value
-                items[f"item_{idx}_product_code_confidence"] = product_code.confidence
-
-            item_date = item.value.get("Date")
-            if item_date:
-                items[f"item_{idx}_date"] = item_date.value
-                items[f"item_{idx}_date_confidence"] = item_date.confidence
-
-            tax = item.value.get("Tax")
-            if tax:
-                items[f"item_{idx}_tax"] = str(tax.value.code) + " $" + str(tax.value.amount)
-                items[f"item_{idx}_tax_confidence"] = tax.confidence
-
-            amount = item.value.get("Amount")
-            if amount:
-                items[f"item_{idx}_amount"] = str(amount.value.code) + " $" + str(amount.value.amount)
-                items[f"item_{idx}_amount_confidence"] = amount.confidence
-
-        subtotal = invoice.fields.get("SubTotal")
-        if subtotal:
-            invoice_data["subtotal"] = str(subtotal.value.code) + " $" + str(subtotal.value.amount)
-            invoice_data["subtotal_confidence"] = subtotal.confidence
-
-        total_tax = invoice.fields.get("TotalTax")
-        if total_tax:
-            invoice_data["total_tax"] = str(total_tax.value.code) + " $" + str(total_tax.value.amount)
-            invoice_data["total_tax_confidence"] = total_tax.confidence
-        
-        previous_unpaid_balance = invoice.fields.get("PreviousUnpaidBalance")
-        if previous_unpaid_balance:
-            invoice_data["previous_unpaid_balance"] = previous_unpaid_balance.value
-            invoice_data["previous_unpaid_balance_confidence"] = previous_unpaid_balance.confidence
-
-        amount_due = invoice.fields.get("AmountDue")
-        if amount_due:
-            invoice_data["amount_due"] = amount_due.value
-            invoice_data["amount_due_confidence"] = amount_due.confidence
-        
-        service_start_date = invoice.fields.get("ServiceStartDate")
-        if service_start_date:
-            invoice_data["service_start_date"] = service_start_date.value
-            invoice_data["service_start_date_confidence"] = service_start_date.confidence
-
-        service_end_date = invoice.fields.get("ServiceEndDate")
-        if service_end_date:
-            invoice_data["service_end_date"] = service_end_date.value
-            invoice_data["service_end_date_confidence"] = service_end_date.confidence
-
-        service_address = invoice.fields.get("ServiceAddress")
-        if service_address:
-            invoice_data["service_address"] = service_address.value
-            invoice_data["service_address_confidence"] = service_address.confidence
-
-        service_address_recipient = invoice.fields.get("ServiceAddressRecipient")
-        if service_address_recipient:
-            invoice_data["service_address_recipient"] = service_address_recipient.value
-            invoice_data["service_address_recipient_confidence"] = service_address_recipient.confidence
-
-        remittance_address = invoice.fields.get("RemittanceAddress")
-        if remittance_address:
-            invoice_data["remittance_address"] = remittance_address.value
-            invoice_data["remittance_address_confidence"] = remittance_address.confidence
-
-        remittance_address_recipient = invoice.fields.get("RemittanceAddressRecipient")
-        if remittance_address_recipient:
-            invoice_data["remittance_address_recipient"] = remittance_address_recipient.value
-            invoice_data["remittance_address_recipient_confidence"] = remittance_address_recipient.confidence
-
-        invoice_data["items"] = items
-
-    invoice_data["invoice_status"] = "Invoice processed successfully." 
-
-    # Save extracted invoice data to Cosmos DB
-    #doc = next((x for x in inputDocument if x["id"] == application_number), None)
-    #doc.data["invoice"] = invoice_data
-
-    #if doc.get("receipt"):
-    #    doc.data["receipt"] = doc.get("receipt")
-
-    # Get cosmosdb record and replace the updated document to Cosmos DB if _etag matches
-    client = CosmosClient.from_connection_string(os.getenv("cosmosdb_config"))
-    database = client.get_database_client("ToDoList")
-    container = database.get_container_client("docs")
-    doc = container.read_item(item=application_number, partition_key=application_number)
-    item_etag = doc["_etag"]
-    doc["invoice"] = invoice_data
-    try:
-        container.replace_item(doc, doc, if_match=item_etag)
-    except:
-        doc = container.read_item(item=application_number, partition_key=application_number)
-        item_etag = doc["_etag"]
-        doc["invoice"] = invoice_data
-        container.replace_item(doc, doc, if_match=item_etag)
+        # Pre generated invoice URI after its been processed
+        invoice_data["invoice_uri"] = clients.processed_blob_uri(blob_name)
 
-    # Save the updated document to Cosmos DB if _etag matches
-    #####
-    #outputDocument.set(doc)
+        invoice_data["invoice_status"] = "Invoice processed successfully." 
 
-    # Move the blob to the processed container
-    outputblob.set(inblobtrig.read())
+        # Look for the same invoice in other applications, rescans and photos of it included
+        with telemetry.span("duplicates"):
+            invoice_data["duplicates"] = await duplicates.check("invoice", "prebuilt-invoice", application_number, invoice_data)
 
-    # delete the original blob
-    blob_name = re.search(r'/(\d+-invoice\.pdf)$', inblobtrig.name).group(1)
-    blob_client = BlobClient.from_connection_string(os.getenv("mfdocintell_STORAGE"), "invoice", blob_name)
-    blob_client.delete_blob()
+        # Keep the OCR text in blob storage, the Cosmos DB document only has its URI
+        with telemetry.span("store_content"):
+            await pipeline.store_content(invoice_data)
+
+        # Save extracted invoice data to Cosmos DB
+        with telemetry.span("save"):
+            await pipeline.save_to_application(application_number, "invoice", invoice_data)
+
+        # Move the blob to the processed container with a server side copy, then delete the original
+        with telemetry.span("move"):
+            await pipeline.move_blob("invoice", blob_name)
 
     return
 
 @app.blob_trigger(arg_name="recblobtrig", path="receipt/{name}", connection="mfdocintell_STORAGE")
-@app.blob_output(arg_name="outputblob", path="processed/{name}", connection="mfdocintell_STORAGE")
 
-def receipt(recblobtrig: func.InputStream, outputblob: func.Out[str]):
+async def receipt(recblobtrig: func.InputStream):
     
     # Extract the receipt number from the blob name
     application_number = re.search(r'^receipt\/(\d+)-receipt\.[A-Za-z]+$', recblobtrig.name).group(1)
@@ -268,146 +78,185 @@ def receipt(recblobtrig: func.InputStream, outputblob: func.Out[str]):
     # Future feature: Check document type using Document Intelligence Custom Classification model. If not receipt, alert ops team.
     # https://learn.microsoft.com/en-us/azure/ai-services/document-intelligence/concept-custom-classifier?view=doc-intel-4.0.0
 
-    # Call the AI model to extract the receipt data
-    endpoint = os.getenv("docintell_endpoint")
-    key = os.getenv("docintell_key")
+    # Every stage is timed and tagged with the application number
+    with telemetry.invocation("receipt", application_number):
+
+        # Call the AI model to extract the receipt data, unless this exact file has been analysed before
+        with telemetry.span("read"):
+            receipt_bytes = recblobtrig.read()
+        # Optionally shrink photos and scans first, they are then sent to the model as bytes
+        prepared = None
+        if imaging.enabled():
+            with telemetry.span("preprocess"):
+                prepared = await asyncio.to_thread(imaging.preprocess, receipt_bytes)
+        with telemetry.span("analyze"):
+            if prepared is not None:
+                logging.info("Receipt of application %s preprocessed: %s", application_number, prepared[1])
+                receipts = await pipeline.analyze("prebuilt-receipt", None, prepared[0])
+            else:
+                receipts = await pipeline.analyze("prebuilt-receipt", recblobtrig.uri, receipt_bytes)
+
+        # Convert the extracted receipt fields into a dictionary
+        with telemetry.span("extract"):
+            receipt_data = extraction.extract("prebuilt-receipt", receipts)
+
+        # Pre generated receipt URI after its been processed
+        receipt_data["receipt_uri"] = clients.processed_blob_uri(blob_name)
+
+        receipt_data["receipt_status"] = "Receipt processed successfully." 
+
+        # Look for the same receipt in other applications, rescans and photos of it included
+        with telemetry.span("duplicates"):
+            receipt_data["duplicates"] = await duplicates.check("receipt", "prebuilt-receipt", application_number, receipt_data)
+
+        # Keep the OCR text in blob storage, the Cosmos DB document only has its URI
+        with telemetry.span("store_content"):
+            await pipeline.store_content(receipt_data)
+
+        # Save extracted receipt data to Cosmos DB
+        with telemetry.span("save"):
+            await pipeline.save_to_application(application_number, "receipt", receipt_data)
+
+        # Move the blob to the processed container with a server side copy, then delete the original
+        with telemetry.span("move"):
+            await pipeline.move_blob("receipt", blob_name)
 
-    document_analysis_client = DocumentAnalysisClient(endpoint=endpoint, credential=AzureKeyCredential(key))
-    poller = document_analysis_client.begin_analyze_document_from_url("prebuilt-receipt", recblobtrig.uri)
-    receipts = poller.result()
+    return
 
-    receipt_data = {}
+@app.cosmos_db_trigger(arg_name="costrig", connection="cosmosdb_config", database_name="ToDoList", container_name="docs", lease_container_name="leases", create_lease_container_if_not_exists=True)
+@app.retry(strategy="exponential_backoff", max_retry_count="5", minimum_interval="00:00:10", maximum_interval="00:05:00")
+
+async def fraud(costrig: func.DocumentList, context: func.Context):
+    # Most changes need no comparison: the intake record, the first of the two extractions and the
+    # comparison this function writes back. Drop them before any other work.
+    pending = _actionable(costrig)
+    if len(pending) < len(costrig):
+        telemetry.count("changefeed_skipped", len(costrig) - len(pending), function="fraud")
+    if not pending:
+        return
+    with telemetry.invocation("fraud"):
+        await _compare_documents(pending, context)
+
+
+def _actionable(costrig):
+    # (document, input fingerprint) of the applications with both an invoice and a receipt that have
+    # not been compared in their current form. Applications compared before comparison_input was
+    # saved are left alone.
+    pending = []
+    for doc in costrig:
+        if not doc.get("invoice") or not doc.get("receipt"):
+            continue
+        if doc.get("comparison") and doc.get("comparison_input") is None:
+            continue
+        fingerprint = idempotency.input_fingerprint(doc.get("invoice"), doc.get("receipt"))
+        if fingerprint != doc.get("comparison_input") or not doc.get("comparison"):
+            pending.append((doc, fingerprint))
+    return pending
 
-    # Pre generated receipt URI after its been processed
-    storage_config_str = os.getenv("mfdocintell_STORAGE")
-    key_value_pairs = storage_config_str.split(';')
-    storage_account_name = key_value_pairs[1].split('=')[1]
-    storage_account_suffix = key_value_pairs[3].split('=')[1]
-    receipt_data["receipt_uri"] = "https://" + storage_account_name + ".blob." + storage_account_suffix + "/processed/" + blob_name
-    
-    receipt_data["content"] = str(receipts.content)
-
-    # Loop through the extracted receipt data and save it to a dictionary
-    for idx, receipt in enumerate(receipts.documents):
-        merchant_name = receipt.fields.get("MerchantName")
-        if merchant_name:
-            receipt_data["merchant_name"] = merchant_name.value
-            receipt_data["merchant_name_confidence"] = merchant_name.confidence
- 
-        transaction_date = receipt.fields.get("TransactionDate")
-        if transaction_date:
-            receipt_data["transaction_date"] = transaction_date.value.strftime("%B %d, %Y")
-            receipt_data["transaction_date_confidence"] = transaction_date.confidence
-
-        if receipt.fields.get("Items"):
-            items = {}
-            for idx, item in enumerate(receipt.fields.get("Items").value):
-                item_description = item.value.get("Description")
-                if item_description:
-                    items[f"item_{idx}_description"] = item_description.value
-                    items[f"item_{idx}_description_confidence"] = item_description.confidence
-
-                item_quantity = item.value.get("Quantity")
-                if item_quantity:
-                    items[f"item_{idx}_quantity"] = item_quantity.value
-                    items[f"item_{idx}_quantity_confidence"] = item_quantity.confidence
-
-                item_price = item.value.get("Price")
-                if item_price:
-                    items[f"item_{idx}_price"] = str(item_price) + " $" + str(item_price.value.amount)
-                    items[f"item_{idx}_price_confidence"] = item_price.confidence
-
-                item_total_price = item.value.get("TotalPrice")
-                if item_total_price:
-                    items[f"item_{idx}_total_price"] = str(item_total_price.value)
-                    items[f"item_{idx}_total_price_confidence"] = item_total_price.confidence
-
-        subtotal = receipt.fields.get("Subtotal")
-        if subtotal:
-            receipt_data["subtotal"] = str(subtotal.value)
-            receipt_data["subtotal_confidence"] = subtotal.confidence
-
-        tax = receipt.fields.get("TotalTax")
-        if tax:
-            receipt_data["total_tax"] = str(tax.value)
-            receipt_data["total_tax_confidence"] = tax.confidence
-        
-        tip = receipt.fields.get("Tip")
-        if tip:
-            receipt_data["tip"] = str(tip.value)
-            receipt_data["tip_confidence"] = tip.confidence
-
-        total = receipt.fields.get("Total")
-        if total:
-            receipt_data["total"] = str(total.value)
-            receipt_data["total_confidence"] = total.confidence
-
-        receipt_data["items"] = items
-
-    receipt_data["receipt_status"] = "Receipt processed successfully." 
-
-    # Save extracted receipt data to Cosmos DB
-    #doc = next((x for x in recinputDocument if x["id"] == application_number), None)
-    #doc.data["receipt"] = receipt_data
-
-    #if doc.get("invoice"):
-    #    doc.data["invoice"] = doc.get("invoice")
-
-    #recoutputDocument.set(doc)
-
-    # Get cosmosdb record and replace the updated document to Cosmos DB if _etag matches
-    client = CosmosClient.from_connection_string(os.getenv("cosmosdb_config"))
-    database = client.get_database_client("ToDoList")
-    container = database.get_container_client("docs")
-    doc = container.read_item(item=application_number, partition_key=application_number)
-    item_etag = doc["_etag"]
-    doc["receipt"] = receipt_data
+
+async def _claim(store, application, fingerprint):
     try:
-        container.replace_item(doc, doc, if_match=item_etag)
-    except:
-        doc = container.read_item(item=application_number, partition_key=application_number)
-        item_etag = doc["_etag"]
-        doc["receipt"] = receipt_data
-        container.replace_item(doc, doc, if_match=item_etag)
+        return await store.claim(application, fingerprint)
+    except Exception as error:
+        # Rather compare twice than not at all while the idempotency store is unavailable
+        logging.warning("Idempotency claim failed for application %s: %s", application, error)
+        return idempotency.NEW, None
 
-    # Move the blob to the processed container
-    outputblob.set(recblobtrig.read())
 
-    # delete the original blob
-    blob_name = re.search(r'/(\d+-receipt\.[A-Za-z]+)$', recblobtrig.name).group(1)
-    blob_client = BlobClient.from_connection_string(os.getenv("mfdocintell_STORAGE"), "receipt", blob_name)
-    blob_client.delete_blob()
+async def _settle(store, application, fingerprint, result):
+    # Save the result of a claimed comparison, or drop the claim when it failed
+    try:
+        if isinstance(result, Exception):
+            await store.release(application, fingerprint)
+        else:
+            await store.complete(application, fingerprint, result)
+    except Exception as error:
+        logging.warning("Idempotency record not saved for application %s: %s", application, error)
 
-    return
 
-@app.cosmos_db_trigger(arg_name="costrig", connection="cosmosdb_config", database_name="ToDoList", container_name="docs")
-@app.cosmos_db_output(arg_name="compareDocument", database_name="ToDoList", container_name="docs", connection ="cosmosdb_config", lease_container_name="leases", create_if_not_exists=True)
+COMPARISON_FIELDS = ("prematch", "comparison_input", "comparison")
 
-def fraud(costrig: func.DocumentList, compareDocument: func.Out[func.Document]):
-    # Check to see if the document has both an invoice and receipt data
-    for doc in costrig:
-        if doc.get("invoice") and doc.get("receipt") and not doc.get("comparison"):
-            invoice_content = doc.get("invoice").get("content")
-            receipt_content = doc.get("receipt").get("content")
-            
-            # Use Azure Open AI to compare the content of the invoice and receipt
-            client = AzureOpenAI(
-                api_key = os.getenv("AZURE_OPENAI_API_KEY"),  
-                api_version = "2023-05-15",
-                azure_endpoint = os.getenv("AZURE_OPENAI_ENDPOINT")
-                )
-            
-            response = client.chat.completions.create(
-                model="gpt-4", # model = "deployment_name".
-                messages=[
-                    {"role": "system", "content": '''You are an AI assistant that helps audit invoices and receipts to make sure match. 
-                                                If the invoice and receipt do not match, state they do not match. Then explain the reasons why they do not match in bullet point form.
-                                                If the invoice and receipt do match, state they match. Then explain the reasons why they do match in bullet point form.'''},
-                    {"role": "user", "content": "Invoice: " + invoice_content + "\\n\\nReceipt: " + receipt_content},
-                ]
-            )
-
-            # Save the comparison results to Cosmos DB  
-            doc.data["comparison"] = response.choices[0].message.content
-            compareDocument.set(doc)
-    return
\ No newline at end of file
+
+async def _save_comparison(doc):
+    # Patch only the comparison fields, conditional on the etag of the version that was compared.
+    # A document written since then, e.g. a new receipt or a schema migration, is left alone: its
+    # newer version is on its way through the change feed and is compared in its own right.
+    # Returns False when the comparison could not be saved.
+    operations = [{"op": "set", "path": "/" + field, "value": doc.data[field]} for field in COMPARISON_FIELDS if field in doc.data]
+    condition = {"etag": doc.get("_etag"), "match_condition": MatchConditions.IfNotModified} if doc.get("_etag") else {}
+    try:
+        await pipeline.patch_application(doc.get("id"), operations, **condition)
+    except CosmosAccessConditionFailedError:
+        logging.info("Application %s changed since it was compared, the comparison of the newer version is kept", doc.get("id"))
+    except Exception as error:
+        logging.error("Saving the comparison of application %s failed: %s", doc.get("id"), error)
+        return False
+    return True
+
+
+async def _compare_documents(pending, context=None):
+    # Time from the last write of each application to this batch (_ts is the Cosmos DB write time in seconds)
+    now = time.time()
+    for doc, _ in pending:
+        if doc.get("_ts"):
+            telemetry.record("changefeed_lag_ms", (now - doc.get("_ts")) * 1000, application=doc.get("id"))
+
+    # Settle the clear matches and mismatches from the extracted fields without calling Azure Open AI.
+    # Applications saved before the current schema version are read through extraction.upgrade().
+    compared = []
+    ambiguous = []
+    for doc, fingerprint in pending:
+        invoice_data = extraction.upgrade("prebuilt-invoice", doc.get("invoice"))
+        receipt_data = extraction.upgrade("prebuilt-receipt", doc.get("receipt"))
+        with telemetry.span("prematch", application=doc.get("id")):
+            result = prematch.prematch_documents(extraction.documents(invoice_data), receipt_data)
+        doc.data["prematch"] = {"verdict": result["verdict"], "confidence": result["confidence"]}
+        doc.data["comparison_input"] = fingerprint
+        if result["verdict"] == prematch.AMBIGUOUS:
+            ambiguous.append((doc, fingerprint, (invoice_data, receipt_data)))
+        else:
+            doc.data["comparison"] = prematch.describe(result)
+            compared.append(doc)
+
+    # Claim each remaining application for its current invoice and receipt, so a redelivered batch
+    # or another host holding the lease reuses a finished comparison instead of paying for it again
+    store = idempotency.get_run_store()
+    claims = await asyncio.gather(*(_claim(store, doc.get("id"), fingerprint) for doc, fingerprint, _ in ambiguous))
+    claimed, busy = [], []
+    for (doc, fingerprint, pair), (status, result) in zip(ambiguous, claims):
+        if status == idempotency.DONE:
+            telemetry.count("comparisons_reused", application=doc.get("id"))
+            doc.data["comparison"] = result
+            compared.append(doc)
+        elif status == idempotency.BUSY:
+            busy.append(doc.get("id"))
+        else:
+            claimed.append((doc, fingerprint, pair))
+
+    # Use Azure Open AI to compare the content of the claimed invoices and receipts, several at a
+    # time. Each comparison is timed as its own "compare" stage.
+    pairs = [pair for _, _, pair in claimed]
+    labels = [doc.get("id") for doc, _, _ in claimed]
+    results = await comparison.compare_all(clients.get_async_openai_client(), pairs, comparison_cache=cache.get_comparison_cache(), labels=labels) if pairs else []
+    await asyncio.gather(*(_settle(store, doc.get("id"), fingerprint, result) for (doc, fingerprint, _), result in zip(claimed, results)))
+
+    failed = []
+    for (doc, _, _), result in zip(claimed, results):
+        if isinstance(result, Exception):
+            logging.error("Comparison failed for application %s: %s", doc.get("id"), result)
+            failed.append(doc.get("id"))
+            continue
+        doc.data["comparison"] = result
+        compared.append(doc)
+
+    # Save the comparisons at the same time, each to its own application
+    with telemetry.span("save"):
+        saved = await asyncio.gather(*(_save_comparison(doc) for doc in compared))
+    failed += [doc.get("id") for doc, ok in zip(compared, saved) if not ok]
+
+    # Fail the invocation while the retry policy has attempts left, so the batch is delivered again
+    # for the applications another invocation is comparing or that failed. The comparisons saved
+    # are not paid for again, their idempotency records are done.
+    retry = getattr(context, "retry_context", None)
+    if (busy or failed) and retry is not None and retry.retry_count < retry.max_retry_count:
+        raise RuntimeError("Comparison pending for applications %s, in progress elsewhere: %s" % (", ".join(failed) or "none", ", ".join(busy) or "none"))
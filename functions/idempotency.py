@@ -0,0 +1,168 @@
+import os
+import json
+import time
+import hashlib
+import threading
+from azure.core import MatchConditions
+from azure.cosmos.exceptions import CosmosAccessConditionFailedError, CosmosResourceExistsError, CosmosResourceNotFoundError
+import clients
+import extraction
+
+# Idempotency records of the fraud function, one per (application, input fingerprint), so an
+# application is compared by Azure Open AI once for a given invoice and receipt however often the
+# change feed delivers it: function retries, lease rebalancing between hosts, its own writes.
+#   claim()    - NEW: go ahead and compare, DONE: the saved result, BUSY: another invocation has it
+#   complete() - saves the result of a claimed comparison
+#   release()  - drops a claim after a failure, so a retry can compare again
+# A claim not completed within CLAIM_TIMEOUT is taken to be abandoned and can be claimed again.
+# Durable backend: the Cosmos DB container named by the fraud_runs_container app setting (partition
+# key /id, time to live on so records expire after RECORD_TTL). Set it to an empty value to keep
+# the records in memory, which only covers retries on the same host.
+
+NEW = "new"
+DONE = "done"
+BUSY = "busy"
+
+CLAIM_TIMEOUT = 600 # seconds
+RECORD_TTL = 30 * 24 * 60 * 60
+DEFAULT_CONTAINER = "fraud-runs"
+
+# Saved fields that do not change what is compared. The OCR text is identified by content_fingerprint
+# wherever it is stored, so moving it to blob storage does not change the fingerprint.
+_ignored = {"content", "content_uri", "content_length", "invoice_status", "receipt_status", "invoice_uri", "receipt_uri", "duplicates"}
+
+
+def _comparable(model_id, data):
+    return {key: value for key, value in extraction.upgrade(model_id, data).items() if key not in _ignored}
+
+
+def input_fingerprint(invoice, receipt):
+    # Fingerprint of the saved invoice and receipt data, the same for every schema version
+    text = json.dumps([_comparable("prebuilt-invoice", invoice), _comparable("prebuilt-receipt", receipt)], sort_keys=True, default=str)
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class MemoryRunBackend:
+    def __init__(self):
+        self.items = {}
+        self._lock = threading.Lock()
+
+    async def create(self, item):
+        with self._lock:
+            if item["id"] in self.items:
+                return False
+            self.items[item["id"]] = dict(item, _etag=os.urandom(8).hex())
+            return True
+
+    async def read(self, item_id):
+        with self._lock:
+            item = self.items.get(item_id)
+            return dict(item) if item is not None else None
+
+    async def replace(self, item, etag):
+        with self._lock:
+            current = self.items.get(item["id"])
+            if current is None or current["_etag"] != etag:
+                return False
+            self.items[item["id"]] = dict(item, _etag=os.urandom(8).hex())
+            return True
+
+    async def put(self, item):
+        with self._lock:
+            self.items[item["id"]] = dict(item, _etag=os.urandom(8).hex())
+
+    async def delete(self, item_id):
+        with self._lock:
+            self.items.pop(item_id, None)
+
+
+class CosmosRunBackend:
+    def __init__(self, container):
+        self.container = container
+
+    def _container(self):
+        return clients.get_async_container(self.container)
+
+    async def create(self, item):
+        try:
+            await self._container().create_item(item)
+            return True
+        except CosmosResourceExistsError:
+            return False
+
+    async def read(self, item_id):
+        try:
+            return await self._container().read_item(item=item_id, partition_key=item_id)
+        except CosmosResourceNotFoundError:
+            return None
+
+    async def replace(self, item, etag):
+        try:
+            await self._container().replace_item(item=item["id"], body=item, etag=etag, match_condition=MatchConditions.IfNotModified)
+            return True
+        except (CosmosAccessConditionFailedError, CosmosResourceNotFoundError):
+            return False
+
+    async def put(self, item):
+        await self._container().upsert_item(item)
+
+    async def delete(self, item_id):
+        try:
+            await self._container().delete_item(item=item_id, partition_key=item_id)
+        except CosmosResourceNotFoundError:
+            pass
+
+
+class RunStore:
+    def __init__(self, backend=None):
+        self.backend = backend if backend is not None else MemoryRunBackend()
+
+    @staticmethod
+    def _record(application, fingerprint, status, result=None):
+        record = {"id": application + "-" + fingerprint, "application": application, "fingerprint": fingerprint,
+                  "status": status, "claimed_at": time.time(), "ttl": RECORD_TTL}
+        if result is not None:
+            record["result"] = result
+        return record
+
+    async def claim(self, application, fingerprint):
+        # Returns (NEW, None), (DONE, saved result) or (BUSY, None)
+        record = self._record(application, fingerprint, "claimed")
+        if await self.backend.create(record):
+            return NEW, None
+        current = await self.backend.read(record["id"])
+        if current is None:
+            # Released in between
+            return (NEW if await self.backend.create(record) else BUSY), None
+        if current["status"] == "done":
+            return DONE, current.get("result")
+        if current["claimed_at"] + CLAIM_TIMEOUT > time.time():
+            return BUSY, None
+        # Abandoned by an invocation that stopped, take it over unless another invocation does first
+        return (NEW if await self.backend.replace(record, current["_etag"]) else BUSY), None
+
+    async def complete(self, application, fingerprint, result):
+        await self.backend.put(self._record(application, fingerprint, "done", result))
+
+    async def release(self, application, fingerprint):
+        await self.backend.delete(application + "-" + fingerprint)
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_run_store():
+    # Process-wide store used by the fraud function
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                container = os.getenv("fraud_runs_container", DEFAULT_CONTAINER)
+                _store = RunStore(CosmosRunBackend(container) if container else None)
+    return _store
+
+
+def set_run_store(store):
+    global _store
+    _store = store
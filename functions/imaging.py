@@ -0,0 +1,54 @@
+import io
+import os
+import logging
+
+# Optional preprocessing of receipt photos and scans before they are analysed. When the
+# receipt_preprocessing app setting is "true" an image is:
+#   - turned upright from its EXIF orientation, phone photos are often stored sideways
+#   - shrunk so its longest side is at most receipt_max_side pixels, Document Intelligence reads
+#     receipt text well below the resolution of a phone camera
+#   - converted to grayscale and recompressed as JPEG
+# and analysed from the bytes instead of by URL. PDFs, multi-page TIFFs, files Pillow cannot read
+# and images that would not get smaller are analysed as uploaded. HEIF needs pillow-heif.
+
+DEFAULT_MAX_SIDE = 2000
+JPEG_QUALITY = 80
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+try:
+    from pillow_heif import register_heif_opener
+    register_heif_opener()
+except ImportError:
+    pass
+
+
+def enabled():
+    return Image is not None and os.getenv("receipt_preprocessing", "false").lower() == "true"
+
+
+def preprocess(data, max_side=None):
+    # Returns (jpeg bytes, details), or None when the document is better analysed as it is
+    if Image is None or data.startswith(b"%PDF"):
+        return None
+    max_side = max_side or int(os.getenv("receipt_max_side", DEFAULT_MAX_SIDE))
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            if getattr(image, "n_frames", 1) > 1:
+                return None
+            original_size = image.size
+            image = ImageOps.exif_transpose(image).convert("L")
+            image.thumbnail((max_side, max_side), Image.LANCZOS)
+            output = io.BytesIO()
+            image.save(output, "JPEG", quality=JPEG_QUALITY, optimize=True)
+    except Exception as error:
+        # Leave unreadable files to the service, it reports what is wrong with them
+        logging.warning("Receipt preprocessing skipped: %s", error)
+        return None
+    prepared = output.getvalue()
+    if len(prepared) >= len(data):
+        return None
+    return prepared, {"original_bytes": len(data), "bytes": len(prepared), "original_size": original_size, "size": image.size}
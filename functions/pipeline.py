@@ -0,0 +1,204 @@
+import os
+import re
+import base64
+import random
+import asyncio
+import hashlib
+import logging
+from azure.core.exceptions import HttpResponseError
+from azure.core.polling.async_base_polling import AsyncLROBasePolling
+from azure.cosmos.exceptions import CosmosHttpResponseError
+from azure.storage.blob import BlobBlock
+import cache
+import clients
+import telemetry
+
+# Awaitable stages shared by the invoice and receipt functions: analyze -> persist -> move.
+# Everything runs on the async Azure clients so one worker can keep many documents in flight
+# instead of pinning a thread on each Document Intelligence long running operation.
+
+POLL_INITIAL = 0.5 # seconds before the first status check
+POLL_FACTOR = 1.5
+POLL_MAX = 5.0
+COPY_POLL_INTERVAL = 0.5 # seconds between checks on a pending server side copy
+PATCH_MAX_ATTEMPTS = 5
+PATCH_BASE_DELAY = 0.1
+PATCH_MAX_DELAY = 2.0
+# Request timeout, retry with (concurrent patch conflict), service unavailable. A precondition failure
+# (412) is not retried: the etag it was sent with stays stale, the caller has to read the document again.
+PATCH_RETRY_STATUS = (408, 449, 503)
+DEFAULT_CONTENT_CONTAINER = "content"
+SPLIT_MIN_PAGES = 20 # PDFs with at least this many pages are analysed as page ranges
+SPLIT_PAGES = 10 # pages per range
+SPLIT_MAX_RANGES = 8 # ranges of one document analysed at the same time, ranges grow past SPLIT_PAGES to stay under it
+
+# Page count of a PDF: /Count of the page tree, or the number of page objects
+_pdf_page_tree = re.compile(rb"/Type\s*/Pages\b[^>]*?/Count\s+(\d+)|/Count\s+(\d+)[^>]*?/Type\s*/Pages\b")
+_pdf_page = re.compile(rb"/Type\s*/Page\b")
+
+
+class AdaptivePolling(AsyncLROBasePolling):
+    # Poll often while a small document is likely to finish, then back off for long analyses.
+    # A Retry-After from the service is honoured when it asks for a longer wait than POLL_MAX.
+    def __init__(self, initial=POLL_INITIAL, factor=POLL_FACTOR, maximum=POLL_MAX, **kwargs):
+        super().__init__(timeout=initial, **kwargs)
+        self._next_delay = initial
+        self._factor = factor
+        self._maximum = maximum
+
+    def _extract_delay(self):
+        delay = self._next_delay
+        self._next_delay = min(self._next_delay * self._factor, self._maximum)
+        # The base class returns the Retry-After header, or the initial interval when there is none
+        retry_after = super()._extract_delay()
+        return retry_after if retry_after > self._maximum else delay
+
+
+def _polling():
+    return AdaptivePolling(path_format_arguments={"endpoint": os.getenv("docintell_endpoint")})
+
+
+async def analyze(model_id, document_url, data, throttle=None, pages=None):
+    # Return the analysis of the document at document_url, whose content is data, from the analysis
+    # cache or by running the model on a miss. The cache backend blocks, so it runs in a thread.
+    # Without a document_url the bytes are sent to the service, e.g. for local files. throttle is
+    # awaited before the model is run, so rate limits only apply to cache misses. pages, e.g. "1-10",
+    # only analyses those pages.
+    analysis_cache = cache.get_analysis_cache()
+    sha256 = hashlib.sha256(data).hexdigest()
+    key = cache.AnalysisCache.key(model_id, clients.DOCINTELL_API_VERSION, sha256 + ("-p" + pages if pages else ""))
+    with telemetry.span("analysis_cache_read"):
+        result = await asyncio.to_thread(analysis_cache.get, key)
+    if result is None:
+        if throttle is not None:
+            await throttle()
+        with telemetry.span("analysis_lro", model=model_id, pages=pages):
+            document_analysis_client = clients.get_async_document_analysis_client()
+            if document_url is None:
+                poller = await document_analysis_client.begin_analyze_document(model_id, data, pages=pages, polling=_polling())
+            else:
+                poller = await document_analysis_client.begin_analyze_document_from_url(model_id, document_url, pages=pages, polling=_polling())
+            result = await poller.result()
+        await asyncio.to_thread(analysis_cache.put, key, result)
+    logging.info("Analysis cache %s", analysis_cache.stats())
+    return result
+
+
+def page_count(data):
+    # Pages of a PDF, None when data is not a PDF or its page tree is in a compressed object stream.
+    # Only used to decide whether to split the document, the service counts the pages itself.
+    if not data.startswith(b"%PDF"):
+        return None
+    counts = [int(tree or reverse) for tree, reverse in _pdf_page_tree.findall(data)]
+    if counts:
+        return max(counts)
+    return len(_pdf_page.findall(data)) or None
+
+
+def page_ranges(pages):
+    # ["1-10", "11-20", ...] for a document with enough pages to split, otherwise [None]
+    if not pages or pages < int(os.getenv("split_min_pages", SPLIT_MIN_PAGES)):
+        return [None]
+    size = max(int(os.getenv("split_pages", SPLIT_PAGES)), -(-pages // int(os.getenv("split_max_ranges", SPLIT_MAX_RANGES))))
+    return [str(first) + "-" + str(min(first + size - 1, pages)) for first in range(1, pages + 1, size)]
+
+
+async def analyze_document(model_id, document_url, data, throttle=None):
+    # analyze() for documents of any size. A large PDF is analysed as page ranges at the same time,
+    # and the results of the ranges are returned in page order for extraction.extract() to merge.
+    ranges = page_ranges(page_count(data))
+    if len(ranges) == 1:
+        return await analyze(model_id, document_url, data, throttle)
+    telemetry.record("split_ranges", len(ranges), model=model_id)
+    return list(await asyncio.gather(*(analyze(model_id, document_url, data, throttle, pages) for pages in ranges)))
+
+
+async def store_content(data):
+    # Move the OCR text of extracted data to the content_container blob container and leave its URI.
+    # Blobs are named after the SHA-256 of the text, so a re-uploaded document reuses its blob.
+    content = data.pop("content", None)
+    if content is None:
+        return data
+    text = content.encode("utf-8")
+    container = os.getenv("content_container", DEFAULT_CONTENT_CONTAINER)
+    blob = clients.get_async_blob_client(container, hashlib.sha256(text).hexdigest() + ".txt")
+    await blob.upload_blob(text, overwrite=True)
+    data["content_uri"] = blob.url
+    data["content_length"] = len(content)
+    return data
+
+
+async def load_content(data):
+    # Extracted data with its OCR text, read back from blob storage when store_content() moved it
+    if "content" in data or not data.get("content_uri"):
+        return data
+    container, blob_name = data["content_uri"].rsplit("/", 2)[-2:]
+    downloader = await clients.get_async_blob_client(container, blob_name).download_blob()
+    return dict(data, content=(await downloader.readall()).decode("utf-8"))
+
+
+async def patch_application(application_number, operations, max_attempts=PATCH_MAX_ATTEMPTS, **kwargs):
+    # Apply patch operations to an application document, retrying transient conflicts with backoff.
+    # Pass etag and match_condition for an optimistic concurrency check on the whole document, a
+    # document changed since it was read raises CosmosAccessConditionFailedError (412) straight away.
+    container = clients.get_async_docs_container()
+    for attempt in range(1, max_attempts + 1):
+        try:
+            return await container.patch_item(item=application_number, partition_key=application_number, patch_operations=operations, **kwargs)
+        except CosmosHttpResponseError as error:
+            if error.status_code == 412:
+                telemetry.count("etag_conflicts", service="cosmos")
+            if error.status_code not in PATCH_RETRY_STATUS or attempt == max_attempts:
+                raise
+            telemetry.count("retries", service="cosmos", status=error.status_code)
+            delay = min(PATCH_BASE_DELAY * 2 ** (attempt - 1), PATCH_MAX_DELAY) * random.uniform(0.5, 1.0)
+            logging.warning("Patch of application %s failed with %s, retrying in %.2fs", application_number, error.status_code, delay)
+            await asyncio.sleep(delay)
+
+
+async def save_to_application(application_number, field, data):
+    # Only /field is written, so the invoice and receipt of one application can land at the same
+    # time without a read or overwriting each other
+    await patch_application(application_number, [{"op": "set", "path": "/" + field, "value": data}])
+
+
+async def _copy_server_side(source, target):
+    # Same account copy, the bytes never pass through the function
+    copy = await target.start_copy_from_url(source.url)
+    status = copy["copy_status"]
+    while status == "pending":
+        await asyncio.sleep(COPY_POLL_INTERVAL)
+        status = (await target.get_blob_properties()).copy.status
+    if status != "success":
+        raise HttpResponseError("Copy of " + source.url + " finished with status " + str(status))
+
+
+async def _copy_streaming(source, target):
+    # Fallback that holds one chunk in memory at a time
+    downloader = await source.download_blob()
+    block_list = []
+    async for chunk in downloader.chunks():
+        block_id = base64.b64encode(("%08d" % len(block_list)).encode()).decode()
+        await target.stage_block(block_id, chunk, length=len(chunk))
+        block_list.append(BlobBlock(block_id=block_id))
+    await target.commit_block_list(block_list)
+
+
+async def move_blob(container, blob_name, destination="processed"):
+    # Move container/blob_name to destination/blob_name and delete the original once the copy is confirmed
+    source = clients.get_async_blob_client(container, blob_name)
+    target = clients.get_async_blob_client(destination, blob_name)
+    try:
+        with telemetry.span("copy"):
+            await _copy_server_side(source, target)
+    except HttpResponseError as error:
+        logging.warning("Server side copy of %s failed, streaming it instead: %s", blob_name, error)
+        telemetry.count("retries", service="blob")
+        with telemetry.span("copy_streaming"):
+            await _copy_streaming(source, target)
+
+    with telemetry.span("delete"):
+        source_properties, target_properties = await asyncio.gather(source.get_blob_properties(), target.get_blob_properties())
+        if source_properties.size != target_properties.size:
+            raise RuntimeError("Copy of " + blob_name + " to " + destination + " is incomplete, the original was not deleted")
+        await source.delete_blob()
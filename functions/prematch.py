@@ -0,0 +1,185 @@
+import re
+import datetime
+from difflib import SequenceMatcher
+
+# Rules based pre-match of the structured invoice and receipt fields extracted by extraction.py, in
+# the current schema version (see extraction.upgrade()).
+# Each check votes agree / disagree / unknown, with the certainty of its vote (the lowest extraction
+# confidence of the fields it compared, 0 when it could not compare them). Clear agreement or
+# disagreement produces a verdict that fraud() saves directly, its confidence is the certainty of the
+# checks that decided it. Anything else is "ambiguous" and is sent to Azure Open AI.
+
+MATCH = "match"
+MISMATCH = "mismatch"
+AMBIGUOUS = "ambiguous"
+
+AGREE = "agree"
+DISAGREE = "disagree"
+UNKNOWN = "unknown"
+
+AMOUNT_TOLERANCE = 0.01 # absolute, in the document currency
+DATE_WINDOW_DAYS = 30 # receipt may be dated up to this many days either side of the invoice
+NAME_MATCH = 0.85 # name similarity at or above which vendor and merchant agree
+NAME_MISMATCH = 0.5 # name similarity at or below which they disagree
+MIN_CONFIDENCE = 0.8 # extraction confidence needed for a field to decide a verdict
+
+_name_noise = re.compile(r"[^a-z0-9 ]")
+_company_suffixes = {"ltd", "limited", "inc", "incorporated", "llc", "co", "corp", "corporation", "pty", "plc", "gmbh", "company"}
+
+
+def _amount(value):
+    return float(value) if isinstance(value, (int, float)) else None
+
+
+def parse_date(text):
+    try:
+        return datetime.date.fromisoformat(text)
+    except (TypeError, ValueError):
+        return None
+
+
+def normalise_name(name):
+    words = _name_noise.sub(" ", str(name or "").lower()).split()
+    return " ".join(word for word in words if word not in _company_suffixes)
+
+
+def name_similarity(a, b):
+    a, b = normalise_name(a), normalise_name(b)
+    if not a or not b:
+        return None
+    return SequenceMatcher(None, a, b).ratio()
+
+
+def _certainty(*confidences):
+    return min((confidence if confidence is not None else 0.0 for confidence in confidences), default=0.0)
+
+
+def _confident(certainty):
+    return certainty >= MIN_CONFIDENCE
+
+
+def check_amount(invoice, receipt, tolerance=AMOUNT_TOLERANCE):
+    invoice_code, invoice_total = invoice.get("currency"), _amount(invoice.get("invoice_total"))
+    receipt_code, receipt_total = receipt.get("currency"), _amount(receipt.get("total"))
+    certainty = _certainty(invoice.get("invoice_total_confidence"), receipt.get("total_confidence"))
+    if invoice_total is None or receipt_total is None:
+        return UNKNOWN, "Invoice total or receipt total is missing", 0.0
+    if invoice_code and receipt_code and invoice_code != receipt_code:
+        return DISAGREE, "Invoice is in " + invoice_code + " but the receipt is in " + receipt_code, certainty
+    if abs(invoice_total - receipt_total) <= tolerance + 1e-9:
+        return AGREE, "Invoice total " + str(invoice_total) + " matches receipt total " + str(receipt_total), certainty
+    return DISAGREE, "Invoice total " + str(invoice_total) + " does not match receipt total " + str(receipt_total), certainty
+
+
+def check_date(invoice, receipt, window_days=DATE_WINDOW_DAYS):
+    invoice_date = parse_date(invoice.get("invoice_date"))
+    receipt_date = parse_date(receipt.get("transaction_date"))
+    certainty = _certainty(invoice.get("invoice_date_confidence"), receipt.get("transaction_date_confidence"))
+    if invoice_date is None or receipt_date is None:
+        return UNKNOWN, "Invoice date or receipt date is missing", 0.0
+    days = abs((receipt_date - invoice_date).days)
+    if days <= window_days:
+        return AGREE, "Receipt is dated " + str(days) + " days from the invoice", certainty
+    return DISAGREE, "Receipt is dated " + str(days) + " days from the invoice", certainty
+
+
+def check_vendor(invoice, receipt):
+    vendor, merchant = invoice.get("vendor_name"), receipt.get("merchant_name")
+    similarity = name_similarity(vendor, merchant)
+    certainty = _certainty(invoice.get("vendor_name_confidence"), receipt.get("merchant_name_confidence"))
+    if similarity is None:
+        return UNKNOWN, "Vendor name or merchant name is missing", 0.0
+    if similarity >= NAME_MATCH:
+        return AGREE, "Vendor " + str(vendor) + " matches merchant " + str(merchant), certainty
+    if similarity <= NAME_MISMATCH:
+        return DISAGREE, "Vendor " + str(vendor) + " does not match merchant " + str(merchant), certainty
+    return UNKNOWN, "Vendor " + str(vendor) + " is similar to merchant " + str(merchant), 0.0
+
+
+def _line_items(items, amount_key):
+    # (normalised description, amount) per line item from the item columns
+    descriptions, amounts = items.get("description") or [], items.get(amount_key) or []
+    count = max(len(descriptions), len(amounts))
+    descriptions, amounts = descriptions + [None] * (count - len(descriptions)), amounts + [None] * (count - len(amounts))
+    return [(normalise_name(description), _amount(amount)) for description, amount in zip(descriptions, amounts)]
+
+
+def _item_certainty(items):
+    # Line items without confidences count as certain
+    return _certainty(*[confidence for confidence in items.get("confidence") or [] if confidence is not None] or [1.0])
+
+
+def check_items(invoice, receipt, tolerance=AMOUNT_TOLERANCE):
+    invoice_lines = _line_items(invoice.get("items") or {}, "amount")
+    receipt_lines = _line_items(receipt.get("items") or {}, "total_price")
+    if not invoice_lines or not receipt_lines:
+        return UNKNOWN, "Invoice or receipt has no line items", 0.0
+    certainty = min(_item_certainty(invoice.get("items") or {}), _item_certainty(receipt.get("items") or {}))
+
+    # Pair every invoice line with the unused receipt line that has the closest description and amount
+    unmatched = list(receipt_lines)
+    aligned = 0
+    for description, amount in invoice_lines:
+        for candidate in unmatched:
+            same_amount = amount is not None and candidate[1] is not None and abs(amount - candidate[1]) <= tolerance + 1e-9
+            if same_amount and SequenceMatcher(None, description, candidate[0]).ratio() >= NAME_MATCH:
+                unmatched.remove(candidate)
+                aligned += 1
+                break
+
+    total_lines = max(len(invoice_lines), len(receipt_lines))
+    if aligned == total_lines:
+        return AGREE, "All " + str(aligned) + " line items match", certainty
+    if aligned == 0:
+        return DISAGREE, "None of the line items match", certainty
+    return UNKNOWN, str(aligned) + " of " + str(total_lines) + " line items match", 0.0
+
+
+def prematch(invoice, receipt):
+    # Returns {"verdict", "confidence", "reasons"} for the extracted invoice and receipt data
+    checks = {
+        "amount": check_amount(invoice, receipt),
+        "vendor": check_vendor(invoice, receipt),
+        "date": check_date(invoice, receipt),
+        "items": check_items(invoice, receipt),
+    }
+    reasons = [reason for _, reason, _ in checks.values()]
+    votes = {name: vote for name, (vote, _, _) in checks.items()}
+    certainty = {name: certainty for name, (_, _, certainty) in checks.items()}
+
+    # A confident total or currency disagreement is a clear mismatch on its own. So is a confident
+    # vendor disagreement, unless the totals agree: trading names, card processor prefixes and store
+    # numbers make the merchant on a genuine receipt differ from the vendor on the invoice.
+    deciding = ["amount"] + (["vendor"] if votes["amount"] != AGREE else [])
+    disagreeing = [certainty[name] for name in deciding if votes[name] == DISAGREE and _confident(certainty[name])]
+    if disagreeing:
+        return {"verdict": MISMATCH, "confidence": round(max(disagreeing), 3), "reasons": reasons}
+
+    # A match needs confident total and vendor agreement, corroborated by the date or line items.
+    # It is as certain as the least certain of the total, the vendor and its best corroboration.
+    corroboration = max((certainty[name] for name in ("date", "items") if votes[name] == AGREE), default=None)
+    confident_core = _confident(certainty["amount"]) and _confident(certainty["vendor"])
+    if votes["amount"] == votes["vendor"] == AGREE and confident_core and corroboration is not None and DISAGREE not in votes.values():
+        return {"verdict": MATCH, "confidence": round(min(certainty["amount"], certainty["vendor"], corroboration), 3), "reasons": reasons}
+
+    return {"verdict": AMBIGUOUS, "confidence": 0.0, "reasons": reasons}
+
+
+def prematch_documents(invoices, receipt):
+    # The receipt against each invoice of a file (see extraction.documents()). A bundle matches when
+    # one of its invoices matches, and only mismatches when all of them clearly do.
+    results = [prematch(invoice, receipt) for invoice in invoices]
+    for verdict in (MATCH, AMBIGUOUS):
+        for result in results:
+            if result["verdict"] == verdict:
+                return result
+    return results[0]
+
+
+def describe(result):
+    # Format a verdict the same way the Azure Open AI comparison is worded
+    if result["verdict"] == MATCH:
+        heading = "The invoice and receipt match."
+    else:
+        heading = "The invoice and receipt do not match."
+    return heading + "\n" + "\n".join("- " + reason for reason in result["reasons"])
@@ -0,0 +1,146 @@
+import os
+import re
+import logging
+import threading
+
+# Token budgeted user message for the invoice/receipt comparison.
+# The message is built from the structured fields extracted by extraction.py, followed by the OCR
+# text of each document. When the full text does not fit in the budget (fraud_prompt_token_budget
+# app setting) only the most relevant lines are kept. build_user_message() returns None when even
+# the structured fields do not fit, and comparison.py falls back to a chunked map-reduce instead.
+# Counting tokens encodes whole OCR texts and the first count loads the tiktoken vocabulary, so
+# comparison.py calls these functions on a worker thread, never on the event loop.
+
+DEFAULT_TOKEN_BUDGET = 3000
+FORMAT_VERSION = "4" # part of the comparison cache key, bump when the message layout changes
+
+# Extracted fields that are bookkeeping rather than document content
+_skipped_fields = {"content", "items", "invoice_uri", "receipt_uri", "invoice_status", "receipt_status", "content_uri", "content_fingerprint", "content_length", "schema_version", "duplicates", "additional_documents"}
+_keywords = re.compile(r"total|subtotal|tax|amount|due|paid|balance|date|invoice|receipt|qty|quantity|price|payment|card", re.IGNORECASE)
+_money = re.compile(r"[$€£]|\d+[.,]\d{2}\b")
+_digits = re.compile(r"\d")
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+_encoding = None
+_encoding_failed = False
+_encoding_lock = threading.Lock()
+
+
+def token_budget():
+    return int(os.getenv("fraud_prompt_token_budget", DEFAULT_TOKEN_BUDGET))
+
+
+def _load_encoding():
+    # Loaded once per process, the worker threads counting tokens at the same time wait for it
+    global _encoding, _encoding_failed
+    with _encoding_lock:
+        if _encoding is None and not _encoding_failed:
+            try:
+                _encoding = tiktoken.encoding_for_model("gpt-4")
+            except Exception as error:
+                # The vocabulary is downloaded on first use, which can fail without outbound access
+                logging.warning("tiktoken is unavailable, estimating prompt tokens: %s", error)
+                _encoding_failed = True
+
+
+def count_tokens(text):
+    # Exact count with tiktoken when it is installed and its vocabulary can be loaded, otherwise
+    # the usual estimate of four characters per token
+    if tiktoken is not None and _encoding is None and not _encoding_failed:
+        _load_encoding()
+    if _encoding is not None:
+        return len(_encoding.encode(text))
+    return (len(text) + 3) // 4
+
+
+def render_fields(data):
+    # "key: value" lines for the extracted fields, with one line per line item
+    lines = [key + ": " + str(value) for key, value in data.items() if key not in _skipped_fields and not key.endswith("_confidence")]
+    columns = {name: values for name, values in (data.get("items") or {}).items() if name != "confidence"}
+    count = max((len(values) for values in columns.values()), default=0)
+    for idx in range(count):
+        row = [name + "=" + str(values[idx]) for name, values in columns.items() if idx < len(values) and values[idx] is not None]
+        lines.append("item " + str(idx) + ": " + ", ".join(row))
+    for number, document in enumerate(data.get("additional_documents") or [], 2):
+        lines.append("document " + str(number) + ":")
+        lines.append(render_fields(document))
+    return "\n".join(lines)
+
+
+def _score(line):
+    return 2 * bool(_keywords.search(line)) + 2 * bool(_money.search(line)) + bool(_digits.search(line))
+
+
+def excerpt(content, budget):
+    # The most relevant lines of content that fit in budget tokens, kept in document order
+    lines = [line.strip() for line in (content or "").splitlines() if line.strip()]
+    if count_tokens("\n".join(lines)) <= budget:
+        return "\n".join(lines)
+    ranked = sorted(range(len(lines)), key=lambda idx: (-_score(lines[idx]), idx))
+    chosen, used = set(), 0
+    for idx in ranked:
+        if _score(lines[idx]) == 0:
+            break
+        tokens = count_tokens(lines[idx]) + 1
+        if used + tokens > budget:
+            continue
+        chosen.add(idx)
+        used += tokens
+    return "\n".join(lines[idx] for idx in sorted(chosen))
+
+
+def _section(title, body):
+    return title + ":\n" + body if body else ""
+
+
+def build_user_message(invoice, receipt, budget=None):
+    # Returns (message, tokens), or None when the structured fields alone exceed the budget
+    budget = token_budget() if budget is None else budget
+    invoice_fields = _section("Invoice fields", render_fields(invoice))
+    receipt_fields = _section("Receipt fields", render_fields(receipt))
+    used = count_tokens(invoice_fields) + count_tokens(receipt_fields) + 16
+    if used > budget:
+        return None
+
+    # Share what is left between the two documents, the shorter one hands its unused part over
+    remaining = budget - used
+    invoice_content, receipt_content = invoice.get("content") or "", receipt.get("content") or ""
+    invoice_need, receipt_need = count_tokens(invoice_content), count_tokens(receipt_content)
+    invoice_budget = max(remaining // 2, remaining - receipt_need)
+    invoice_text = excerpt(invoice_content, min(invoice_budget, invoice_need))
+    receipt_text = excerpt(receipt_content, remaining - count_tokens(invoice_text))
+
+    sections = [invoice_fields, _section("Invoice text", invoice_text), receipt_fields, _section("Receipt text", receipt_text)]
+    message = "\n\n".join(section for section in sections if section)
+    return message, count_tokens(message)
+
+
+def chunk_text(text, budget):
+    # Split text on line boundaries into pieces of at most budget tokens
+    lines = []
+    for line in text.splitlines():
+        # A single line longer than the budget is cut into pieces of roughly budget tokens
+        if count_tokens(line) > budget:
+            lines.extend(line[start:start + budget * 4] for start in range(0, len(line), budget * 4))
+        else:
+            lines.append(line)
+    chunks, current, used = [], [], 0
+    for line in lines:
+        tokens = count_tokens(line) + 1
+        if current and used + tokens > budget:
+            chunks.append("\n".join(current))
+            current, used = [], 0
+        current.append(line)
+        used += tokens
+    if current:
+        chunks.append("\n".join(current))
+    return chunks
+
+
+def document_text(title, data):
+    # Everything known about one document, the input to the map step of the map-reduce comparison
+    return "\n\n".join(section for section in (_section(title + " fields", render_fields(data)), _section(title + " text", data.get("content") or "")) if section)
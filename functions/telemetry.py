@@ -0,0 +1,176 @@
+import os
+import time
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+
+# Per stage timings and counters for the invoice, receipt and fraud functions.
+#   span(stage)         - times a block into the stage_duration_ms histogram, tagged with the function,
+#                         the application number and whether the block succeeded
+#   record(name, value) - any other histogram: changefeed_lag_ms, split_ranges
+#   count(name, value)  - counters: retries, etag_conflicts, llm_tokens, duplicates, changefeed_skipped,
+#                         comparisons_reused
+# invocation(function, application) tags everything recorded inside it, so a slow application can be
+# followed stage by stage. Every span is also logged, which is how the application number reaches
+# the Application Insights traces.
+# Measurements go to Application Insights through OpenTelemetry when azure-monitor-opentelemetry is
+# installed and APPLICATIONINSIGHTS_CONNECTION_STRING is set (the Functions host sets it when
+# Application Insights is enabled), and to any exporter passed to add_exporter(), e.g. LocalExporter.
+
+try:
+    from azure.monitor.opentelemetry import configure_azure_monitor
+    from opentelemetry import metrics
+except ImportError:
+    configure_azure_monitor = None
+
+_function = contextvars.ContextVar("telemetry_function", default=None)
+_application = contextvars.ContextVar("telemetry_application", default=None)
+
+_exporters = []
+_configured = False
+_lock = threading.Lock()
+
+
+class LocalExporter:
+    # Keeps every measurement in memory, for tests and benchmarks
+    def __init__(self):
+        self.histograms = {}
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    def record(self, name, value, attributes):
+        with self._lock:
+            self.histograms.setdefault(name, []).append((value, attributes))
+
+    def add(self, name, value, attributes):
+        with self._lock:
+            self.counters.setdefault(name, []).append((value, attributes))
+
+    @staticmethod
+    def _matching(measurements, attributes):
+        return [value for value, tags in measurements if all(tags.get(key) == expected for key, expected in attributes.items())]
+
+    def values(self, name, **attributes):
+        # Histogram values of name whose attributes include the given ones
+        return self._matching(self.histograms.get(name, []), attributes)
+
+    def total(self, name, **attributes):
+        # Sum of counter name over the measurements whose attributes include the given ones
+        return sum(self._matching(self.counters.get(name, []), attributes))
+
+    def clear(self):
+        with self._lock:
+            self.histograms.clear()
+            self.counters.clear()
+
+
+class AzureMonitorExporter:
+    # OpenTelemetry histograms and counters exported to Application Insights as custom metrics
+    def __init__(self):
+        # Metrics only, the Functions host already sends the logs and traces to Application Insights
+        configure_azure_monitor(disable_logging=True, disable_tracing=True)
+        self._meter = metrics.get_meter("doc-intel-fraud")
+        self._instruments = {}
+        self._lock = threading.Lock()
+
+    def _instrument(self, name, create):
+        instrument = self._instruments.get(name)
+        if instrument is None:
+            with self._lock:
+                instrument = self._instruments.get(name)
+                if instrument is None:
+                    instrument = self._instruments[name] = create(name)
+        return instrument
+
+    @staticmethod
+    def _dimensions(attributes):
+        # The application number is left to the traces, as a metric dimension it would create one
+        # time series per application
+        return {key: value for key, value in attributes.items() if key != "application" and value is not None}
+
+    def record(self, name, value, attributes):
+        self._instrument(name, self._meter.create_histogram).record(value, self._dimensions(attributes))
+
+    def add(self, name, value, attributes):
+        self._instrument(name, self._meter.create_counter).add(value, self._dimensions(attributes))
+
+
+def _get_exporters():
+    global _configured
+    if not _configured:
+        with _lock:
+            if not _configured:
+                if configure_azure_monitor is not None and os.getenv("APPLICATIONINSIGHTS_CONNECTION_STRING"):
+                    try:
+                        _exporters.append(AzureMonitorExporter())
+                    except Exception as error:
+                        logging.warning("Application Insights metrics are unavailable: %s", error)
+                _configured = True
+    return _exporters
+
+
+def add_exporter(exporter):
+    _get_exporters()
+    with _lock:
+        _exporters.append(exporter)
+
+
+def remove_exporter(exporter):
+    with _lock:
+        _exporters.remove(exporter)
+
+
+def _attributes(attributes):
+    tags = {"function": _function.get(), "application": _application.get()}
+    tags.update(attributes)
+    return tags
+
+
+def _export(method, name, value, attributes):
+    for exporter in _get_exporters():
+        try:
+            getattr(exporter, method)(name, value, attributes)
+        except Exception as error:
+            # Telemetry must never fail an invocation
+            logging.warning("Exporting %s failed: %s", name, error)
+
+
+def record(name, value, **attributes):
+    _export("record", name, value, _attributes(attributes))
+
+
+def count(name, value=1, **attributes):
+    _export("add", name, value, _attributes(attributes))
+
+
+@contextmanager
+def span(stage, application=None, **attributes):
+    # Time the block as stage. Passing application tags the block and everything recorded inside it.
+    token = _application.set(application) if application is not None else None
+    start = time.perf_counter()
+    success = False
+    try:
+        yield
+        success = True
+    finally:
+        elapsed = (time.perf_counter() - start) * 1000
+        tags = _attributes(attributes)
+        tags.update(stage=stage, success=success)
+        logging.info("%s stage %s of application %s took %.1fms%s", tags["function"], stage, tags["application"], elapsed, "" if success else " and failed")
+        _export("record", "stage_duration_ms", elapsed, tags)
+        if token is not None:
+            _application.reset(token)
+
+
+@contextmanager
+def invocation(function, application=None):
+    # Tag everything recorded in the block with the function and application, and time the whole
+    # invocation as the "total" stage
+    tokens = (_function.set(function), _application.set(application))
+    try:
+        with span("total"):
+            yield
+    finally:
+        _function.reset(tokens[0])
+        _application.reset(tokens[1])
@@ -0,0 +1,314 @@
+import os
+import re
+import sys
+import json
+import time
+import asyncio
+import logging
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+FUNCTIONS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "functions")
+sys.path.insert(0, FUNCTIONS)
+
+from azure.cosmos.exceptions import CosmosResourceNotFoundError
+import cache
+import clients
+import comparison
+import duplicates
+import extraction
+import idempotency
+import imaging
+import pipeline
+import prematch
+
+# Offline backfill: re-run extraction and the fraud comparison over an archive of applications with
+# the same code as the invoice, receipt and fraud functions.
+#   python tools/backfill.py --directory archive/
+#   python tools/backfill.py --container processed
+# Documents are paired by name, <application>-invoice.pdf and <application>-receipt.<ext>, like the
+# blob triggers. Chunks of applications are spread over a pool of processes, each running its chunk
+# concurrently on its own event loop. Document Intelligence, Azure Open AI, Cosmos DB and Blob
+# Storage each have a request rate limit shared by every process. Results are written to Cosmos DB
+# (or a JSON lines file with --output) in batches, and every application written is appended to the
+# checkpoint file, so running the same command again after an interruption carries on from there.
+# With --output nothing is written to Cosmos DB or the content container: documents are not added to
+# the duplicate index and keep their OCR text inline.
+
+DEFAULT_CHUNK_SIZE = 4
+DEFAULT_BATCH_SIZE = 50
+DEFAULT_WRITE_CONCURRENCY = 16
+# Requests per second, 0 for no limit. Document Intelligence S0 allows 15 analyses per second.
+DEFAULT_RATES = {"docintell": 15.0, "openai": 5.0, "cosmos": 100.0, "blob": 0.0}
+
+_invoice_name = re.compile(r"^(?:.*/)?(\d+)-invoice\.pdf$")
+_receipt_name = re.compile(r"^(?:.*/)?(\d+)-receipt\.[A-Za-z]+$")
+
+
+class RateLimiter:
+    # Spaces requests 1/rate seconds apart. The next free slot is kept in shared memory so the
+    # limit holds across every process of the pool.
+    def __init__(self, rate, next_slot):
+        self.rate = rate
+        self._next_slot = next_slot
+
+    def reserve(self):
+        # Seconds to wait before the next request may be sent
+        if not self.rate:
+            return 0.0
+        with self._next_slot.get_lock():
+            now = time.time()
+            slot = max(now, self._next_slot.value)
+            self._next_slot.value = slot + 1.0 / self.rate
+        return slot - now
+
+    async def acquire(self):
+        delay = self.reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+class Checkpoint:
+    # Application numbers that have been written, one per line. Appending is safe to interrupt.
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return set()
+        with open(self.path) as f:
+            return {line.strip() for line in f if line.strip()}
+
+    def add(self, application_numbers):
+        with open(self.path, "a") as f:
+            f.writelines(number + "\n" for number in application_numbers)
+            f.flush()
+            os.fsync(f.fileno())
+
+
+def load_settings(path):
+    # App settings from local.settings.json, without overriding the environment
+    if path and os.path.exists(path):
+        with open(path) as f:
+            for name, value in json.load(f).get("Values", {}).items():
+                os.environ.setdefault(name, str(value))
+
+
+def find_applications(names):
+    # {application number: {"invoice": name, "receipt": name}} for the document names of an archive
+    applications = {}
+    for name in names:
+        for field, pattern in (("invoice", _invoice_name), ("receipt", _receipt_name)):
+            match = pattern.match(name)
+            if match:
+                applications.setdefault(match.group(1), {})[field] = name
+    return applications
+
+
+def list_documents(directory=None, container=None, prefix=None):
+    if directory is not None:
+        return [os.path.relpath(os.path.join(root, name), directory).replace(os.sep, "/") for root, _, names in os.walk(directory) for name in names]
+    container_client = clients.get_blob_service_client().get_container_client(container)
+    return [blob.name for blob in container_client.list_blobs(name_starts_with=prefix)]
+
+
+# Per process state of the pool workers
+_limiters = {}
+_loop = None
+_offline = False
+
+
+def _init_worker(limiters, cache_dir, verbose, offline=False):
+    global _limiters, _loop, _offline
+    logging.basicConfig(level=logging.INFO if verbose else logging.WARNING)
+    _limiters = limiters
+    _offline = offline
+    # One event loop per process, so the async clients in the client registry stay usable between chunks
+    _loop = asyncio.new_event_loop()
+    if cache_dir:
+        cache.set_analysis_cache(cache.AnalysisCache(cache.DirectoryCacheBackend(cache_dir)))
+        cache.set_comparison_cache(cache.ComparisonCache(cache.DirectoryCacheBackend(cache_dir)))
+
+
+async def _read(source, name):
+    kind, location = source
+    if kind == "directory":
+        with open(os.path.join(location, name), "rb") as f:
+            return f.read()
+    await _limiters["blob"].acquire()
+    downloader = await clients.get_async_blob_client(location, name).download_blob()
+    return await downloader.readall()
+
+
+async def _extract(source, name, field, model_id):
+    data = await _read(source, name)
+    if field == "receipt" and imaging.enabled():
+        prepared = await asyncio.to_thread(imaging.preprocess, data)
+        if prepared is not None:
+            data = prepared[0]
+    result = await pipeline.analyze_document(model_id, None, data, throttle=_limiters["docintell"].acquire)
+    extracted = extraction.extract(model_id, result)
+    if source[0] == "container":
+        extracted[field + "_uri"] = clients.get_async_blob_client(source[1], name).url
+    extracted[field + "_status"] = field.capitalize() + " processed successfully."
+    return extracted
+
+
+async def _check_duplicates(application_number, field, model_id, data):
+    # Adds the document to the duplicate index, so later applications are checked against the archive
+    await _limiters["cosmos"].acquire()
+    data["duplicates"] = await duplicates.check(field, model_id, application_number, data)
+
+
+async def _process_application(source, application_number, names, semaphore):
+    # The same steps as invoice(), receipt() and fraud() for one application
+    models = {"invoice": "prebuilt-invoice", "receipt": "prebuilt-receipt"}
+    fields = [field for field in models if field in names]
+    extracted = await asyncio.gather(*(_extract(source, names[field], field, models[field]) for field in fields))
+    doc = dict(zip(fields, extracted), id=application_number)
+    if not _offline:
+        await asyncio.gather(*(_check_duplicates(application_number, field, models[field], doc[field]) for field in fields))
+    if "invoice" in doc and "receipt" in doc:
+        result = prematch.prematch_documents(extraction.documents(doc["invoice"]), doc["receipt"])
+        doc["prematch"] = {"verdict": result["verdict"], "confidence": result["confidence"]}
+        # So the fraud function does not compare the application again when the write reaches the change feed
+        doc["comparison_input"] = idempotency.input_fingerprint(doc["invoice"], doc["receipt"])
+        if result["verdict"] != prematch.AMBIGUOUS:
+            doc["comparison"] = prematch.describe(result)
+        else:
+            await _limiters["openai"].acquire()
+            doc["comparison"] = await comparison.compare(clients.get_async_openai_client(), doc["invoice"], doc["receipt"], semaphore,
+                                                         comparison_cache=cache.get_comparison_cache(), label=application_number)
+
+    # The OCR text goes to blob storage once the comparison no longer needs it
+    if not _offline:
+        for field in fields:
+            await _limiters["blob"].acquire()
+        await asyncio.gather(*(pipeline.store_content(doc[field]) for field in fields))
+    return doc
+
+
+async def _process_all(source, chunk):
+    semaphore = asyncio.Semaphore(len(chunk))
+    results = await asyncio.gather(*(_process_application(source, number, names, semaphore) for number, names in chunk), return_exceptions=True)
+    # Errors are returned as text, SDK exceptions do not always survive pickling back to the parent
+    return [(number, None, repr(result)) if isinstance(result, Exception) else (number, result, None) for (number, _), result in zip(chunk, results)]
+
+
+def process_chunk(source, chunk):
+    # Runs in a pool process, returns (application number, document, error) for each application
+    return _loop.run_until_complete(_process_all(source, chunk))
+
+
+async def _write_one(doc, limiter):
+    # Patch the fields of an existing application so data saved by the client app is kept,
+    # create the application when there is none
+    await limiter.acquire()
+    operations = [{"op": "set", "path": "/" + key, "value": value} for key, value in doc.items() if key != "id"]
+    try:
+        await pipeline.patch_application(doc["id"], operations)
+    except CosmosResourceNotFoundError:
+        await limiter.acquire()
+        await clients.get_async_docs_container().upsert_item(doc)
+
+
+async def write_batch(docs, limiter, concurrency=DEFAULT_WRITE_CONCURRENCY):
+    # Returns the application numbers written and the errors of the ones that were not
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def write(doc):
+        async with semaphore:
+            await _write_one(doc, limiter)
+
+    results = await asyncio.gather(*(write(doc) for doc in docs), return_exceptions=True)
+    written = [doc["id"] for doc, result in zip(docs, results) if not isinstance(result, Exception)]
+    errors = [(doc["id"], result) for doc, result in zip(docs, results) if isinstance(result, Exception)]
+    return written, errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Re-run extraction and the fraud comparison over an archive of applications")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--directory", help="local directory of <application>-invoice.pdf and <application>-receipt.* files")
+    source.add_argument("--container", help="blob container of <application>-invoice.pdf and <application>-receipt.* blobs")
+    parser.add_argument("--prefix", help="only blobs whose name starts with this prefix")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="processes in the pool")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE, help="applications each process works on concurrently")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE, help="applications per bulk write")
+    parser.add_argument("--checkpoint", default="backfill.checkpoint", help="file of the applications already written")
+    parser.add_argument("--output", help="append the results to this JSON lines file instead of writing to Cosmos DB, the content container and the duplicate index")
+    parser.add_argument("--cache-dir", help="keep the analysis and comparison caches in this directory instead of the app settings")
+    parser.add_argument("--settings", default=os.path.join(FUNCTIONS, "local.settings.json"), help="local.settings.json to read app settings from")
+    for name, rate in DEFAULT_RATES.items():
+        parser.add_argument("--" + name + "-rate", type=float, default=rate, help=name + " requests per second, 0 for no limit")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+    load_settings(args.settings)
+    source = ("directory", args.directory) if args.directory else ("container", args.container)
+    applications = find_applications(list_documents(args.directory, args.container, args.prefix))
+    checkpoint = Checkpoint(args.checkpoint)
+    done = checkpoint.load()
+    todo = sorted(number for number in applications if number not in done)
+    chunks = [[(number, applications[number]) for number in todo[i:i + args.chunk_size]] for i in range(0, len(todo), args.chunk_size)]
+    print("%d applications found, %d already in %s, %d to process" % (len(applications), len(applications) - len(todo), args.checkpoint, len(todo)), flush=True)
+
+    context = multiprocessing.get_context("spawn")
+    limiters = {name: RateLimiter(getattr(args, name + "_rate"), context.Value("d", 0.0)) for name in DEFAULT_RATES}
+    loop = asyncio.new_event_loop()
+    counts = {"applications": 0, "documents": 0, "prematched": 0, "compared": 0, "failed": 0}
+    pending = []
+    start = time.perf_counter()
+
+    def flush():
+        if not pending:
+            return
+        if args.output:
+            with open(args.output, "a") as f:
+                f.writelines(json.dumps(doc) + "\n" for doc in pending)
+            written = [doc["id"] for doc in pending]
+        else:
+            written, errors = loop.run_until_complete(write_batch(pending, limiters["cosmos"]))
+            for number, error in errors:
+                logging.error("Writing application %s failed: %s", number, error)
+            counts["failed"] += len(errors)
+        checkpoint.add(written)
+        written = set(written)
+        for doc in pending:
+            if doc["id"] in written:
+                counts["applications"] += 1
+                counts["documents"] += ("invoice" in doc) + ("receipt" in doc)
+                if "prematch" in doc:
+                    counts["compared" if doc["prematch"]["verdict"] == prematch.AMBIGUOUS else "prematched"] += 1
+        pending.clear()
+        elapsed = time.perf_counter() - start
+        print("%d of %d applications written, %.1f docs/sec" % (counts["applications"], len(todo), counts["documents"] / elapsed), flush=True)
+
+    try:
+        with ProcessPoolExecutor(args.workers, mp_context=context, initializer=_init_worker, initargs=(limiters, args.cache_dir, args.verbose, bool(args.output))) as pool:
+            futures = [pool.submit(process_chunk, source, chunk) for chunk in chunks]
+            for future in as_completed(futures):
+                for number, doc, error in future.result():
+                    if error is not None:
+                        logging.error("Application %s failed: %s", number, error)
+                        counts["failed"] += 1
+                    else:
+                        pending.append(doc)
+                if len(pending) >= args.batch_size:
+                    flush()
+    finally:
+        # Keep what has been processed when the run is interrupted
+        flush()
+        loop.run_until_complete(clients.close_async_clients())
+        loop.close()
+
+    elapsed = time.perf_counter() - start
+    print("Backfilled %d applications (%d documents) in %.1fs: %.1f docs/sec, %.2f applications/sec" % (
+        counts["applications"], counts["documents"], elapsed, counts["documents"] / elapsed if elapsed else 0.0, counts["applications"] / elapsed if elapsed else 0.0))
+    print("Settled by the pre-match: %d, compared by Azure Open AI: %d, failed: %d (run again to retry)" % (counts["prematched"], counts["compared"], counts["failed"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+import os
+import sys
+import json
+import asyncio
+import logging
+import argparse
+
+FUNCTIONS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "functions")
+sys.path.insert(0, FUNCTIONS)
+
+from azure.core import MatchConditions
+from azure.cosmos.exceptions import CosmosHttpResponseError
+import clients
+import extraction
+import pipeline
+from backfill import load_settings
+
+# Migrates the invoice and receipt data of every application to the current extraction schema
+# (extraction.SCHEMA_VERSION): the data is converted with extraction.upgrade(), its OCR text is
+# moved to the content_container blob container and the field is patched in place.
+#   python tools/migrate_schema.py --dry-run
+#   python tools/migrate_schema.py
+# Each patch is conditional on the document's etag, an application written to while it was being
+# migrated is skipped and picked up by the next run. Running it again only touches applications
+# that still have inline OCR text. An application with an amount upgrade() cannot read, e.g. in a
+# currency format it does not know, is reported and left as it is rather than losing the amount.
+
+DEFAULT_CONCURRENCY = 16
+FIELDS = {"invoice": "prebuilt-invoice", "receipt": "prebuilt-receipt"}
+# Only documents saved before the content moved to blob storage have it inline
+QUERY = "SELECT * FROM c WHERE IS_DEFINED(c.invoice.content) OR IS_DEFINED(c.receipt.content)"
+
+
+def _size(value):
+    return len(json.dumps(value, default=str).encode("utf-8"))
+
+
+async def migrate(doc, dry_run, counts):
+    upgraded = {field: extraction.upgrade(model_id, doc[field]) for field, model_id in FIELDS.items()
+                if isinstance(doc.get(field), dict) and "content" in doc[field]}
+    unparsed = [field + "." + name for field, data in upgraded.items() for name in extraction.unparsed_amounts(FIELDS[field], data)]
+    if unparsed:
+        logging.warning("Application %s not migrated, these amounts cannot be read: %s", doc["id"], ", ".join(unparsed))
+        counts["unparsed"] += 1
+        return
+
+    operations = []
+    for field, data in upgraded.items():
+        counts["bytes_before"] += _size(doc[field])
+        if dry_run:
+            data = {key: value for key, value in data.items() if key != "content"}
+        else:
+            data = await pipeline.store_content(dict(data))
+        counts["bytes_after"] += _size(data)
+        operations.append({"op": "set", "path": "/" + field, "value": data})
+
+    if operations and not dry_run:
+        await pipeline.patch_application(doc["id"], operations, max_attempts=1, etag=doc["_etag"], match_condition=MatchConditions.IfNotModified)
+    counts["migrated"] += 1
+
+
+async def run(dry_run, concurrency):
+    counts = {"migrated": 0, "skipped": 0, "unparsed": 0, "failed": 0, "bytes_before": 0, "bytes_after": 0}
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def bounded(doc):
+        async with semaphore:
+            try:
+                await migrate(doc, dry_run, counts)
+            except CosmosHttpResponseError as error:
+                if error.status_code != 412:
+                    logging.error("Migrating application %s failed: %s", doc["id"], error)
+                    counts["failed"] += 1
+                    return
+                logging.warning("Application %s changed while it was migrated, run again to migrate it", doc["id"])
+                counts["skipped"] += 1
+            except Exception as error:
+                logging.error("Migrating application %s failed: %s", doc["id"], error)
+                counts["failed"] += 1
+
+    tasks = []
+    async for doc in clients.get_async_docs_container().query_items(query=QUERY):
+        tasks.append(asyncio.create_task(bounded(doc)))
+        # Keep the number of documents held in memory bounded
+        if len(tasks) >= concurrency * 4:
+            await asyncio.gather(*tasks)
+            tasks = []
+    await asyncio.gather(*tasks)
+    await clients.close_async_clients()
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Migrate saved invoice and receipt data to schema version " + str(extraction.SCHEMA_VERSION))
+    parser.add_argument("--dry-run", action="store_true", help="report the size change without writing anything")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY)
+    parser.add_argument("--settings", default=os.path.join(FUNCTIONS, "local.settings.json"), help="local.settings.json to read app settings from")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    load_settings(args.settings)
+    counts = asyncio.run(run(args.dry_run, args.concurrency))
+    before, after = counts["bytes_before"], counts["bytes_after"]
+    print("%s %d applications, skipped %d, failed %d" % ("Would migrate" if args.dry_run else "Migrated", counts["migrated"], counts["skipped"], counts["failed"]))
+    if counts["unparsed"]:
+        print("%d applications left as they are, they have amounts that cannot be read (see the warnings above)" % counts["unparsed"])
+    if before:
+        print("invoice and receipt data: %d bytes -> %d bytes (%.0f%% smaller)" % (before, after, 100 * (1 - after / before)))
+
+
+if __name__ == "__main__":
+    main()
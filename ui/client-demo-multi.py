@@ -1,5 +1,12 @@
 import gradio as gr
 import os
+import io
+import csv
+import time
+import zipfile
+import posixpath
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import azure.cosmos.cosmos_client as cosmos_client
 from azure.cosmos.partition_key import PartitionKey
 from azure.storage.blob import BlobServiceClient
@@ -7,9 +14,18 @@ from dotenv import load_dotenv
 
 load_dotenv()
 
-def application(app_number, app_type, first_name, last_name, address, invoice, receipt):
-    # Save application data to Cosmos DB
+# Files larger than BLOCK_SIZE are uploaded as blocks of BLOCK_SIZE, UPLOAD_CONCURRENCY blocks at a time
+BLOCK_SIZE = 4 * 1024 * 1024
+UPLOAD_CONCURRENCY = 4
+# Applications submitted at once in bulk mode
+BULK_CONCURRENCY = int(os.getenv('BULK_CONCURRENCY', 8))
+# Columns of a bulk manifest. invoice and receipt are file paths inside the zip, relative to its root.
+MANIFEST_COLUMNS = ["application_number", "type", "first_name", "last_name", "address", "invoice", "receipt"]
+
 
+@lru_cache(maxsize=1)
+def get_container():
+    # Created once and shared by every submission, so connections and account metadata are reused
     HOST = os.getenv('COSHOST')
     MASTER_KEY = os.getenv('COSMASTER_KEY')
     DATABASE_ID = os.getenv('COSDATABASE_ID')
@@ -17,8 +33,28 @@ def application(app_number, app_type, first_name, last_name, address, invoice, r
 
     client = cosmos_client.CosmosClient(HOST, {'masterKey': MASTER_KEY})
     db = client.create_database_if_not_exists(id=DATABASE_ID)
-    container = db.create_container_if_not_exists(id=CONTAINER_ID,partition_key=PartitionKey(path='/id', kind='Hash'))
+    return db.create_container_if_not_exists(id=CONTAINER_ID,partition_key=PartitionKey(path='/id', kind='Hash'))
+
+
+@lru_cache(maxsize=1)
+def get_blob_service_client():
+    connection_string = os.getenv('stracc')
+    return BlobServiceClient.from_connection_string(connection_string, max_single_put_size=BLOCK_SIZE, max_block_size=BLOCK_SIZE)
+
+
+def upload(container, blob_name, data):
+    # data is a file object or bytes. Large files are staged as parallel blocks and committed together.
+    blob_client = get_blob_service_client().get_blob_client(container=container, blob=blob_name)
+    blob_client.upload_blob(data, blob_type="BlockBlob", overwrite=True, max_concurrency=UPLOAD_CONCURRENCY)
+
+
+def _open_local(name):
+    return open(name, 'rb')
 
+
+def submit(app_number, app_type, first_name, last_name, address, invoice, receipt, open_file=_open_local):
+    # Save application data to Cosmos DB, then upload the invoice and receipt at the same time.
+    # invoice and receipt are file names that open_file opens for reading.
     app_item = {
         '/id': app_number, # Partition key
         'id': app_number,
@@ -30,36 +66,109 @@ def application(app_number, app_type, first_name, last_name, address, invoice, r
         'receipt': []
     }
 
-    response = container.upsert_item(body=app_item)
+    # The item has to exist before the blob triggers save the extracted data to it
+    get_container().upsert_item(body=app_item)
 
-    # Save invoice and receipt to Azure Blob Storage
-    # Invoice
-    in_filename, in_file_extension = os.path.splitext(invoice)
-    connection_string = os.getenv('stracc')
-    blob_service_client = BlobServiceClient.from_connection_string(connection_string)
-    blob_name = app_number + "-invoice" + in_file_extension
-    blob_client = blob_service_client.get_blob_client(container='invoice', blob=blob_name)
-    with open(invoice, 'rb') as data:
-        blob_client.upload_blob(data, blob_type="BlockBlob")
-
-    # Receipt
-    re_filename, re_file_extension = os.path.splitext(receipt)
-    connection_string = os.getenv('stracc')
-    blob_service_client = BlobServiceClient.from_connection_string(connection_string)
-    blob_name = app_number + "-receipt" + re_file_extension
-    blob_client = blob_service_client.get_blob_client(container='receipt', blob=blob_name)
-    with open(receipt, 'rb') as data:
-        blob_client.upload_blob(data, blob_type="BlockBlob")
+    def upload_file(container, file_name):
+        file_extension = os.path.splitext(file_name)[1]
+        with open_file(file_name) as data:
+            upload(container, app_number + "-" + container + file_extension, data)
+
+    with ThreadPoolExecutor(2) as pool:
+        uploads = [pool.submit(upload_file, "invoice", invoice), pool.submit(upload_file, "receipt", receipt)]
+        for future in uploads:
+            future.result()
+
+
+def application(app_number, app_type, first_name, last_name, address, invoice, receipt):
+    submit(app_number, app_type, first_name, last_name, address, invoice, receipt)
 
     # Return data to user
     return "Thank you " + first_name + " " + last_name + " for submitting your " + app_type + " application " + app_number + " ."
 
-demo = gr.Interface(
-    fn=application, 
-    inputs=[gr.Text(label="Application Number"), gr.Dropdown(choices=["Rebate", "Loan"], label="Type of Application"), gr.Text(label="First Name"), gr.Text(label="Last Name"), "textbox", gr.File(file_types=['.pdf','.jpeg', '.jpg', '.png', '.bmp', '.tiff', '.heif']), gr.File(file_types=['.pdf','.jpeg', '.jpg', '.png', '.bmp', '.tiff', '.heif'])], 
+
+def zip_member(archive, name):
+    # The zip member a manifest path names. Absolute paths and paths out of the zip are refused.
+    path = posixpath.normpath(str(name or "").replace("\\", "/"))
+    if not name or path.startswith("/") or path == ".." or path.startswith("../") or ":" in path.split("/")[0]:
+        raise ValueError("file path " + str(name) + " is not inside the zip")
+    try:
+        return archive.getinfo(path)
+    except KeyError:
+        raise ValueError("file " + str(name) + " is not in the zip")
+
+
+def read_manifest(archive):
+    # The rows of the manifest.csv at the root of the zip
+    try:
+        manifest = archive.open("manifest.csv")
+    except KeyError:
+        raise gr.Error("The zip has no manifest.csv.")
+    with manifest:
+        return list(csv.DictReader(io.TextIOWrapper(manifest, encoding="utf-8-sig")))
+
+
+def bulk(manifest, progress=gr.Progress()):
+    if manifest is None or not zipfile.is_zipfile(manifest):
+        raise gr.Error("Upload a zip with a manifest.csv and the documents.")
+    with zipfile.ZipFile(manifest) as archive:
+        rows = read_manifest(archive)
+        missing = [column for column in MANIFEST_COLUMNS if rows and column not in rows[0]]
+        if missing:
+            raise gr.Error("The manifest has no " + ", ".join(missing) + " column.")
+
+        # Applications whose files are not in the zip are reported, not submitted
+        valid, failures = [], []
+        for row in rows:
+            try:
+                for column in ("invoice", "receipt"):
+                    zip_member(archive, row[column])
+                valid.append(row)
+            except ValueError as error:
+                failures.append(row["application_number"] + ": " + str(error))
+        return _submit_all(valid, lambda name: archive.open(zip_member(archive, name)), failures, progress)
+
+
+def _submit_all(rows, open_file, failures, progress):
+    start = time.perf_counter()
+    total = len(rows) + len(failures)
+    done = 0
+    progress(0, desc="Submitting " + str(len(rows)) + " applications")
+    with ThreadPoolExecutor(BULK_CONCURRENCY) as pool:
+        futures = {pool.submit(submit, *[row[column] for column in MANIFEST_COLUMNS], open_file=open_file): row["application_number"] for row in rows}
+        for future in as_completed(futures):
+            done += 1
+            try:
+                future.result()
+            except Exception as error:
+                failures.append(futures[future] + ": " + str(error))
+            progress(done / len(rows), desc="Submitted " + str(done) + " of " + str(len(rows)) + " applications")
+
+    elapsed = time.perf_counter() - start
+    summary = "Submitted " + str(total - len(failures)) + " of " + str(total) + " applications in " + str(round(elapsed, 1)) + " seconds."
+    if failures:
+        summary += "\nFailed:\n" + "\n".join(failures)
+    return summary
+
+
+file_types = ['.pdf','.jpeg', '.jpg', '.png', '.bmp', '.tiff', '.heif']
+
+single = gr.Interface(
+    fn=application,
+    inputs=[gr.Text(label="Application Number"), gr.Dropdown(choices=["Rebate", "Loan"], label="Type of Application"), gr.Text(label="First Name"), gr.Text(label="Last Name"), "textbox", gr.File(file_types=file_types), gr.File(file_types=file_types)],
     outputs="textbox",
     title="Sample Customer Rebate Application",
     description="This is a sample application form. Please enter your information, attach your invoice and receipt and submit."
     )
-    
-demo.launch()
\ No newline at end of file
+
+batch = gr.Interface(
+    fn=bulk,
+    inputs=[gr.File(label="Manifest", file_types=['.zip'])],
+    outputs="textbox",
+    title="Bulk Submission",
+    description="Submit many applications at once. Upload a zip with a manifest.csv and the documents. The manifest columns are " + ", ".join(MANIFEST_COLUMNS) + "; invoice and receipt are file paths inside the zip."
+    )
+
+demo = gr.TabbedInterface([single, batch], ["Application", "Bulk Submission"])
+
+demo.launch()
@@ -1,36 +1,125 @@
 import gradio as gr
 import os
+import time
+import threading
+from functools import lru_cache
+from collections import OrderedDict
 import azure.cosmos.cosmos_client as cosmos_client
-from azure.cosmos.partition_key import PartitionKey
+from azure.cosmos.exceptions import CosmosResourceNotFoundError
 from dotenv import load_dotenv
 
 load_dotenv()
 
-def application(app_number):
-    # Retreive application data from Cosmos DB
+# Seconds an application looked up by number is served from memory before it is read again
+CACHE_TTL = float(os.getenv('PROCESSOR_CACHE_TTL', 30))
+CACHE_SIZE = 256
+
+# Review queue filters. The fields written by the invoice, receipt and fraud functions decide the status.
+STATUSES = {
+    "Awaiting documents": "NOT IS_DEFINED(c.invoice.invoice_status) OR NOT IS_DEFINED(c.receipt.receipt_status)",
+    "Awaiting comparison": "IS_DEFINED(c.invoice.invoice_status) AND IS_DEFINED(c.receipt.receipt_status) AND NOT IS_DEFINED(c.comparison)",
+    "Match": "c.prematch.verdict = 'match'",
+    "Mismatch": "c.prematch.verdict = 'mismatch'",
+    "Compared by Azure Open AI": "c.prematch.verdict = 'ambiguous' AND IS_DEFINED(c.comparison)",
+    "Duplicate documents": "ARRAY_LENGTH(c.invoice.duplicates) > 0 OR ARRAY_LENGTH(c.receipt.duplicates) > 0",
+}
+
+# Only the fields shown in the queue are returned, not the extracted documents
+QUEUE_COLUMNS = ["Application Number", "Type", "First Name", "Last Name", "Invoice Total", "Receipt Total", "Verdict"]
+QUEUE_QUERY = 'SELECT c.id, c.type, c.first_name, c.last_name, c.invoice.invoice_total, c.receipt.total, c.prematch.verdict FROM c WHERE '
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+@lru_cache(maxsize=1)
+def get_container():
+    # One client for the whole app, so connections and account metadata are reused between clicks
     HOST = os.getenv('COSHOST')
     MASTER_KEY = os.getenv('COSMASTER_KEY')
     DATABASE_ID = os.getenv('COSDATABASE_ID')
     CONTAINER_ID = os.getenv('COSCONTAINER_ID')
 
     client = cosmos_client.CosmosClient(HOST, {'masterKey': MASTER_KEY})
-    db = client.create_database_if_not_exists(id=DATABASE_ID)
-    container = db.get_container_client(CONTAINER_ID)
-    query = 'SELECT * FROM c WHERE c.id = ' + '"' + app_number + '"'
-    items = container.query_items(
-        query=query,
-        enable_cross_partition_query=True
-    )
-    
-    for i in items:
-        return i.get('first_name'), i.get('last_name'), i.get('address'), i.get('invoice'), i.get('receipt'), i.get('comparison')
-
-demo = gr.Interface(
-    fn=application,
-    inputs=[gr.Text(label="Application Number")],
-    outputs=[gr.Text(label="First Name"), gr.Text(label="Last Name"), gr.Text(label="Address"), gr.Text(label="Invoice"), gr.Text(label="Receipt"), gr.Text(label="comparison")],
-    title="Sample Processor Application",
-    description="This is a sample application for a processors to assess the rebate application. Enter the application number to retrieve the application data."
-    )
-    
-demo.launch()
\ No newline at end of file
+    return client.get_database_client(DATABASE_ID).get_container_client(CONTAINER_ID)
+
+
+def read_application(app_number):
+    # Point read by id, which is also the partition key, served from a short lived cache
+    with _cache_lock:
+        cached = _cache.get(app_number)
+        if cached is not None and cached[0] > time.monotonic():
+            return cached[1]
+
+    try:
+        item = get_container().read_item(item=app_number, partition_key=app_number)
+    except CosmosResourceNotFoundError:
+        return None
+
+    with _cache_lock:
+        _cache[app_number] = (time.monotonic() + CACHE_TTL, item)
+        _cache.move_to_end(app_number)
+        while len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+    return item
+
+
+def application(app_number):
+    # Retreive application data from Cosmos DB
+    i = read_application(app_number.strip())
+    if i is None:
+        raise gr.Error("Application " + app_number + " was not found.")
+    return i.get('first_name'), i.get('last_name'), i.get('address'), i.get('invoice'), i.get('receipt'), i.get('comparison')
+
+
+def queue_page(status, page_size, position):
+    # Next page of the review queue. position is {"status", "page_size", "token"}, the continuation
+    # token of the previous page and the query it belongs to, kept in the session. A different status
+    # or page size starts a new query.
+    page_size = int(page_size)
+    if position is None or position["status"] != status or position["page_size"] != page_size:
+        position = {"status": status, "page_size": page_size, "token": None}
+    elif position["token"] is None:
+        return [], position, "No more applications."
+    query = QUEUE_QUERY + "(" + STATUSES[status] + ")"
+    pager = get_container().query_items(query=query, enable_cross_partition_query=True, max_item_count=page_size).by_page(position["token"])
+    try:
+        page = list(next(pager))
+    except StopIteration:
+        page = []
+    position = dict(position, token=pager.continuation_token)
+    rows = [[i.get('id'), i.get('type'), i.get('first_name'), i.get('last_name'), i.get('invoice_total'), i.get('total'), i.get('verdict')] for i in page]
+    if position["token"] is None:
+        return rows, position, str(len(rows)) + " applications, the last page."
+    return rows, position, str(len(rows)) + " applications, press Next page for more."
+
+
+def first_page(status, page_size):
+    return queue_page(status, page_size, None)
+
+
+with gr.Blocks(title="Sample Processor Application") as demo:
+    gr.Markdown("# Sample Processor Application")
+    with gr.Tab("Application"):
+        gr.Markdown("This is a sample application for a processors to assess the rebate application. Enter the application number to retrieve the application data.")
+        app_number = gr.Text(label="Application Number")
+        lookup = gr.Button("Submit")
+        outputs = [gr.Text(label="First Name"), gr.Text(label="Last Name"), gr.Text(label="Address"), gr.Text(label="Invoice"), gr.Text(label="Receipt"), gr.Text(label="comparison")]
+        lookup.click(application, inputs=[app_number], outputs=outputs)
+        app_number.submit(application, inputs=[app_number], outputs=outputs)
+
+    with gr.Tab("Review queue"):
+        gr.Markdown("Work through the applications with a given status, one page at a time.")
+        with gr.Row():
+            status = gr.Dropdown(choices=list(STATUSES), value="Compared by Azure Open AI", label="Status")
+            page_size = gr.Number(value=25, precision=0, label="Page size")
+        with gr.Row():
+            start = gr.Button("First page")
+            more = gr.Button("Next page")
+        position = gr.State(None)
+        message = gr.Markdown()
+        table = gr.Dataframe(headers=QUEUE_COLUMNS, interactive=False)
+        start.click(first_page, inputs=[status, page_size], outputs=[table, position, message])
+        more.click(queue_page, inputs=[status, page_size, position], outputs=[table, position, message])
+
+demo.launch()